@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# YAFF is yet another force-field code
+# Copyright (C) 2011 - 2013 Toon Verstraelen <Toon.Verstraelen@UGent.be>,
+# Louis Vanduyfhuys <Louis.Vanduyfhuys@UGent.be>, Center for Molecular Modeling
+# (CMM), Ghent University, Ghent, Belgium; all rights reserved unless otherwise
+# stated.
+#
+# This file is part of YAFF.
+#
+# YAFF is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# YAFF is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+'''Benchmark for the cold-start latency of Yaff
+
+   Every measurement is carried out in a fresh Python interpreter, such that
+   the timings include the import of all (third-party) modules. This makes it
+   easy to spot regressions in the start-up time of short-lived scripts that
+   only need a few parts of Yaff.
+'''
+
+
+import os, sys, argparse, subprocess
+
+
+cases = [
+    ('import', '''
+import time
+time0 = time.time()
+import yaff
+time1 = time.time()
+'''),
+    ('generate', '''
+import time
+time0 = time.time()
+from yaff import System, ForceField, context, log
+log.set_level(log.silent)
+system = System.from_file(context.get_fn('opttest/water_dimer.chk'))
+ff = ForceField.generate(system, context.get_fn('test/parameters_water.txt'), rcut=200.0)
+time1 = time.time()
+'''),
+]
+
+
+# The following code is appended to each case to report the results.
+report = '''
+print 'IMPORTBENCH %.6f %s' % (time1 - time0, ','.join(
+    name for name in heavy_modules if name in sys.modules
+))
+'''
+
+
+# Modules that should only be loaded when they are really needed.
+heavy_modules = [
+    'h5py', 'matplotlib', 'scipy', 'yaff.analysis', 'yaff.conversion',
+    'yaff.sampling', 'yaff.tune',
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog='importbench.py',
+        description='Measure the cold-start latency of YAFF.')
+    parser.add_argument('case', default=None, nargs='?',
+        help='Select one case to run. If not given, all cases are executed.')
+    parser.add_argument('-r', '--repeat', default=5, type=int,
+        help='The number of fresh interpreters used for each case. '
+             '[default=%(default)s]')
+    return parser.parse_args()
+
+
+def run_case(code):
+    '''Run the code of a case in a fresh interpreter.
+
+       Returns the wall time and a list of heavy modules that were loaded.
+    '''
+    code = 'import sys\nheavy_modules = %r\n' % heavy_modules + code + report
+    env = dict(os.environ)
+    if os.path.isfile('setup.py') and os.path.isdir('data') and os.path.isdir('yaff'):
+        # Needed in case the benchmark is executed on an in-place build:
+        rootdir = os.getcwd()
+        env['PYTHONPATH'] = rootdir + ':' + env.get('PYTHONPATH', '')
+        env['YAFFDATA'] = os.path.join(rootdir, 'data')
+    proc = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE, env=env)
+    outdata = proc.communicate()[0]
+    if proc.returncode != 0:
+        raise RuntimeError('Benchmark case failed with return code %i.' % proc.returncode)
+    for line in outdata.split('\n'):
+        if line.startswith('IMPORTBENCH'):
+            words = line.split()
+            loaded = words[2].split(',') if len(words) > 2 else []
+            return float(words[1]), loaded
+    raise RuntimeError('Could not find the timing in the output of the benchmark case.')
+
+
+def main():
+    args = parse_args()
+    print 'Case            Min [s]   Median [s]      Max [s]   Heavy modules'
+    print '-'*80
+    for name, code in cases:
+        if args.case is not None and args.case != name:
+            continue
+        timings = []
+        for irepeat in xrange(args.repeat):
+            timing, loaded = run_case(code)
+            timings.append(timing)
+        timings.sort()
+        print '%-10s %12.3f %12.3f %12.3f   %s' % (
+            name, timings[0], timings[len(timings)/2], timings[-1],
+            ', '.join(loaded) if len(loaded) > 0 else '-'
+        )
+
+
+if __name__ == '__main__':
+    main()
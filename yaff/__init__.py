@@ -28,20 +28,178 @@
    (:mod:`yaff.sampling`), trajectory analysis (:mod:`yaff.analysis`) and
    parameter tuning (:mod:`yaff.tune`). These major subpackages are discusses in
    the following sections.
+
+   All public names of the subpackages are also available in the ``yaff``
+   namespace, e.g. ``yaff.System`` or ``from yaff import *``. Only the units,
+   the constants, the logger and the context are imported eagerly. The
+   subpackages are imported the first time one of their names is requested,
+   such that ``import yaff`` remains cheap and, for example, scripts that only
+   use ``System`` and ``ForceField`` never load the analysis code, matplotlib
+   or h5py.
 '''
 
 
 __version__ = '1.1.2'
 
+import sys as _sys
+from importlib import import_module as _import_module
+from types import ModuleType as _ModuleType
+
 from molmod.units import *
 from molmod.constants import *
 
-from yaff.analysis import *
-from yaff.atselect import *
-from yaff.conversion import *
 from yaff.context import *
 from yaff.log import *
-from yaff.pes import *
-from yaff.sampling import *
-from yaff.system import *
-from yaff.tune import *
+
+
+# The modules whose public names are exposed in the yaff namespace, in the
+# order in which they are searched, with the names each module provides. Cheap
+# modules come first, such that a name never triggers the import of a heavier
+# subpackage than needed. This table is static, such that looking up a name,
+# or finding out that it does not exist, does not import any subpackage.
+# ``yaff/test/test_import.py`` checks that it matches the subpackages.
+_lazy_names = [
+    ('atselect', [
+        'atsel_compile', 'check_name', 'find_first', 'iter_bond_matches',
+        'iter_matches', 'lex_find', 'lex_split'
+    ]),
+    ('system', [
+        'System'
+    ]),
+    ('pes', [
+        'BendAngle', 'BendAngleHarmGenerator', 'BendCos', 'BendCosGenerator',
+        'BendCosHarmGenerator', 'BendGenerator', 'Bond', 'BondDoubleWell',
+        'BondDoubleWell2Generator', 'BondDoubleWellGenerator',
+        'BondFuesGenerator', 'BondGenerator', 'BondHarmGenerator',
+        'BondMorseGenerator', 'Cell', 'Chebychev1', 'Chebychev2', 'Chebychev3',
+        'Chebychev4', 'Chebychev6', 'Complain', 'Cosine', 'Cross',
+        'CrossGenerator', 'D3BJGenerator', 'DampDispGenerator', 'DeltaList',
+        'DihedAngle', 'DihedCos', 'ExpRepGenerator', 'FFArgs',
+        'FixedChargeGenerator', 'ForceField', 'ForcePart',
+        'ForcePartEwaldCorrection', 'ForcePartEwaldCorrectionDD',
+        'ForcePartEwaldNeutralizing', 'ForcePartEwaldReciprocal',
+        'ForcePartEwaldReciprocalDD', 'ForcePartGrid', 'ForcePartPair',
+        'ForcePartPressure', 'ForcePartValence', 'Fues', 'Generator', 'Hammer',
+        'Harmonic', 'InternalCoordinate', 'InternalCoordinateList',
+        'LJGenerator', 'MM3Bend', 'MM3BendGenerator', 'MM3Generator',
+        'MM3Quartic', 'MM3QuarticGenerator', 'Morse', 'NeighborList',
+        'NonbondedGenerator', 'OopAngle', 'OopAngleGenerator', 'OopCos',
+        'OopCosGenerator', 'OopDist', 'OopDistGenerator', 'OopMeanAngle',
+        'OopMeanAngleGenerator', 'OopMeanCos', 'OopMeanCosGenerator',
+        'PairPot', 'PairPotChargeTransferSlater1s1s', 'PairPotDampDisp',
+        'PairPotDisp68BJDamp', 'PairPotEI', 'PairPotEIDip',
+        'PairPotEiSlater1s1sCorr', 'PairPotEiSlater1sp1spCorr',
+        'PairPotExpRep', 'PairPotGrimme', 'PairPotLJ', 'PairPotLJCross',
+        'PairPotMM3', 'PairPotOlpSlater1s1s', 'PairPotQMDFFRep',
+        'ParameterDefinition', 'ParameterSection', 'Parameters', 'PolyFour',
+        'PolySix', 'Scalings', 'Switch3', 'TorsionCos2HarmGenerator',
+        'TorsionCosHarmGenerator', 'TorsionGenerator', 'UreyBradley',
+        'UreyBradleyHarmGenerator', 'ValenceCrossGenerator',
+        'ValenceGenerator', 'ValenceList', 'ValenceTerm', 'apply_generators',
+        'compute_ewald_corr', 'compute_ewald_corr_dd', 'compute_ewald_reci',
+        'compute_ewald_reci_dd', 'compute_grid3d', 'dlist', 'dlist_back',
+        'dlist_forward', 'ext', 'ff', 'generator', 'iclist', 'iclist_back',
+        'iclist_forward', 'iter_paths', 'nlist', 'nlist_build', 'nlist_inc_r',
+        'nlist_recompute', 'nlist_status_finish', 'nlist_status_init',
+        'parameters', 'scaling', 'vlist', 'vlist_back', 'vlist_forward'
+    ]),
+    ('sampling', [
+        'AndersenThermostat', 'AnisoCellDOF', 'AttributeStateItem',
+        'BFGSHessianModel', 'BackgroundWriter', 'BaseCellDOF', 'BaseOptimizer',
+        'BerendsenBarostat', 'BerendsenThermostat', 'CGOptimizer',
+        'CSVRThermostat', 'CartesianDOF', 'CellStateItem', 'ConsErrTracker',
+        'DOF', 'DipoleStateItem', 'DipoleVelStateItem', 'EPotContribStateItem',
+        'EpotBendsStateItem', 'EpotBondsStateItem', 'EpotDihedsStateItem',
+        'FixedBCDOF', 'FixedVolOrthoCellDOF', 'FullCellDOF', 'GLEThermostat',
+        'HDF5Writer', 'Hook', 'IsoCellDOF', 'Iterative', 'KineticAnnealing',
+        'LangevinBarostat', 'LangevinThermostat', 'MTKAttributeStateItem',
+        'MTKBarostat', 'McDonaldBarostat', 'NHCAttributeStateItem',
+        'NHCThermostat', 'OptScreenLog', 'PRBarostat', 'PosStateItem',
+        'QNOptimizer', 'RawDataset', 'RawGroup', 'RawTrajectoryFile',
+        'RawWriter', 'RefTrajectory', 'RestartWriter', 'SR1HessianModel',
+        'StateItem', 'StrainCellDOF', 'TBCombination', 'TadmorBarostat',
+        'TemperatureStateItem', 'TrajScreenLog', 'VerletHook',
+        'VerletIntegrator', 'VerletScreenLog', 'VolumeStateItem', 'XYZWriter',
+        'angular_moment', 'cell_symmetrize', 'clean_momenta', 'dof',
+        'estimate_cart_hessian', 'estimate_elastic', 'estimate_hessian',
+        'get_ndof_baro', 'get_ndof_internal_md', 'get_random_vel',
+        'get_random_vel_press', 'harmonic', 'io', 'iterative', 'npt', 'nvt',
+        'opt', 'raw_to_hdf5', 'read_raw_header', 'remove_angular_moment',
+        'remove_com_moment', 'solve_trust_radius',
+        'stabilized_cholesky_decomp', 'trajectory', 'utils', 'verlet'
+    ]),
+    ('tune', [
+        'BendGroup', 'BondGroup', 'CostFunction', 'FCTest',
+        'GeoOptHessianSimulation', 'GeoOptSimulation', 'ICGroup', 'ICTest',
+        'IncrementRule', 'ModifierRule', 'ParameterModifier',
+        'ParameterTransform', 'ScaleRule', 'Simulation', 'Test', 'cost',
+        'transform'
+    ]),
+    ('conversion', [
+        'check_trajectory_rows', 'common', 'cp2k', 'cp2k_ener_to_hdf5',
+        'dlpoly', 'dlpoly_history_to_hdf5', 'g09log_to_hdf5', 'gaussian',
+        'get_last_trajectory_row', 'get_trajectory_datasets',
+        'get_trajectory_group', 'write_to_dataset', 'xyz', 'xyz_to_hdf5'
+    ]),
+    ('analysis', [
+        'AnalysisDriver', 'AnalysisHook', 'AnalysisInput',
+        'BlockingAccumulator', 'CovarianceAccumulator', 'DensityMap',
+        'Diffusion', 'InternalCoordinateSeries', 'RDF', 'RunningStatistics',
+        'Spectrum', 'basic', 'blav', 'blocking', 'calc_cov_mat',
+        'calc_cov_mat_internal', 'calc_pca', 'density', 'diffusion',
+        'get_slice', 'hook', 'ic', 'inefficiency', 'iter_batches', 'pca',
+        'pca_convergence', 'pca_projection', 'pca_similarity', 'plot_angle',
+        'plot_cell_pars', 'plot_density', 'plot_dihedral', 'plot_energies',
+        'plot_epot_contribs', 'plot_press_dist', 'plot_pressure',
+        'plot_temp_dist', 'plot_temperature', 'plot_volume_dist', 'rdf',
+        'spectrum', 'stats', 'write_principal_mode'
+    ]),
+]
+_lazy_modules = [modname for modname, names in _lazy_names]
+_lazy_map = dict((name, modname) for modname, names in _lazy_names for name in names)
+
+
+class _LazyModule(_ModuleType):
+    '''The yaff package, with subpackages that are imported on first access'''
+
+    def __getattr__(self, name):
+        # This is only called when the name is not present yet.
+        if name == '__all__':
+            for modname in _lazy_modules:
+                self._load(modname)
+            self.__all__ = sorted(
+                name for name in self.__dict__ if not name.startswith('_')
+            )
+            return self.__all__
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if name in _lazy_modules:
+            return _import_module('yaff.%s' % name)
+        modname = _lazy_map.get(name)
+        if modname is None:
+            raise AttributeError('module \'yaff\' has no attribute \'%s\'' % name)
+        self._load(modname)
+        return self.__dict__[name]
+
+    def _load(self, modname):
+        '''Import a module and copy its public names into the yaff namespace
+
+           Only the names that ``_lazy_map`` assigns to this module are
+           copied, such that the first module in ``_lazy_modules`` takes
+           precedence.
+        '''
+        if modname in self._loaded:
+            return
+        module = _import_module('yaff.%s' % modname)
+        for name in _lazy_names[_lazy_modules.index(modname)][1]:
+            setattr(self, name, getattr(module, name))
+        self._loaded.add(modname)
+
+
+_module = _LazyModule(__name__, __doc__)
+_module.__dict__.update(globals())
+_module._loaded = set()
+# Keep a reference to the original module. Python 2 clears the globals of a
+# module when it is garbage collected, which would break the functions above.
+_module._original = _sys.modules[__name__]
+_sys.modules[__name__] = _module
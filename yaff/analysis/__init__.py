@@ -26,8 +26,12 @@
 
 from yaff.analysis.basic import *
 from yaff.analysis.blav import *
+from yaff.analysis.density import *
 from yaff.analysis.diffusion import *
+from yaff.analysis.hook import *
+from yaff.analysis.ic import *
 from yaff.analysis.rdf import *
 from yaff.analysis.spectrum import *
+from yaff.analysis.stats import *
 from yaff.analysis.utils import *
 from yaff.analysis.pca import *
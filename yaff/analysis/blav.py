@@ -26,10 +26,9 @@
 
 import numpy as np
 from molmod.units import *
-import matplotlib.pyplot as pt
 
 
-__all__ = ['blav', 'inefficiency']
+__all__ = ['blav', 'inefficiency', 'BlockingAccumulator', 'blocking']
 
 
 def blav(signal, minblock=100, fn_png=None, unit=None):
@@ -178,6 +177,7 @@ def inefficiency(signal, time = None, fn_png = 'stat_ineff.png', taus = None, eq
             phi[i,j] = 1.*tau*np.var(averages)/varX
 
     # Plot the statistical ineffiency
+    import matplotlib.pyplot as pt
     if time is not None:
         xlabel = 'Length of segment [ps]'
         unit = 1./((time[1]-time[0])/picosecond)
@@ -197,3 +197,214 @@ def inefficiency(signal, time = None, fn_png = 'stat_ineff.png', taus = None, eq
         pt.plot(taus/unit, phi[i,:], color=comap(clr), label='Equilibrated for %i %s' %(eq_limits[i]/unit, unit_ab))
     pt.legend(loc='center left', bbox_to_anchor=(1, 0.5))
     pt.savefig(fn_png, bbox_inches='tight')
+
+
+class BlockingAccumulator(object):
+    '''Hierarchical block averages of signals, built up in a single pass
+
+       This is the blocking method of Flyvbjerg and Petersen:
+
+            Flyvbjerg, H.; Petersen, H. G. J. Chem. Phys. 1989, 91, 461-466.
+
+       At level zero, the statistics of the original samples are collected.
+       The averages of consecutive pairs of samples at one level form the
+       samples of the next level. Samples can be added in chunks, e.g. from an
+       online hook, and the total cost is linear in the length of the signal.
+       Many observables are treated at once: the first index of a chunk
+       refers to the time step, all other indexes to the observables.
+    '''
+    def __init__(self, shape=()):
+        """
+           **Optional arguments:**
+
+           shape
+                The shape of one sample, i.e. of all observables at one time
+                step. By default, a single scalar observable is analyzed.
+        """
+        self.shape = tuple(shape)
+        self.size = int(np.product(self.shape))
+        # Per level: the number of samples, their mean and the sum of squared
+        # deviations from the mean.
+        self.nsamples = []
+        self.means = []
+        self.m2s = []
+        # Per level: the first sample, used as shift, the sum of products of
+        # consecutive shifted samples and the last shifted sample. These are
+        # needed for the lag-one autocovariance.
+        self.firsts = []
+        self.products = []
+        self.lasts = []
+        # Per level: a sample that still awaits its partner, or None.
+        self.pending = []
+
+    def update(self, samples):
+        '''Add a chunk of samples, the first index is the time step'''
+        samples = np.asarray(samples, float).reshape(-1, self.size)
+        level = 0
+        while len(samples) > 0:
+            if level == len(self.nsamples):
+                self.nsamples.append(0)
+                self.means.append(np.zeros(self.size, float))
+                self.m2s.append(np.zeros(self.size, float))
+                self.firsts.append(samples[0].copy())
+                self.products.append(np.zeros(self.size, float))
+                self.lasts.append(np.zeros(self.size, float))
+                self.pending.append(None)
+            self._merge(level, samples)
+            if self.pending[level] is not None:
+                samples = np.concatenate([self.pending[level][None], samples])
+            npair = len(samples)//2
+            if len(samples) % 2 == 1:
+                self.pending[level] = samples[-1].copy()
+            else:
+                self.pending[level] = None
+            samples = 0.5*(samples[:2*npair:2] + samples[1:2*npair:2])
+            level += 1
+
+    def _merge(self, level, samples):
+        # Pairwise update of Chan et al., which is numerically stable.
+        nsample = len(samples)
+        mean = samples.mean(axis=0)
+        m2 = ((samples - mean)**2).sum(axis=0)
+        ntotal = self.nsamples[level] + nsample
+        delta = mean - self.means[level]
+        self.m2s[level] += m2 + delta**2*(self.nsamples[level]*float(nsample)/ntotal)
+        self.means[level] += delta*(float(nsample)/ntotal)
+        # Products of consecutive samples, also across the chunk boundary.
+        shifted = samples - self.firsts[level]
+        self.products[level] += (shifted[:-1]*shifted[1:]).sum(axis=0)
+        if self.nsamples[level] > 0:
+            self.products[level] += self.lasts[level]*shifted[0]
+        self.lasts[level] = shifted[-1]
+        self.nsamples[level] = ntotal
+
+    def get_mean(self):
+        '''Return the average of all samples'''
+        if len(self.nsamples) == 0:
+            raise ValueError('No samples were added.')
+        return self.means[0].reshape(self.shape)
+
+    def get_variance(self):
+        '''Return the variance of all samples'''
+        if len(self.nsamples) == 0:
+            raise ValueError('No samples were added.')
+        return (self.m2s[0]/self.nsamples[0]).reshape(self.shape)
+
+    def get_errors(self):
+        '''Return the error on the mean estimated at each level
+
+           **Returns:**
+
+           nblocks
+                The number of blocks at each level.
+
+           errors
+                The estimates of the error on the mean, for each level with at
+                least two blocks. The first index refers to the level.
+
+           errors_errors
+                The uncertainties on the estimates of the error.
+        '''
+        nblocks = np.array([n for n in self.nsamples if n >= 2])
+        if len(nblocks) == 0:
+            raise ValueError('At least two samples are needed to estimate the error.')
+        m2s = np.array(self.m2s[:len(nblocks)])
+        errors = np.sqrt(m2s/(nblocks*(nblocks - 1.0))[:,None])
+        errors_errors = errors/np.sqrt(2*(nblocks - 1.0))[:,None]
+        shape = (len(nblocks),) + self.shape
+        return nblocks, errors.reshape(shape), errors_errors.reshape(shape)
+
+    def _get_autocovariances(self, nlevel):
+        # The lag-one autocovariance at each level, with the normalization
+        # of a biased estimator, as in Jonsson's method.
+        result = np.zeros((nlevel, self.size))
+        for level in xrange(nlevel):
+            n = self.nsamples[level]
+            mean = self.means[level] - self.firsts[level]
+            result[level] = (
+                self.products[level] + mean*self.lasts[level] - (n + 1)*mean**2
+            )/n
+        return result
+
+    def get_error(self, minblock=16, alpha=0.01):
+        '''Return the error on the mean at the plateau of the blocking analysis
+
+           **Optional arguments:**
+
+           minblock
+                The minimum number of blocks at the levels that are
+                considered. Only the first level is used when the signal has
+                too few samples.
+
+           alpha
+                The significance level of the test for correlations between
+                the block averages.
+
+           The plateau is located with the automated test of Jonsson:
+
+                Jonsson, M. Phys. Rev. E 2018, 98, 043304.
+
+           It selects the first level at which the lag-one autocorrelations of
+           this and all subsequent levels are consistent with uncorrelated
+           block averages. When no such level exists, the last considered
+           level is used.
+
+           **Returns:**
+
+           error
+                The error on the mean of each observable.
+
+           sinef
+                The statistical inefficiency of each observable, i.e. the
+                ratio of the variance on the mean with the one obtained when
+                all samples would be uncorrelated.
+        '''
+        from scipy.stats import chi2
+        nblocks, errors, errors_errors = self.get_errors()
+        nlevel = max(1, (nblocks >= minblock).sum())
+        errors = errors.reshape(len(nblocks), -1)[:nlevel]
+        variances = np.array(self.m2s[:nlevel])/nblocks[:nlevel,None]
+        gammas = self._get_autocovariances(nlevel)
+        ratios = np.zeros(gammas.shape)
+        mask = variances > 0
+        ratios[mask] = gammas[mask]/variances[mask]
+        # M_j statistics, summed from the last level backwards
+        ms = np.cumsum((nblocks[:nlevel,None]*ratios**2)[::-1], axis=0)[::-1]
+        quantiles = chi2.ppf(1 - alpha, np.arange(nlevel, 0, -1))
+        accept = ms < quantiles[:,None]
+        levels = np.where(accept.any(axis=0), accept.argmax(axis=0), nlevel - 1)
+        error = errors[levels, np.arange(self.size)]
+        sinef = np.zeros(error.shape)
+        mask = errors[0] > 0
+        sinef[mask] = (error[mask]/errors[0][mask])**2
+        return error.reshape(self.shape), sinef.reshape(self.shape)
+
+
+def blocking(signal, minblock=16):
+    """Analyze one or more signals with the blocking method
+
+       **Arguments:**
+
+       signal
+            An array containing time-dependent data. The first index refers to
+            the time step. All other indexes refer to different observables.
+
+       **Optional arguments:**
+
+       minblock
+            The minimum number of blocks at the levels that are considered.
+
+       **Returns:**
+
+       error
+            The error on the average of each observable.
+
+       sinef
+            The statistical inefficiency of each observable.
+
+       See :class:`BlockingAccumulator` for the details.
+    """
+    signal = np.asarray(signal)
+    accumulator = BlockingAccumulator(signal.shape[1:])
+    accumulator.update(signal)
+    return accumulator.get_error(minblock)
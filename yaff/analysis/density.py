@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+# YAFF is yet another force-field code
+# Copyright (C) 2011 - 2013 Toon Verstraelen <Toon.Verstraelen@UGent.be>,
+# Louis Vanduyfhuys <Louis.Vanduyfhuys@UGent.be>, Center for Molecular Modeling
+# (CMM), Ghent University, Ghent, Belgium; all rights reserved unless otherwise
+# stated.
+#
+# This file is part of YAFF.
+#
+# YAFF is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# YAFF is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+'''Volumetric density maps'''
+
+
+import numpy as np
+
+from molmod.constants import boltzmann
+
+from yaff.analysis.hook import AnalysisInput, AnalysisHook
+
+
+__all__ = ['DensityMap']
+
+
+class DensityMap(AnalysisHook):
+    def __init__(self, shape, f=None, start=0, end=-1, max_sample=None,
+                 step=None, select=None, pospath='trajectory/pos', poskey='pos',
+                 cellpath=None, cellkey=None, outpath=None, buffer_size=100,
+                 write_step=100):
+        """Computes the density of a selection of atoms on a grid in the unit cell
+
+           **Argument:**
+
+           shape
+                The number of grid points along each cell vector.
+
+           **Optional arguments:**
+
+           f
+                An h5.File instance containing the trajectory data. If ``f``
+                is not given, or it does not contain the dataset referred to
+                with the ``path`` argument, an on-line analysis is carried out.
+
+           start, end, max_sample, step
+                arguments to setup the selection of time slices. See
+                ``get_slice`` for more information.
+
+           select
+                A list of atom indexes that are considered for the density
+                map, e.g. the atoms of the guest molecules. If not given, all
+                atoms are used.
+
+           pospath
+                The path of the dataset that contains the time dependent data in
+                the HDF5 file. The first axis of the array must be the time
+                axis. This is only needed for an off-line analysis
+
+           poskey
+                In case of an on-line analysis, this is the key of the state
+                item that contains the atomic positions.
+
+           cellpath
+                The path the time-dependent cell vector data. This is only
+                needed when the cell parameters are variable and the analysis is
+                off-line.
+
+           cellkey
+                The key of the stateitem that contains the cell vectors. This
+                is only needed when the cell parameters are variable and the
+                analysis is done on-line.
+
+           outpath
+                The output path for the density map in the HDF5 file. If not
+                given, it defaults to '%s_density' % path. If this path
+                already exists, it will be removed first.
+
+           buffer_size
+                The number of frames that is collected before they are
+                processed in an on-line analysis.
+
+           write_step
+                In an on-line analysis, the results are written every
+                ``write_step`` frames and at the end of the simulation.
+
+           The grid is defined in fractional coordinates, such that it
+           deforms with the cell in case of a variable cell. Grid point
+           (i,j,k) is located at the fractional coordinates (i/shape[0],
+           j/shape[1], k/shape[2]) and counts all atoms that are closer to it
+           than to any other grid point, as in the trilinear interpolation of
+           :class:`yaff.pes.ff.ForcePartGrid`. The histograms of a batch of
+           frames are computed at once with ``np.bincount``. The system must
+           be 3D periodic.
+
+           The number of atoms per grid point and per frame is stored in
+           ``counts``. The number density, i.e. the counts divided by the
+           average volume of one grid cell, is stored in ``density``. Both
+           are also written to the output group.
+        """
+        self.shape = tuple(int(n) for n in shape)
+        if len(self.shape) != 3 or min(self.shape) < 1:
+            raise ValueError('The shape of the grid must consist of three positive integers.')
+        if buffer_size < 1:
+            raise ValueError('The buffer_size must be at least one.')
+        if write_step < 1:
+            raise ValueError('The write_step must be at least one.')
+        self.select = select
+        self.buffer_size = buffer_size
+        self.write_step = write_step
+        self.ngrid = int(np.product(self.shape))
+        self.counts_sum = np.zeros(self.ngrid, float)
+        self.volume_sum = 0.0
+        self.nsample = 0
+        if outpath is None:
+            outpath = pospath + '_density'
+        analysis_inputs = {'pos': AnalysisInput(pospath, poskey), 'cell': AnalysisInput(cellpath, cellkey, False)}
+        AnalysisHook.__init__(self, f, start, end, max_sample, step, analysis_inputs, outpath, False)
+
+    def configure_online(self, iterative, st_pos, st_cell=None):
+        self.natom = iterative.ff.system.natom
+        self._set_rvecs(iterative.ff.system.cell.rvecs)
+
+    def configure_offline(self, ds_pos, ds_cell=None):
+        # In case of a variable cell, the cell vectors are updated for every
+        # frame.
+        if 'rvecs' in self.f['system']:
+            self._set_rvecs(self.f['system/rvecs'][:])
+        else:
+            self._set_rvecs(np.zeros((0, 3), float))
+        self.natom = ds_pos.shape[1]
+
+    def _set_rvecs(self, rvecs):
+        if rvecs.shape != (3, 3):
+            raise ValueError('A density map can only be computed for 3D periodic systems.')
+        self.rvecs = rvecs.copy()
+
+    def init_first(self):
+        if self.select is None:
+            self.nselect = self.natom
+        else:
+            self.nselect = len(self.select)
+        if self.online:
+            self.buffer_pos = np.zeros((self.buffer_size, self.nselect, 3), float)
+            self.buffer_rvecs = np.zeros((self.buffer_size, 3, 3), float)
+            self.nbuffer = 0
+            self.counter = 0
+        AnalysisHook.init_first(self)
+
+    def read_online(self, st_pos, st_cell=None):
+        if st_cell is not None:
+            self.rvecs[:] = st_cell.value
+        if self.select is None:
+            self.pos = st_pos.value
+        else:
+            self.pos = st_pos.value[self.select]
+
+    def compute_iteration(self):
+        self.buffer_pos[self.nbuffer] = self.pos
+        self.buffer_rvecs[self.nbuffer] = self.rvecs
+        self.nbuffer += 1
+        self.counter += 1
+        if self.nbuffer == self.buffer_size:
+            self._flush()
+
+    def compute_batch(self, indexes, ds_pos, ds_cell=None):
+        if self.select is not None:
+            ds_pos = ds_pos[:, self.select]
+        if ds_cell is None:
+            rvecs = np.repeat(self.rvecs.reshape(1, 3, 3), len(indexes), axis=0)
+        else:
+            rvecs = ds_cell
+        self._accumulate(ds_pos, rvecs)
+
+    def _flush(self):
+        '''Process the frames in the buffer of an on-line analysis'''
+        if self.nbuffer > 0:
+            self._accumulate(self.buffer_pos[:self.nbuffer], self.buffer_rvecs[:self.nbuffer])
+            self.nbuffer = 0
+
+    def _accumulate(self, pos, rvecs):
+        '''Add the histograms of a batch of frames'''
+        # Fractional coordinates, with the reciprocal cell vectors as
+        # columns of the inverse of rvecs.
+        frac = np.einsum('nai,nij->naj', pos, np.linalg.inv(rvecs))
+        # Index of the nearest grid point, along each cell vector
+        indexes = np.floor(frac*self.shape + 0.5).astype(int) % self.shape
+        flat = np.ravel_multi_index(indexes.reshape(-1, 3).T, self.shape)
+        self.counts_sum += np.bincount(flat, minlength=self.ngrid)
+        self.volume_sum += abs(np.linalg.det(rvecs)).sum()
+        self.nsample += len(pos)
+
+    def get_accumulators(self):
+        return {
+            'counts_sum': self.counts_sum, 'volume_sum': self.volume_sum,
+            'nsample': self.nsample,
+        }
+
+    def merge_accumulators(self, accumulators):
+        self.counts_sum += accumulators['counts_sum']
+        self.volume_sum += accumulators['volume_sum']
+        self.nsample += accumulators['nsample']
+
+    def compute_derived(self):
+        if self.online:
+            if self.counter % self.write_step != 0:
+                return
+            self._flush()
+        self._compute_results()
+
+    def _compute_results(self):
+        if self.nsample == 0:
+            return
+        self.counts = (self.counts_sum/self.nsample).reshape(self.shape)
+        self.volume = self.volume_sum/self.nsample
+        self.density = self.counts*(self.ngrid/self.volume)
+        if self.outg is not None:
+            for name in 'counts', 'density':
+                if name in self.outg:
+                    self.outg[name][...] = getattr(self, name)
+                else:
+                    self.outg.create_dataset(name, data=getattr(self, name))
+            self.outg.attrs['nsample'] = self.nsample
+            self.outg.attrs['volume'] = self.volume
+
+    def finalize(self, iterative):
+        # Write the results, irrespective of write_step
+        if self.online and not self._first_iteration:
+            self._flush()
+            self._compute_results()
+
+    def get_energy_grid(self, temp, emax=None):
+        '''Return the free energy of the selected atoms on the grid
+
+           **Arguments:**
+
+           temp
+                The temperature of the simulation.
+
+           **Optional arguments:**
+
+           emax
+                The free energy assigned to grid points without any counts.
+                If not given, the largest free energy of the other grid
+                points is used.
+
+           The free energy is -kT ln(rho/<rho>), with rho the density and
+           <rho> its average over the grid. The result can be used as a grid
+           of :class:`yaff.pes.ff.ForcePartGrid`.
+        '''
+        if self.nsample == 0:
+            raise ValueError('No frames were analyzed.')
+        counts = self.counts_sum.reshape(self.shape)
+        mask = counts > 0
+        result = np.zeros(self.shape, float)
+        result[mask] = -boltzmann*temp*np.log(counts[mask]/counts.mean())
+        if emax is None:
+            emax = result[mask].max()
+        result[~mask] = emax
+        return result
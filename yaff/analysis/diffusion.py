@@ -29,6 +29,7 @@ import numpy as np
 from yaff.log import log
 from yaff.analysis.hook import AnalysisInput, AnalysisHook
 from yaff.analysis.blav import blav
+from yaff.pes.ext import Cell
 
 
 __all__ = ['Diffusion']
@@ -36,7 +37,8 @@ __all__ = ['Diffusion']
 
 class Diffusion(AnalysisHook):
     def __init__(self, f=None, start=0, end=-1, step=1, mult=20, select=None,
-                 bsize=None, pospath='trajectory/pos', poskey='pos', outpath=None):
+                 bsize=None, pospath='trajectory/pos', poskey='pos', outpath=None,
+                 fft=False, groups=None, cellpath=None, cellkey=None):
         """Computes mean-squared displacements and diffusion constants
 
            **Optional arguments:**
@@ -54,7 +56,9 @@ class Diffusion(AnalysisHook):
            mult
                 In the first place, the mean square displacement (MSD) between
                 subsequent step is computed. The MSD is also computed between
-                every, two, three, ..., until ``mult`` steps.
+                every, two, three, ..., until ``mult`` steps. With the fft
+                option, mult may be None in an off-line analysis, meaning that
+                all lag times are included.
 
            select
                 A list of atom indexes that are considered for the computation
@@ -81,18 +85,62 @@ class Diffusion(AnalysisHook):
                 to '%s_diff' % path. If this path already exists, it will be
                 removed first.
 
+           fft
+                When True, the MSD's are averaged over all time origins instead
+                of every ``m``-th time origin for a lag of ``m`` steps. They are
+                computed with FFT-based correlation functions in blocks of
+                frames, such that all lag times up to ``mult`` are obtained at
+                a cost that grows only logarithmically with ``mult``. The
+                memory usage is proportional to ``mult``, also in an on-line
+                analysis. The time series of MSD's for the error estimates
+                are not available in this mode.
+
+           groups
+                A list of lists of atom indexes, e.g. one for each element, or
+                one for each atom. A separate MSD is computed for each group,
+                which is stored in the attribute msds_groups. This requires the
+                fft option.
+
+           cellpath
+                The path the time-dependent cell vector data. This is only
+                needed when the cell parameters are variable and the analysis is
+                off-line.
+
+           cellkey
+                The key of the stateitem that contains the cell vectors. This
+                is only needed when the cell parameters are variable and the
+                analysis is on-line.
+
+           In both modes, the positions are unwrapped before the MSD's are
+           computed, i.e. the displacement between two subsequent frames is
+           the shortest one according to the minimum image convention. The
+           cell vectors of the system are used, or those of each frame when
+           cellpath or cellkey is given. An off-line analysis refuses a
+           variable cell in ``trajectory/cell`` when cellpath is not given.
         """
+        if fft:
+            if bsize is not None:
+                raise ValueError('The bsize parameter is not supported with the fft option.')
+        else:
+            if mult is None:
+                raise ValueError('The mult parameter can only be None with the fft option.')
+            if groups is not None:
+                raise ValueError('The groups parameter requires the fft option.')
         if bsize is not None and bsize < mult:
             raise ValueError('The bsize parameter must be larger than mult.')
         self.mult = mult
         self.select = select
         self.bsize = bsize
-        self.msdsums = np.zeros(self.mult, float)
-        self.msdcounters = np.zeros(self.mult, int)
+        self.fft = fft
+        self.groups = groups
         self.counter = 0
+        # Only used in a partition of a parallel analysis
+        self.first_counter = 0
+        self.msd_series = None
         if outpath is None:
             outpath = pospath + '_diff'
-        analysis_inputs = {'pos': AnalysisInput(pospath, poskey)}
+        self.last_pos = None
+        analysis_inputs = {'pos': AnalysisInput(pospath, poskey), 'cell': AnalysisInput(cellpath, cellkey, False)}
         AnalysisHook.__init__(self, f, start, end, None, step, analysis_inputs, outpath, True)
 
     def init_first(self):
@@ -103,57 +151,228 @@ class Diffusion(AnalysisHook):
         self.ndim = 1
         for s in self.shape[1:]:
             self.ndim *= s
+        if self.mult is None:
+            if self.online:
+                raise ValueError('The mult parameter can not be None in an on-line analysis.')
+            self.mult = len(xrange(self.start, self.end, self.step)) - 1
+        self.msdsums = np.zeros(self.mult, float)
+        self.msdcounters = np.zeros(self.mult, int)
         # allocate working arrays
-        self.last_poss = [np.zeros(self.shape, float) for i in xrange(self.mult)]
         self.pos = np.zeros(self.shape, float)
+        if self.fft:
+            self._init_fft()
+        else:
+            self.last_poss = [np.zeros(self.shape, float) for i in xrange(self.mult)]
         # prepare the hdf5 output file, if present.
         AnalysisHook.init_first(self)
         if self.outg is not None:
-            for m in xrange(self.mult):
-                self.outg.create_dataset('msd%03i' % (m+1), shape=(0,), maxshape=(None,), dtype=float)
+            if not self.fft:
+                for m in xrange(self.mult):
+                    self.outg.create_dataset('msd%03i' % (m+1), shape=(0,), maxshape=(None,), dtype=float)
             self.outg.create_dataset('msdsums', data=self.msdsums)
             self.outg.create_dataset('msdcounters', data=self.msdcounters)
             self.outg.create_dataset('pars', shape=(2,), dtype=float)
             self.outg.create_dataset('pars_error', shape=(2,), dtype=float)
 
-    def configure_online(self, iterative, st_pos):
+    def _init_fft(self):
+        # The weights to average the squared displacements of the atoms over
+        # all atoms (first column) and over each group (other columns).
+        natom = self.shape[0]
+        if self.groups is None:
+            self.weights = np.ones((natom, 1), float)/natom
+        else:
+            if self.select is None:
+                index = np.arange(natom)
+            else:
+                index = -np.ones(max(self.select)+1, int)
+                index[self.select] = np.arange(natom)
+            self.weights = np.zeros((natom, 1+len(self.groups)), float)
+            self.weights[:,0] = 1.0/natom
+            for igroup, group in enumerate(self.groups):
+                group = np.asarray(group)
+                if (group >= len(index)).any() or (index[group] < 0).any():
+                    raise ValueError('The groups may only contain selected atoms.')
+                self.weights[index[group],igroup+1] = 1.0/len(group)
+            self.msdsums_groups = np.zeros((len(self.groups), self.mult), float)
+        # The last frames (unwrapped) are kept in a history. The first nold
+        # frames in the history are already processed.
+        self.chunk = max(self.mult, 16)
+        self.history = np.zeros((self.mult + self.chunk, natom, self.ndim), float)
+        self.nhistory = 0
+        self.nold = 0
+        self.origin = None
+
+    def configure_online(self, iterative, st_pos, st_cell=None):
         self.shape = st_pos.shape
+        self.cell = iterative.ff.system.cell
 
-    def configure_offline(self, ds_pos):
+    def configure_offline(self, ds_pos, ds_cell=None):
         self.shape = ds_pos.shape[1:]
+        if 'rvecs' in self.f['system']:
+            self.cell = Cell(self.f['system/rvecs'][:])
+        else:
+            self.cell = Cell(None)
+        if ds_cell is None and self.cell.nvec > 0 and 'trajectory/cell' in self.f:
+            cells = self.f['trajectory/cell'][self.start:self.end:self.step]
+            if not (abs(cells - cells[:1]) <= 1e-10*abs(cells).max()).all():
+                raise ValueError('The cell vectors in trajectory/cell are not constant. Pass cellpath=\'trajectory/cell\' to unwrap the positions with the cell vectors of each frame.')
 
     def init_timestep(self):
         pass
 
-    def read_online(self, st_pos):
-        if self.select is None:
-            self.pos[:] = st_pos.value
-        else:
-            self.pos[:] = st_pos.value[self.select]
+    def read_online(self, st_pos, st_cell=None):
+        pos = st_pos.value
+        if self.select is not None:
+            pos = pos[self.select]
+        rvecs = None
+        if st_cell is not None:
+            rvecs = st_cell.value.reshape((1,) + st_cell.value.shape)
+        self.pos[:] = self._unwrap(pos.reshape((1,) + self.shape), rvecs)[0]
 
-    def read_offline(self, i, ds_pos):
-        if self.select is None:
-            ds_pos.read_direct(self.pos, (i,))
+    def compute_batch(self, indexes, ds_pos, ds_cell=None):
+        if self.select is not None:
+            ds_pos = ds_pos[:, self.select]
+        frames = self._unwrap(ds_pos, ds_cell)
+        if self.fft:
+            self._push(frames)
+            return
+        for frame in frames:
+            self.pos[:] = frame
+            self.compute_iteration()
+
+    def _unwrap(self, frames, rvecs=None):
+        '''Unwrap the displacements between subsequent frames
+
+           **Arguments:**
+
+           frames
+                An array with subsequent (selected) frames.
+
+           **Optional arguments:**
+
+           rvecs
+                An array with the cell vectors of each frame. If not given,
+                the cell vectors of self.cell are used.
+        '''
+        if rvecs is None:
+            if self.cell.nvec == 0:
+                return frames
+            rvecs = self.cell.rvecs
+            gvecs = self.cell.gvecs
+        else:
+            if rvecs.shape[1] == 0:
+                return frames
+            gvecs = np.linalg.pinv(rvecs).transpose(0, 2, 1)
+        if frames.shape[-1] != 3:
+            return frames
+        if self.last_pos is None:
+            self.last_pos = frames[0].copy()
+            self.last_unwrapped = frames[0].copy()
+        deltas = np.diff(np.concatenate([self.last_pos.reshape((1,) + frames.shape[1:]), frames]), axis=0)
+        if rvecs.ndim == 2:
+            deltas -= np.dot(np.round(np.dot(deltas, gvecs.T)), rvecs)
         else:
-            ds_pos.read_direct(self.pos, (i, self.select))
+            # Every displacement with the cell vectors of the final frame
+            frac = np.einsum('n...i,nvi->n...v', deltas, gvecs)
+            deltas -= np.einsum('n...v,nvi->n...i', np.round(frac), rvecs)
+        self.last_pos = frames[-1].copy()
+        frames = self.last_unwrapped + deltas.cumsum(axis=0)
+        self.last_unwrapped = frames[-1].copy()
+        return frames
 
     def compute_iteration(self):
+        if self.fft:
+            self._push(self.pos.reshape((1,) + self.shape))
+            return
         for m in xrange(self.mult):
             if self.counter % (m+1) == 0:
-                if self.counter > 0 and not self.overlap_bsize(m):
+                if self.counter > 0 and self.counter >= self.first_counter and not self.overlap_bsize(m):
                     msd = ((self.pos - self.last_poss[m])**2).mean()*self.ndim
                     self.update_msd(msd, m)
                 self.last_poss[m][:] = self.pos
         self.counter += 1
 
+    def _push(self, frames):
+        '''Add unwrapped frames to the history and process them when full'''
+        frames = frames.reshape(len(frames), self.history.shape[1], -1)
+        # The MSD's are computed relative to the first frame to reduce
+        # rounding errors.
+        if self.origin is None:
+            self.origin = frames[0].copy()
+        frames = frames - self.origin
+        begin = 0
+        while begin < len(frames):
+            end = min(len(frames), begin + len(self.history) - self.nhistory)
+            if self.counter < self.first_counter:
+                end = min(end, begin + self.first_counter - self.counter)
+            self.history[self.nhistory:self.nhistory+end-begin] = frames[begin:end]
+            self.nhistory += end - begin
+            self.counter += end - begin
+            if self.counter <= self.first_counter:
+                # Frames before a partition of a parallel analysis only serve
+                # as history for the first frames in the partition.
+                self._keep_tail()
+            elif self.nhistory == len(self.history):
+                self._flush()
+            begin = end
+
+    def _keep_tail(self):
+        ntail = min(self.mult, self.nhistory)
+        self.history[:ntail] = self.history[self.nhistory-ntail:self.nhistory]
+        self.nhistory = ntail
+        self.nold = ntail
+
+    def _flush(self):
+        '''Add the MSD's for the new frames in the history to the sums'''
+        nhistory = self.nhistory
+        nold = self.nold
+        if nhistory == nold:
+            return
+        history = self.history[:nhistory]
+        # Correlation functions of the history with the new frames, averaged
+        # over the atoms and over the groups. The length of the FFT is large
+        # enough to avoid wrap-around effects for lags up to mult.
+        nfft = 2**int(np.ceil(np.log2(nhistory + self.mult)))
+        fts_all = np.fft.rfft(history, nfft, axis=0)
+        fts_new = np.fft.rfft(history[nold:], nfft, axis=0)
+        # Account for the shift of the new frames in the history.
+        fts_new *= np.exp(-2j*np.pi*np.arange(fts_new.shape[0])*nold/nfft).reshape(-1, 1, 1)
+        products = np.dot((fts_all.conj()*fts_new).sum(axis=2), self.weights)
+        cross = np.fft.irfft(products, nfft, axis=0)[1:self.mult+1]
+        # Cumulative sums of the squared norms of the positions
+        sqnorms = np.zeros((nhistory+1, self.weights.shape[1]), float)
+        sqnorms[1:] = np.dot((history**2).sum(axis=2), self.weights).cumsum(axis=0)
+        # The sum of the MSD's over all time origins, for each lag k, with
+        # the final frame (s) among the new frames:
+        #   sum_s |x_s|^2 + |x_{s-k}|^2 - 2 x_s.x_{s-k}
+        lags = np.arange(1, self.mult+1)
+        lows = np.maximum(nold, lags)
+        valid = lows < nhistory
+        lags = lags[valid]
+        lows = lows[valid]
+        sums = (
+            sqnorms[nhistory] - sqnorms[lows]
+            + sqnorms[nhistory - lags] - sqnorms[lows - lags]
+            - 2*cross[valid]
+        )
+        self.msdsums[valid] += sums[:,0]
+        self.msdcounters[valid] += nhistory - lows
+        if self.groups is not None:
+            self.msdsums_groups[:,valid] += sums[:,1:].T
+        self._keep_tail()
+
     def compute_derived(self):
+        if self.fft and not self.online:
+            self._flush()
         positive = (self.msdcounters > 0).nonzero()[0]
         if len(positive) > 0:
             self.msds = self.msdsums[positive]/self.msdcounters[positive]
             self.time = np.arange(1, self.mult+1)[positive]*self.timestep
+            if self.groups is not None:
+                self.msds_groups = self.msdsums_groups[:,positive]/self.msdcounters[positive]
             # make error estimates for A and B, first compute error
             # estimates for the msds array.
-            if self.outg is None:
+            if self.outg is None or self.fft:
                 self.msds_error = None
             else:
                 self.msds_error = []
@@ -184,6 +403,10 @@ class Diffusion(AnalysisHook):
                     del self.outg['msds']
                 self.outg['time'] = self.time
                 self.outg['msds'] = self.msds
+                if self.groups is not None:
+                    if 'msds_groups' in self.outg:
+                        del self.outg['msds_groups']
+                    self.outg['msds_groups'] = self.msds_groups
                 self.outg['msdsums'][:] = self.msdsums
                 self.outg['msdcounters'][:] = self.msdcounters
                 self.outg['pars'][0] = self.A
@@ -195,6 +418,45 @@ class Diffusion(AnalysisHook):
                     self.outg['pars_error'][0] = self.A_error
                     self.outg['pars_error'][1] = self.B_error
 
+    def get_partition_overlap(self):
+        return self.mult
+
+    def init_partition(self, warmup, first):
+        self.counter = warmup
+        self.first_counter = first
+        self.msd_series = [[] for m in xrange(self.mult)]
+
+    def get_accumulators(self):
+        result = {
+            'msdsums': self.msdsums, 'msdcounters': self.msdcounters,
+            'msd_series': self.msd_series,
+        }
+        if self.fft:
+            self._flush()
+            if self.groups is not None:
+                result['msdsums_groups'] = self.msdsums_groups
+        return result
+
+    def merge_accumulators(self, accumulators):
+        self.msdsums += accumulators['msdsums']
+        self.msdcounters += accumulators['msdcounters']
+        if self.fft:
+            if self.groups is not None:
+                self.msdsums_groups += accumulators['msdsums_groups']
+        elif self.outg is not None:
+            for m, series in enumerate(accumulators['msd_series']):
+                if len(series) == 0:
+                    continue
+                ds = self.outg['msd%03i' % (m+1)]
+                row = ds.shape[0]
+                ds.resize(row+len(series), axis=0)
+                ds[row:] = series
+
+    def finalize(self, iterative):
+        if self.fft:
+            self._flush()
+            self.compute_derived()
+
     def overlap_bsize(self, m):
         if self.bsize is None:
             return False
@@ -209,6 +471,8 @@ class Diffusion(AnalysisHook):
             row = ds.shape[0]
             ds.resize(row+1, axis=0)
             ds[row] = msd
+        elif self.msd_series is not None:
+            self.msd_series[m].append(msd)
 
     def plot(self, fn_png='msds.png'):
         import matplotlib.pyplot as pt
@@ -24,12 +24,15 @@
 '''Abstract hook implementation for trajectory analysis'''
 
 
+import h5py as h5, multiprocessing, numpy as np, os
+from fractions import gcd
+
 from yaff.log import log
 from yaff.sampling.iterative import Hook
-from yaff.analysis.utils import get_slice
+from yaff.analysis.utils import get_slice, iter_batches
 
 
-__all__ = ['AnalysisInput', 'AnalysisHook']
+__all__ = ['AnalysisInput', 'AnalysisHook', 'AnalysisDriver']
 
 
 
@@ -61,11 +64,34 @@ class AnalysisInput(object):
 
 
 class AnalysisHook(Hook):
+    # When True, an off-line analysis is not carried out in the constructor.
+    # This is only set on instances created by AnalysisDriver.add.
+    _defer_offline = False
+
     def __init__(self, f=None, start=0, end=-1, max_sample=None, step=None,
                  analysis_inputs={}, outpath='trajectory/noname', do_timestep=False):
         """Base class for the analysis hooks.
 
            Analysis hooks in Yaff support both off-line and on-line analysis.
+           Subclasses implement the following methods:
+
+           * ``configure_online(**state_items)`` or
+             ``configure_offline(**datasets)``, followed by ``init_first``,
+             to prepare the data structures.
+           * ``read_online(**state_items)`` to copy the current state of an
+             iterative algorithm into attributes of the analysis.
+           * ``read_batch(j, **batch)`` to copy frame j of a batch of an
+             off-line analysis into the same attributes. The batches contain
+             arrays with consecutive frames, see ``iter_batches``. Older
+             subclasses may implement ``read_offline(i, **datasets)``
+             instead, see ``compute_batch``.
+           * ``compute_iteration()`` to process the frame in these
+             attributes. Off-line analyses may override ``compute_batch`` to
+             process a whole batch at once instead.
+           * ``compute_derived()`` to compute the final results.
+
+           Parallel off-line analyses (see AnalysisDriver) also need
+           ``get_accumulators`` and ``merge_accumulators``.
 
            **Optional arguments:**
 
@@ -88,6 +114,7 @@ class AnalysisHook(Hook):
                 early as possible.
         """
         self.f = f
+        self.fout = f
         self.start, self.end, self.step = get_slice(self.f, start, end, max_sample, step)
         self.analysis_inputs = analysis_inputs
         self.outpath = outpath
@@ -99,10 +126,23 @@ class AnalysisHook(Hook):
                 self.online |= (ai.path is None and ai.required)
                 self.online |= not (ai.path is None or ai.path in self.f)
         if not self.online:
-            self.compute_offline()
+            for ai in self.analysis_inputs.itervalues():
+                if ai.path is not None and ai.path in self.f and 'stride' in self.f[ai.path].attrs:
+                    raise ValueError(
+                        'The dataset %s is written with a stride of %i iterations '
+                        '(see HDF5Writer) and can not be combined with the other '
+                        'trajectory data in an off-line analysis.'
+                        % (ai.path, self.f[ai.path].attrs['stride'])
+                    )
+            if not self._defer_offline:
+                self.compute_offline()
         else:
             self.init_online()
 
+    @property
+    def needs_vtens(self):
+        return any(ai.key in self.vtens_keys for ai in self.analysis_inputs.itervalues())
+
     def __call__(self, iterative):
         # get the requested state items
         state_items = {}
@@ -128,6 +168,12 @@ class AnalysisHook(Hook):
         self.compute_derived()
 
     def compute_offline(self):
+        datasets = self.prepare_offline()
+        self.offline_loop(**datasets)
+        self.compute_derived()
+
+    def prepare_offline(self):
+        '''Configure an off-line analysis and return the input datasets'''
         datasets = {}
         for key, ai in self.analysis_inputs.iteritems():
             if ai.path is not None:
@@ -137,15 +183,14 @@ class AnalysisHook(Hook):
         if self.do_timestep:
             self.timestep = self.f['trajectory/time'][self.start+self.step] - self.f['trajectory/time'][self.start]
             self.init_timestep()
-        self.offline_loop(**datasets)
-        self.compute_derived()
+        return datasets
 
     def init_first(self):
         # create the output group
-        if self.f is not None:
-            if self.outpath in self.f:
-                del self.f[self.outpath]
-            self.outg = self.f.create_group(self.outpath)
+        if self.fout is not None:
+            if self.outpath in self.fout:
+                del self.fout[self.outpath]
+            self.outg = self.fout.create_group(self.outpath)
         else:
             self.outg = None
 
@@ -156,10 +201,38 @@ class AnalysisHook(Hook):
             self.lasttime = None
 
     def offline_loop(self, **datasets):
-        # Iterate over the dataset
-        for i in xrange(self.start, self.end, self.step):
-            self.read_offline(i, **datasets)
-            self.compute_iteration()
+        # Iterate over the dataset in batches, see iter_batches
+        for indexes, batch in iter_batches(datasets, self.start, self.end, self.step):
+            self.compute_batch(indexes, **batch)
+
+    def compute_batch(self, indexes, **batch):
+        '''Process a batch of frames in an off-line analysis
+
+           **Arguments:**
+
+           indexes
+                The indexes of the frames in the batch.
+
+           The keyword arguments have the same names as the datasets and
+           contain arrays with the frames in the batch. By default,
+           read_batch and compute_iteration are called for every frame.
+           Subclasses may override this method with vectorized code.
+
+           Subclasses written for the older frame-by-frame protocol define
+           ``read_offline(i, **datasets)`` instead of read_batch. For these,
+           read_offline and compute_iteration are called for every frame,
+           where i is the index of the frame in the trajectory and the
+           datasets only give access to the frames of the batch.
+        '''
+        if hasattr(self, 'read_offline'):
+            frames = dict((key, _BatchFrames(array, indexes)) for key, array in batch.iteritems())
+            for i in indexes:
+                self.read_offline(i, **frames)
+                self.compute_iteration()
+        else:
+            for j in xrange(len(indexes)):
+                self.read_batch(j, **batch)
+                self.compute_iteration()
 
     def configure_online(self, **state_items):
         pass
@@ -173,7 +246,44 @@ class AnalysisHook(Hook):
     def read_online(self, **state_items):
         raise NotImplementedError
 
-    def read_offline(self, i, **kwargs):
+    def read_batch(self, j, **batch):
+        raise NotImplementedError
+
+    def get_partition_block(self):
+        '''The frames of a partition in a parallel analysis must be a multiple of this number'''
+        return 1
+
+    def get_partition_overlap(self):
+        '''The number of frames before a partition needed to prepare the state of the analysis'''
+        return 0
+
+    def init_partition(self, warmup, first):
+        '''Prepare the analysis for one partition in a parallel analysis
+
+           **Arguments:**
+
+           warmup
+                The index of the first frame to be processed, counting from
+                zero at the first frame of the entire analysis.
+
+           first
+                The index of the first frame of the partition. The frames
+                from warmup to first are only used to prepare the state of
+                the analysis, see get_partition_overlap.
+
+           This is called in the worker process, after prepare_offline.
+        '''
+        pass
+
+    def get_accumulators(self):
+        '''Return a dictionary with the partial results of a partition'''
+        raise NotImplementedError
+
+    def merge_accumulators(self, accumulators):
+        '''Add the partial results of a partition to this analysis
+
+           The partitions are merged in the order of the frames.
+        '''
         raise NotImplementedError
 
     def compute_iteration(self):
@@ -181,3 +291,285 @@ class AnalysisHook(Hook):
 
     def compute_derived(self):
         raise NotImplementedError
+
+
+class _BatchFrames(object):
+    '''Access to the frames in a batch with their index in the trajectory
+
+       This mimics the parts of the h5py.Dataset interface that are used by
+       read_offline methods, i.e. ``ds[i]`` and ``ds.read_direct(dest, (i,
+       ...))``, where i is the index of a frame in the batch.
+    '''
+    def __init__(self, array, indexes):
+        self.array = array
+        self.indexes = indexes
+
+    shape = property(lambda self: self.array.shape)
+    dtype = property(lambda self: self.array.dtype)
+
+    def _get_local(self, sel):
+        if not isinstance(sel, tuple):
+            sel = (sel,)
+        j = np.searchsorted(self.indexes, sel[0])
+        if j == len(self.indexes) or self.indexes[j] != sel[0]:
+            raise IndexError('Frame %s is not in the current batch.' % sel[0])
+        return (j,) + sel[1:]
+
+    def __getitem__(self, sel):
+        return np.array(self.array[self._get_local(sel)])
+
+    def read_direct(self, dest, source_sel=None, dest_sel=None):
+        if dest_sel is None:
+            dest_sel = Ellipsis
+        dest[dest_sel] = self.array[self._get_local(source_sel)]
+
+
+class AnalysisDriver(object):
+    '''Carries out several off-line analyses in a single pass over a trajectory
+
+       Example::
+
+           driver = AnalysisDriver(f)
+           rdf = driver.add(RDF, 4.5*angstrom, 0.1*angstrom, f, select0=select)
+           diff = driver.add(Diffusion, f, select=select)
+           driver.run()
+
+       The frames needed by all analyses are read in batches with
+       iter_batches and each batch is passed to the compute_batch method
+       of every analysis. Analyses that replace the offline_loop method
+       by their own loop read their input separately.
+    '''
+    def __init__(self, f, fout=None, batch_size=None, window=16*1024**2,
+                 readahead=2, nproc=None):
+        """
+           **Arguments:**
+
+           f
+                An h5.File instance (or RawTrajectoryFile) containing the
+                trajectory data.
+
+           **Optional arguments:**
+
+           fout
+                An h5.File instance in which all analyses write their results,
+                each under its own outpath. If not given, the results are
+                written to f.
+
+           batch_size, window, readahead
+                See iter_batches.
+
+           nproc
+                When larger than one, the frames of each analysis are split
+                in nproc contiguous partitions, which are processed by as
+                many forked worker processes. The partial results of the
+                workers are merged with the merge_accumulators method of each
+                analysis. This requires the fork start method of the
+                multiprocessing module, i.e. a Unix-like OS. Each worker
+                opens the HDF5 input file again in read-only mode, so it must
+                be a file on disk.
+        """
+        self.f = f
+        self.fout = fout
+        self.batch_size = batch_size
+        self.window = window
+        self.readahead = readahead
+        self.nproc = nproc
+        self.hooks = []
+
+    def add(self, cls, *args, **kwargs):
+        '''Create an off-line analysis that will be carried out by run
+
+           **Arguments:**
+
+           cls
+                A subclass of AnalysisHook.
+
+           All other arguments are passed on to the constructor of cls. The
+           analysis must read its input from the same file as the driver.
+           Returns the analysis object, whose results are available after
+           calling run.
+        '''
+        if not issubclass(cls, AnalysisHook):
+            raise ValueError('%s is not an analysis.' % cls.__name__)
+        # The analysis is marked before its constructor is called, such that
+        # it is configured but not carried out.
+        hook = cls.__new__(cls)
+        hook._defer_offline = True
+        hook.__init__(*args, **kwargs)
+        if hook.online:
+            raise ValueError('The analysis %s is not an off-line analysis.' % cls.__name__)
+        if hook.f is not self.f:
+            raise ValueError('The analysis %s does not read from the same file as the driver.' % cls.__name__)
+        if self.fout is not None:
+            hook.fout = self.fout
+        self.hooks.append(hook)
+        return hook
+
+    def run(self):
+        '''Carry out all analyses'''
+        hooks = self.hooks
+        self.hooks = []
+        datasets = [hook.prepare_offline() for hook in hooks]
+        if self.nproc is None or self.nproc <= 1:
+            self._single_pass(hooks, datasets)
+        else:
+            self._parallel(hooks, datasets)
+        for hook in hooks:
+            hook.compute_derived()
+
+    def _single_pass(self, hooks, datasets):
+        batch_hooks = []
+        paths = {}
+        for hook, hook_datasets in zip(hooks, datasets):
+            if type(hook).offline_loop.im_func is not AnalysisHook.offline_loop.im_func:
+                hook.offline_loop(**hook_datasets)
+                continue
+            batch_hooks.append(hook)
+            for key, ai in hook.analysis_inputs.iteritems():
+                if ai.path is not None:
+                    paths[ai.path] = hook_datasets['ds_' + key]
+        if len(batch_hooks) == 0:
+            return
+        # The frames of all analyses are a subset of the frames in the range
+        # [start, end) with a spacing step.
+        start = min(hook.start for hook in batch_hooks)
+        end = max(hook.end for hook in batch_hooks)
+        step = 0
+        for hook in batch_hooks:
+            step = gcd(gcd(step, hook.step), hook.start - start)
+        if log.do_medium:
+            log('Single pass over frames %i to %i with step %i for %i analyses.' % (start, end, step, len(batch_hooks)))
+        for indexes, batch in iter_batches(paths, start, end, step, self.batch_size, self.window, self.readahead):
+            for hook in batch_hooks:
+                mask = (indexes >= hook.start) & (indexes < hook.end) & ((indexes - hook.start) % hook.step == 0)
+                if not mask.any():
+                    continue
+                hook_batch = {}
+                for key, ai in hook.analysis_inputs.iteritems():
+                    if ai.path is not None:
+                        hook_batch['ds_' + key] = batch[ai.path][mask]
+                hook.compute_batch(indexes[mask], **hook_batch)
+
+    def _get_partitions(self, hook):
+        # Split the frames of one analysis in nproc contiguous parts, with
+        # boundaries at multiples of the partition block. Each partition is
+        # a tuple (warmup, first, last), see AnalysisHook.init_partition.
+        nframe = len(xrange(hook.start, hook.end, hook.step))
+        block = hook.get_partition_block()
+        nblock = nframe/block
+        bounds = [(nblock*ipart/self.nproc)*block for ipart in xrange(self.nproc)] + [nframe]
+        overlap = hook.get_partition_overlap()
+        return [
+            (max(0, bounds[ipart] - overlap), bounds[ipart], bounds[ipart+1])
+            for ipart in xrange(self.nproc)
+        ]
+
+    def _parallel(self, hooks, datasets):
+        for hook in hooks:
+            if type(hook).get_accumulators.im_func is AnalysisHook.get_accumulators.im_func:
+                raise ValueError('The analysis %s does not support parallel execution.' % hook.__class__.__name__)
+        partitions = [self._get_partitions(hook) for hook in hooks]
+        # The workers are forked and inherit the prepared analyses. Make sure
+        # that the HDF5 files are up to date on disk, such that each worker
+        # can open them again.
+        for f in self.f, self.fout:
+            if hasattr(f, 'flush'):
+                f.flush()
+        sources = [
+            dict((key, _get_source(ds)) for key, ds in hook_datasets.iteritems())
+            for hook_datasets in datasets
+        ]
+        # The work is passed to each worker when it starts, see
+        # _init_worker. The workers only receive the partition index.
+        pool = multiprocessing.Pool(self.nproc, _init_worker, (self, hooks, sources, partitions))
+        try:
+            results = pool.map(_run_partition, xrange(self.nproc))
+        finally:
+            pool.close()
+            pool.join()
+        # Merge the partial results in the original order of the frames.
+        for result in results:
+            for ihook, accumulators in result:
+                hooks[ihook].merge_accumulators(accumulators)
+
+
+# The work of a worker process of AnalysisDriver._parallel, set by _init_worker
+_worker_work = None
+
+
+def _init_worker(driver, hooks, sources, partitions):
+    '''Store the work of AnalysisDriver._parallel in a worker process'''
+    global _worker_work
+    _worker_work = (driver, hooks, sources, partitions)
+
+
+def _get_source(ds):
+    # HDF5 files can not be shared with forked processes. Instead, the
+    # workers open the file again, given its filename and the path of the
+    # dataset. Other datasets, e.g. memory-mapped RawDatasets, are shared.
+    if not isinstance(ds, h5.Dataset):
+        return ds
+    fn = ds.file.filename
+    if not os.path.isfile(fn):
+        raise ValueError('The parallel analysis of %s requires an HDF5 file on disk.' % ds.name)
+    return fn, ds.name
+
+
+def _open_readonly(fn):
+    '''Open an HDF5 file in a worker process, independently of the parent
+
+       The forked process inherits the state of the HDF5 library, including
+       the files opened by the parent. When the same file is opened again
+       with the default driver, HDF5 recognizes it and shares the inherited
+       file handle and caches. A different driver gives an independent
+       handle. File locking is disabled while the file is opened, because
+       the parent may still hold the file open in write mode. It does not
+       write while the workers read. The environment is restored afterwards.
+    '''
+    old = os.environ.get('HDF5_USE_FILE_LOCKING')
+    os.environ['HDF5_USE_FILE_LOCKING'] = 'FALSE'
+    try:
+        return h5.File(fn, 'r', driver='stdio')
+    finally:
+        if old is None:
+            del os.environ['HDF5_USE_FILE_LOCKING']
+        else:
+            os.environ['HDF5_USE_FILE_LOCKING'] = old
+
+
+def _run_partition(ipart):
+    driver, hooks, sources, partitions = _worker_work
+    files = {}
+    try:
+        datasets = []
+        for hook_sources in sources:
+            hook_datasets = {}
+            for key, source in hook_sources.iteritems():
+                if isinstance(source, tuple):
+                    fn, path = source
+                    if fn not in files:
+                        files[fn] = _open_readonly(fn)
+                    source = files[fn][path]
+                hook_datasets[key] = source
+            datasets.append(hook_datasets)
+        return _run_partition_datasets(ipart, driver, hooks, datasets, partitions)
+    finally:
+        for f in files.itervalues():
+            f.close()
+
+
+def _run_partition_datasets(ipart, driver, hooks, datasets, partitions):
+    todo = []
+    for ihook, hook in enumerate(hooks):
+        warmup, first, last = partitions[ihook][ipart]
+        if first == last:
+            continue
+        # The results are only written by the main process.
+        hook.outg = None
+        if ipart < driver.nproc - 1:
+            hook.end = hook.start + last*hook.step
+        hook.start += warmup*hook.step
+        hook.init_partition(warmup, first)
+        todo.append(ihook)
+    driver._single_pass([hooks[ihook] for ihook in todo], [datasets[ihook] for ihook in todo])
+    return [(ihook, hooks[ihook].get_accumulators()) for ihook in todo]
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+# YAFF is yet another force-field code
+# Copyright (C) 2011 - 2013 Toon Verstraelen <Toon.Verstraelen@UGent.be>,
+# Louis Vanduyfhuys <Louis.Vanduyfhuys@UGent.be>, Center for Molecular Modeling
+# (CMM), Ghent University, Ghent, Belgium; all rights reserved unless otherwise
+# stated.
+#
+# This file is part of YAFF.
+#
+# YAFF is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# YAFF is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+'''Time series of internal coordinates'''
+
+
+import numpy as np
+
+from yaff.analysis.hook import AnalysisInput, AnalysisHook
+from yaff.pes.dlist import DeltaList
+from yaff.pes.iclist import InternalCoordinateList
+from yaff.system import System
+
+
+__all__ = ['InternalCoordinateSeries']
+
+
+class InternalCoordinateSeries(AnalysisHook):
+    def __init__(self, ics, f=None, start=0, end=-1, max_sample=None, step=None,
+                 pospath='trajectory/pos', poskey='pos', cellpath=None,
+                 cellkey=None, outpath=None):
+        """Computes the time series of a list of internal coordinates
+
+           **Argument:**
+
+           ics
+                A list of InternalCoordinate instances, e.g. Bond, BendAngle,
+                DihedAngle, OopDist, ... (See :mod:`yaff.pes.iclist`.)
+
+           **Optional arguments:**
+
+           f
+                An h5.File instance containing the trajectory data. If ``f``
+                is not given, or it does not contain the dataset referred to
+                with the ``path`` argument, an on-line analysis is carried out.
+
+           start, end, max_sample, step
+                arguments to setup the selection of time slices. See
+                ``get_slice`` for more information.
+
+           pospath
+                The path of the dataset that contains the time dependent data in
+                the HDF5 file. The first axis of the array must be the time
+                axis. This is only needed for an off-line analysis
+
+           poskey
+                In case of an on-line analysis, this is the key of the state
+                item that contains the atomic positions.
+
+           cellpath
+                The path the time-dependent cell vector data. This is only
+                needed when the cell parameters are variable and the analysis is
+                off-line.
+
+           cellkey
+                The key of the stateitem that contains the cell vectors. This
+                is only needed when the cell parameters are variable and the
+                analysis is done on-line.
+
+           outpath
+                The output path for the internal coordinates in the HDF5 file.
+                If not given, it defaults to '%s_ic' % path. If this path
+                already exists, it will be removed first.
+
+           The internal coordinates are evaluated with the same low-level
+           routines as the covalent energy terms of a force field, see
+           :class:`yaff.pes.dlist.DeltaList` and
+           :class:`yaff.pes.iclist.InternalCoordinateList`. Hence, the minimum
+           image convention is taken into account. The relative vectors that
+           are shared by several internal coordinates are computed only once.
+
+           The time series are stored in the ``values`` attribute and in the
+           dataset ``values`` in the output group, with one column per
+           internal coordinate. The dataset ``labels`` describes the columns.
+        """
+        if len(ics) == 0:
+            raise ValueError('At least one internal coordinate must be given.')
+        self.ics = ics
+        if outpath is None:
+            outpath = pospath + '_ic'
+        analysis_inputs = {'pos': AnalysisInput(pospath, poskey), 'cell': AnalysisInput(cellpath, cellkey, False)}
+        AnalysisHook.__init__(self, f, start, end, max_sample, step, analysis_inputs, outpath, False)
+
+    def configure_online(self, iterative, st_pos, st_cell=None):
+        system = iterative.ff.system
+        self._init_system(system.numbers, system.cell.rvecs)
+
+    def configure_offline(self, ds_pos, ds_cell=None):
+        # In case of a variable cell, the cell vectors are updated for every
+        # frame.
+        if 'rvecs' in self.f['system']:
+            rvecs = self.f['system/rvecs'][:]
+        else:
+            rvecs = None
+        self._init_system(self.f['system/numbers'][:], rvecs)
+
+    def _init_system(self, numbers, rvecs):
+        # The delta list works on a private copy of the system, whose
+        # positions are overwritten by every frame.
+        self.system = System(numbers, np.zeros((len(numbers), 3), float), rvecs=rvecs)
+        self.dlist = DeltaList(self.system)
+        self.iclist = InternalCoordinateList(self.dlist)
+        self.rows = np.array([self.iclist.add_ic(ic) for ic in self.ics])
+
+    def init_first(self):
+        self.nframe = 0
+        self._values = np.zeros((16, len(self.ics)), float)
+        AnalysisHook.init_first(self)
+        if self.outg is not None:
+            self.outg.create_dataset('values', (0, len(self.ics)), float, maxshape=(None, len(self.ics)))
+            self.outg['labels'] = np.array([ic.get_log() for ic in self.ics])
+
+    def read_online(self, st_pos, st_cell=None):
+        if st_cell is not None:
+            self.system.cell.update_rvecs(st_cell.value)
+        self.system.pos[:] = st_pos.value
+
+    def compute_iteration(self):
+        self._append(self._compute_values().reshape(1, -1))
+
+    def compute_batch(self, indexes, ds_pos, ds_cell=None):
+        values = np.zeros((len(indexes), len(self.ics)), float)
+        for j in xrange(len(indexes)):
+            if ds_cell is not None:
+                self.system.cell.update_rvecs(ds_cell[j])
+            self.system.pos[:] = ds_pos[j]
+            values[j] = self._compute_values()
+        self._append(values)
+
+    def _compute_values(self):
+        '''Evaluate the internal coordinates for the current positions'''
+        self.dlist.forward()
+        self.iclist.forward()
+        return self.iclist.ictab['value'][self.rows]
+
+    def _append(self, values):
+        '''Add rows to the time series'''
+        nframe = self.nframe + len(values)
+        if nframe > len(self._values):
+            self._values = np.resize(self._values, (max(nframe, 2*len(self._values)), len(self.ics)))
+        self._values[self.nframe:nframe] = values
+        self.nframe = nframe
+        if self.outg is not None:
+            ds = self.outg['values']
+            row = ds.shape[0]
+            ds.resize(row+len(values), axis=0)
+            ds[row:] = values
+
+    def get_accumulators(self):
+        return {'values': self._values[:self.nframe]}
+
+    def merge_accumulators(self, accumulators):
+        self._append(accumulators['values'])
+
+    def compute_derived(self):
+        self.values = self._values[:self.nframe]
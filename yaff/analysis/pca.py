@@ -26,20 +26,88 @@
 import h5py as h5
 import numpy as np
 import scipy.linalg as spla
-import matplotlib.pyplot as pt
 from molmod.units import *
 from molmod.constants import boltzmann
 from scipy import random
 from molmod.io.xyz import XYZWriter
 from molmod.periodic import periodic as pd
 from yaff.log import log
+from yaff.analysis.utils import iter_batches
 
 __all__ = [
-    'calc_cov_mat_internal', 'calc_cov_mat', 'calc_pca', 'pca_projection',
-    'write_principal_mode', 'pca_similarity', 'pca_convergence'
+    'CovarianceAccumulator', 'calc_cov_mat_internal', 'calc_cov_mat',
+    'calc_pca', 'pca_projection', 'write_principal_mode', 'pca_similarity',
+    'pca_convergence'
 ]
 
 
+class CovarianceAccumulator(object):
+    '''Builds up a covariance matrix from chunks of samples
+
+       The memory usage is proportional to the size of the covariance matrix
+       and the size of one chunk, not to the total number of samples.
+    '''
+    def __init__(self, size, q_ref=None):
+        """
+           **Arguments:**
+
+           size
+                The number of components of each sample.
+
+           **Optional arguments:**
+
+           q_ref
+                Reference vector of size N. If not provided, the average of
+                all samples is used as reference.
+        """
+        self.size = size
+        self.q_ref = q_ref
+        self.nsample = 0
+        self.mean = np.zeros(size, float)
+        # Sum of outer products of the deviations from the mean (or q_ref)
+        self.m2 = np.zeros((size, size), float)
+
+    def update(self, q):
+        '''Add a chunk of samples, one sample per row of q'''
+        q = np.asarray(q, float).reshape(-1, self.size)
+        if len(q) == 0:
+            return
+        if self.q_ref is not None:
+            delta = q - self.q_ref
+            self.m2 += np.dot(delta.T, delta)
+            self.mean += (q.sum(axis=0) - len(q)*self.mean)/(self.nsample + len(q))
+            self.nsample += len(q)
+        else:
+            mean = q.mean(axis=0)
+            delta = q - mean
+            self._merge(len(q), mean, np.dot(delta.T, delta))
+
+    def merge(self, other):
+        '''Add the samples of another CovarianceAccumulator'''
+        if self.q_ref is not None:
+            raise NotImplementedError('Merging is only supported without q_ref.')
+        self._merge(other.nsample, other.mean, other.m2)
+
+    def _merge(self, nsample, mean, m2):
+        # Pairwise update of Chan et al., which is numerically stable.
+        ntotal = self.nsample + nsample
+        if ntotal == 0:
+            return
+        delta = mean - self.mean
+        self.m2 += m2 + np.outer(delta, delta)*(self.nsample*float(nsample)/ntotal)
+        self.mean += delta*(float(nsample)/ntotal)
+        self.nsample = ntotal
+
+    def get_cov_mat(self):
+        '''Return the covariance matrix and the reference vector'''
+        if self.nsample == 0:
+            raise ValueError('No samples were added.')
+        if self.q_ref is None:
+            return self.m2/self.nsample, self.mean.copy()
+        else:
+            return self.m2/self.nsample, self.q_ref
+
+
 def calc_cov_mat_internal(q, q_ref=None):
     """
         Calculates the covariance matrix of a time-dependent matrix q,
@@ -62,9 +130,10 @@ def calc_cov_mat_internal(q, q_ref=None):
         q_ref = q.mean(axis=0)
 
     # Calculation of the covariance matrix
-    return np.einsum('ij,ik->ijk',q-q_ref, q-q_ref).mean(axis=0), q_ref
+    delta = q - q_ref
+    return np.dot(delta.T, delta)/len(q), q_ref
 
-def calc_cov_mat(f, q_ref=None, start=0, end=None, step=1, select=None, path='trajectory/pos', mw=True):
+def calc_cov_mat(f, q_ref=None, start=0, end=None, step=1, select=None, path='trajectory/pos', mw=True, batch_size=None):
     """
         Calculates the covariance matrix of the given trajectory.
 
@@ -103,30 +172,59 @@ def calc_cov_mat(f, q_ref=None, start=0, end=None, step=1, select=None, path='tr
 
         mw
             If mw is True, the covariance matrix is mass-weighted.
-    """
 
-    # Load in the relevant data
-    q = f[path][start:end:step,:,:]
-    # Select the given atoms
-    if select is not None:
-        q = q[:,select,:]
-    # Reshape such that all Cartesian coordinates are treated equally
-    q = q.reshape(q.shape[0],-1)
+        batch_size
+            The number of frames that are read at once, see iter_batches.
 
-    # If necessary, weight with the mass
+        The trajectory is read in batches, such that the memory usage is
+        proportional to the size of the covariance matrix.
+    """
+    ds = f[path]
+    start, end, step = slice(start, end, step).indices(ds.shape[0])
+    # The factors for the mass-weighting
     if mw:
         # Select the necessary masses
-        masses = f['system/masses']
+        masses = f['system/masses'][:]
         if select is not None:
             masses = masses[select]
         # Repeat d times, with d the dimension
-        masses = np.repeat(masses,3)
-        # Reweight with the masses
-        q *= np.sqrt(masses)
+        weights = np.sqrt(np.repeat(masses,3))
+    natom = ds.shape[1] if select is None else len(select)
+    accumulator = CovarianceAccumulator(natom*3, q_ref)
+    for indexes, batch in iter_batches({'q': ds}, start, end, step, batch_size):
+        q = batch['q']
+        # Select the given atoms
+        if select is not None:
+            q = q[:,select,:]
+        # Reshape such that all Cartesian coordinates are treated equally
+        q = q.reshape(q.shape[0],-1)
+        # If necessary, weight with the mass
+        if mw:
+            q = q*weights
+        accumulator.update(q)
     # Return the covariance matrix
-    return calc_cov_mat_internal(q, q_ref)
-
-def calc_pca(f_target, cov_mat=None, f=None, q_ref=None, start=0, end=None, step=1, select=None, path='trajectory/pos', mw=True, temp=None):
+    return accumulator.get_cov_mat()
+
+def _randomized_eigh(mat, nmode, noversample=10, niter=4, seed=1):
+    '''Approximate the eigenpairs of a symmetric matrix with the largest eigenvalues
+
+       This is a randomized subspace iteration (Halko, Martinsson and Tropp,
+       SIAM Review 53, 217 (2011)). The eigenvalues are in decreasing order.
+       The random starting basis is drawn from ``seed``, which is either an
+       integer seed or a ``np.random.RandomState`` instance.
+    '''
+    if not isinstance(seed, np.random.RandomState):
+        seed = np.random.RandomState(seed)
+    size = len(mat)
+    nbasis = min(size, nmode + noversample)
+    basis = np.linalg.qr(np.dot(mat, seed.normal(size=(size, nbasis))))[0]
+    for i in xrange(niter):
+        basis = np.linalg.qr(np.dot(mat, basis))[0]
+    eigval, eigvec = np.linalg.eigh(np.dot(basis.T, np.dot(mat, basis)))
+    idx = eigval.argsort()[::-1][:nmode]
+    return eigval[idx], np.dot(basis, eigvec[:,idx])
+
+def calc_pca(f_target, cov_mat=None, f=None, q_ref=None, start=0, end=None, step=1, select=None, path='trajectory/pos', mw=True, temp=None, n_modes=None, seed=1):
     """
         Performs a principle component analysis of the given trajectory.
 
@@ -175,6 +273,18 @@ def calc_pca(f_target, cov_mat=None, f=None, q_ref=None, start=0, end=None, step
 
         temp
             Temperature at which the simulation is carried out, necessary to determine the frequencies
+
+        n_modes
+            When given, only this number of principal modes, with the largest
+            eigenvalues, is computed with a randomized eigensolver. This is
+            much faster for large systems when only a few modes are needed.
+            The reduced covariance matrix and its inverse are then restricted
+            to the subspace of these modes.
+
+        seed
+            An integer seed or a ``np.random.RandomState`` instance for the
+            randomized eigensolver, only used when n_modes is given. The fixed
+            default makes the results reproducible.
     """
     if cov_mat is None:
         if f is None:
@@ -186,12 +296,15 @@ def calc_pca(f_target, cov_mat=None, f=None, q_ref=None, start=0, end=None, step
 
     with log.section('PCA'):
         log('Diagonalizing the covariance matrix')
-        # Eigenvalue decomposition
-        eigval, eigvec = np.linalg.eigh(cov_mat)
-        # Order the eigenvalues in decreasing order
-        idx = eigval.argsort()[::-1]
-        eigval = eigval[idx]
-        eigvec = eigvec[:,idx]
+        if n_modes is None:
+            # Eigenvalue decomposition
+            eigval, eigvec = np.linalg.eigh(cov_mat)
+            # Order the eigenvalues in decreasing order
+            idx = eigval.argsort()[::-1]
+            eigval = eigval[idx]
+            eigvec = eigvec[:,idx]
+        else:
+            eigval, eigvec = _randomized_eigh(cov_mat, n_modes, seed=seed)
 
         # Create output HDF5 file
         g = h5.File(f_target,'w')
@@ -208,8 +321,12 @@ def calc_pca(f_target, cov_mat=None, f=None, q_ref=None, start=0, end=None, step
         log('Determining inverse of the covariance matrix')
         # Process matrix to determine inverse
         # First, project out the three zero eigenvalues (translations)
-        eigvec_reduced = eigvec[:,:-3]
-        eigval_reduced = eigval[:-3]
+        if n_modes is None:
+            eigvec_reduced = eigvec[:,:-3]
+            eigval_reduced = eigval[:-3]
+        else:
+            eigvec_reduced = eigvec
+            eigval_reduced = eigval
 
         # Second, calculate the reduced covariance matrix and its inverse
         cov_mat_reduced = np.dot(np.dot(eigvec_reduced, np.diag(eigval_reduced)), eigvec_reduced.T)
@@ -221,7 +338,9 @@ def calc_pca(f_target, cov_mat=None, f=None, q_ref=None, start=0, end=None, step
         # (the zero frequencies are mentioned last so that their index corresponds to the principal modes)
         if temp is not None:
             log('Determining frequencies')
-            frequencies = np.append(np.sqrt(boltzmann*temp/eigval_reduced)/(2*np.pi), np.repeat(0,3))
+            frequencies = np.sqrt(boltzmann*temp/eigval_reduced)/(2*np.pi)
+            if n_modes is None:
+                frequencies = np.append(frequencies, np.repeat(0,3))
             pca.create_dataset('freqs', data=frequencies)
 
     return eigval, eigvec
@@ -401,7 +520,94 @@ def pca_similarity(covar_a, covar_b):
     # Return the PCA similarity (1 - PCA distance)
     return 1 - np.sqrt(np.trace(np.dot(a_sq-b_sq, a_sq-b_sq))/(np.trace(covar_a+covar_b)))
 
-def pca_convergence(f, eq_time=0*picosecond, n_parts=None, step=1, fn='PCA_convergence', n_bootstrap=50, mw=True):
+def _sqrtm_psd(mat):
+    '''The square root of a symmetric positive semi-definite matrix'''
+    eigval, eigvec = np.linalg.eigh(mat)
+    return np.dot(eigvec*np.sqrt(np.clip(eigval, 0, None)), eigvec.T)
+
+def _get_deviations(q, weights):
+    '''Return a matrix d such that np.dot(d.T, d) is the weighted covariance of q'''
+    nsample = float(weights.sum())
+    mean = np.dot(weights, q)/nsample
+    return (q - mean)*np.sqrt(weights/nsample).reshape(-1, 1)
+
+def _calc_similarity(q, weights, sqrt_ref, trace_ref):
+    '''The PCA similarity of the covariance matrix of some samples with a reference
+
+       **Arguments:**
+
+       q
+            The distinct samples in its rows.
+
+       weights
+            The number of times each sample occurs.
+
+       sqrt_ref, trace_ref
+            The square root and the trace of the reference covariance matrix.
+
+       This gives the same result as pca_similarity, using the symmetry of the
+       matrices. When there are fewer samples than components, the square root
+       of the covariance matrix is derived from the smaller Gram matrix.
+    '''
+    d = _get_deviations(q, weights)
+    trace = (d**2).sum()
+    if len(d) < d.shape[1]:
+        eigval, eigvec = np.linalg.eigh(np.dot(d, d.T))
+        mask = eigval > eigval.max()*1e-12
+        x = np.dot(eigvec[:,mask].T, d)
+        cross = ((np.dot(x, sqrt_ref)*x).sum(axis=1)/np.sqrt(eigval[mask])).sum()
+    else:
+        cross = (_sqrtm_psd(np.dot(d.T, d))*sqrt_ref).sum()
+    return 1 - np.sqrt(max(0.0, trace + trace_ref - 2*cross)/(trace + trace_ref))
+
+def _calc_similarities(q, n_parts, draws=None):
+    '''Average similarity of the blocks of a (bootstrapped) trajectory with the whole
+
+       **Arguments:**
+
+       q
+            The samples in its rows.
+
+       n_parts
+            The numbers of blocks in which the trajectory is divided.
+
+       **Optional arguments:**
+
+       draws
+            The indexes of the samples in a bootstrapped trajectory. If not
+            given, the original trajectory is used.
+    '''
+    if draws is None:
+        draws = np.arange(len(q))
+    def get_samples(indexes):
+        indexes, counts = np.unique(indexes, return_counts=True)
+        return q[indexes], counts.astype(float)
+    q_total, weights_total = get_samples(draws)
+    d = _get_deviations(q_total, weights_total)
+    cov_total = np.dot(d.T, d)
+    sqrt_total = _sqrtm_psd(cov_total)
+    trace_total = np.trace(cov_total)
+    result = np.zeros(len(n_parts))
+    for j in xrange(len(n_parts)):
+        block_size = len(draws)/n_parts[j]
+        for i in xrange(n_parts[j]):
+            q_block, weights_block = get_samples(draws[i*block_size:(i+1)*block_size])
+            result[j] += _calc_similarity(q_block, weights_block, sqrt_total, trace_total)
+        result[j] /= n_parts[j]
+    return result
+
+# The work of a worker process of pca_convergence, set by _init_bootstrap_worker
+_bootstrap_work = None
+
+def _init_bootstrap_worker(q, n_parts, draws):
+    global _bootstrap_work
+    _bootstrap_work = (q, n_parts, draws)
+
+def _calc_bootstrap_similarities(k):
+    q, n_parts, draws = _bootstrap_work
+    return _calc_similarities(q, n_parts, draws[k])
+
+def pca_convergence(f, eq_time=0*picosecond, n_parts=None, step=1, fn='PCA_convergence', n_bootstrap=50, mw=True, nproc=None):
     """
     Calculates the convergence of the simulation by calculating the pca
     similarity for different subsets of the simulation.
@@ -431,94 +637,74 @@ def pca_convergence(f, eq_time=0*picosecond, n_parts=None, step=1, fn='PCA_conve
 
     mw
         If mass_weighted is True, the covariance matrix is mass-weighted.
+
+    nproc
+        When larger than one, the bootstrapped trajectories are processed by
+        this number of forked worker processes.
+
+    The blocks are formed by the frames after the equilibration, taking
+    into account the step argument. A bootstrapped trajectory has the same
+    number of frames, drawn with replacement. The covariance matrices of
+    all blocks are derived from the (distinct) frames in the block and the
+    number of times they occur, without ever constructing per-frame outer
+    products. Besides the positions of the production run, only one
+    covariance matrix per process is kept in memory at a time, irrespective
+    of the number of blocks.
     """
 
     # Configure n_parts, the array containing the number of parts in which the total simulation is divided
     if n_parts is None:
         n_parts = np.array([1,3,10,30,100,300])
+    n_parts = np.asarray(n_parts)
 
     # Read in the timestep and the number of atoms
     time = f['trajectory/time']
     timestep = time[1] - time[0]
-    time_length = len(time)
 
     # Determine the equilibration size
     eq_size = int(eq_time/timestep)
 
-    ### ---PART A: SIMILARITY OF THE TRUE TRAJECTORY--- ###
-
-    # Calculate the covariance matrix of the whole production run as golden standard
-    covar_total, q_ref = calc_cov_mat(f, start=eq_size, step=step, mw=mw)
-
-    # Initialize the average similarity vector of the divided trajectories
-    sim_block = np.zeros(len(n_parts))
-    # Calculate this average similarity vector
-    for j in xrange(len(n_parts)):
-        # Determine in how many parts the trajectory should be divided and the corresponding block size
-        n_part = n_parts[j]
-        block_size = (time_length-eq_size)/n_part
-        # Calculate the n_part covariance matrices and compare with the total covariance matrix
-        tot_sim_block=0
-        for i in xrange(n_part):
-            start = eq_size + i*block_size
-            covars, tmp = calc_cov_mat(f, start=start, end=start+block_size+1, step=step, mw=mw)
-            tot_sim_block += pca_similarity(covars, covar_total)
-        # Determine the average similarity
-        sim_block[j] = tot_sim_block/n_part
-
-
-    ### ---PART B: SIMILARITY OF BOOTSTRAPPED TRAJECTORIES --- ###
-
-    # Read in the positions, which will be used to generate bootstrapped trajectories
-    pos = f['trajectory/pos'][eq_size:,:,:]
+    # Read in the positions of the production run
+    pos = f['trajectory/pos'][eq_size::step]
     pos = pos.reshape(pos.shape[0], -1)
-
     if mw:
         # Read in the masses of the atoms, and replicate them d times (d=dimension)
-        masses = f['system/masses']
-        masses = np.repeat(masses,3)
-
-        # Create the mass-weighted positions matrix, on which the bootstrapping will be based
+        masses = np.repeat(f['system/masses'][:],3)
+        # Create the mass-weighted positions matrix
         pos *= np.sqrt(masses)
+    if n_parts.max() > len(pos):
+        raise ValueError('The trajectory has fewer frames than the number of parts.')
 
-    # Initialize the vector containing the average similarity over all the bootstrapped, divided trajectories
-    sim_bt_all = np.zeros(len(n_parts))
+    ### ---PART A: SIMILARITY OF THE TRUE TRAJECTORY--- ###
+
+    # Compare the covariance matrices of the blocks with the covariance
+    # matrix of the whole production run as golden standard
+    sim_block = _calc_similarities(pos, n_parts)
 
-    for k in xrange(n_bootstrap):
+    ### ---PART B: SIMILARITY OF BOOTSTRAPPED TRAJECTORIES --- ###
+
+    if log.do_medium:
         with log.section('PCA'):
-            log('Processing %s of %s bootstrapped trajectories' %(k+1,n_bootstrap))
-            # Create a bootstrapped trajectory bt
-            pos_bt = np.zeros(pos.shape)
-            random_time = random.random(time_length)*time_length
-            for h in np.arange(time_length):
-                pos_bt[h,:] = pos[random_time[h],:]
-
-            # Covariance matrix of the total bootstrapped trajectory
-            covar_bt_total, tmp = calc_cov_mat_internal(pos_bt)
-
-            # Initialize the vector containing the average similarity over the different blocks,
-            # for the given bootstrapped trajectory
-            sim_bt = np.zeros(len(n_parts))
-
-            for j in xrange(len(n_parts)):
-                # Calculate the number of blocks, as well as the block size
-                n_part = n_parts[j]
-                block_size = (len(time)-eq_size)/n_part
-                tot_sim_bt = 0
-                # Calculate the total similarity of this number of blocks, for this bootstrapped trajectory
-                for i in xrange(n_part):
-                    start = eq_size + i*block_size
-                    pos_bt_block = pos_bt[start:start+block_size:step]
-                    covars_bt, tmp = calc_cov_mat_internal(pos_bt_block)
-                    tot_sim_bt += pca_similarity(covars_bt, covar_bt_total)
-                # Calculate the average similarity for this number of blocks, for this bootstrapped trajectory
-                sim_bt[j] = tot_sim_bt/n_part
-            sim_bt_all += sim_bt
+            log('Processing %s bootstrapped trajectories' % n_bootstrap)
+    # The bootstrapped trajectories are drawn in advance, such that the result
+    # does not depend on the number of processes.
+    draws = (random.random((n_bootstrap, len(pos)))*len(pos)).astype(int)
+    if nproc is None or nproc <= 1:
+        sims_bt = [_calc_similarities(pos, n_parts, draws[k]) for k in xrange(n_bootstrap)]
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(nproc, _init_bootstrap_worker, (pos, n_parts, draws))
+        try:
+            sims_bt = pool.map(_calc_bootstrap_similarities, xrange(n_bootstrap))
+        finally:
+            pool.close()
+            pool.join()
     # Calculate the average similarity over all bootstrapped trajectories
-    sim_bt_all /= n_bootstrap
+    sim_bt_all = np.mean(sims_bt, axis=0)
 
     ### ---PART C: PROCESSING THE RESULTS --- ###
 
+    import matplotlib.pyplot as pt
     pt.clf()
     pt.semilogx((time[-1]-time[0])/n_parts/picosecond, sim_block/sim_bt_all, 'r-')
     pt.semilogx((time[-1]-time[0])/n_parts/picosecond, sim_block/sim_bt_all, 'rs')
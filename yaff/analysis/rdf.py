@@ -24,10 +24,11 @@
 '''Radial distribution functions'''
 
 
+from itertools import product
+
 import numpy as np
 
 from yaff.log import log
-from yaff.analysis.utils import get_slice
 from yaff.analysis.hook import AnalysisInput, AnalysisHook
 from yaff.pes.ext import Cell
 
@@ -39,7 +40,7 @@ class RDF(AnalysisHook):
     def __init__(self, rcut, rspacing, f=None, start=0, end=-1, max_sample=None,
                  step=None, select0=None, select1=None, pairs_sr=None, nimage=0,
                  pospath='trajectory/pos', poskey='pos', cellpath=None,
-                 cellkey=None, outpath=None):
+                 cellkey=None, outpath=None, partials=None):
         """Computes a radial distribution function (RDF)
 
            **Argument:**
@@ -81,7 +82,9 @@ class RDF(AnalysisHook):
            nimage
                 The number of cell images to consider in the computation of the
                 pair distances. By default, this is zero, meaning that only the
-                minimum image convention is used.
+                minimum image convention is used. (All periodic images closer
+                than rcut are counted, nimage only determines the largest
+                allowed rcut.)
 
            pospath
                 The path of the dataset that contains the time dependent data in
@@ -107,38 +110,43 @@ class RDF(AnalysisHook):
                 If not given, it defaults to '%s_rdf' % path. If this path
                 already exists, it will be removed first.
 
+           partials
+                A list of (select0, select1) tuples, with the same meaning as
+                the select0 and select1 arguments. The corresponding partial
+                RDFs, e.g. for all pairs of elements, are computed in the same
+                pass over the trajectory and are stored in the rdf_partials
+                attribute.
+
+           The pairs of atoms closer than rcut are found with a cell list, such
+           that the cost of the analysis scales linearly with the number of
+           atoms. In an off-line analysis, batches of frames are processed at
+           once.
+
            When f is None, or when the path does not exist in the HDF5 file, the
            class can be used as an on-line analysis hook for the iterative
            algorithms in yaff.sampling package. This means that the RDF
            is built up as the itertive algorithm progresses. The end option is
            ignored and max_sample is not applicable to an on-line analysis.
         """
-        if select0 is not None:
-            if len(select0) != len(set(select0)):
-                raise ValueError('No duplicates are allowed in select0')
-            if len(select0) == 0:
-                raise ValueError('select0 can not be an empty list')
-        if select1 is not None:
-            if len(select1) != len(set(select1)):
-                raise ValueError('No duplicates are allowed in select1')
-            if len(select1) == 0:
-                raise ValueError('select1 can not be an empty list')
-        if select0 is not None and select1 is not None and len(select0) + len(select1) != len(set(select0) | set(select1)):
-            raise ValueError('No overlap is allowed between select0 and select1. If you want to compute and RDF within a set of atoms, omit the select1 argument.')
-        if select0 is None and select1 is not None:
-            raise ValueError('select1 can not be given without select0.')
+        _check_selects(select0, select1)
+        if partials is not None:
+            for partial_select0, partial_select1 in partials:
+                _check_selects(partial_select0, partial_select1)
         self.rcut = rcut
         self.rspacing = rspacing
         self.select0 = select0
         self.select1 = select1
         self.pairs_sr = self._process_pairs_sr(pairs_sr)
         self.nimage = nimage
+        self.partials = partials
         self.nbin = int(self.rcut/self.rspacing)
         self.bins = np.arange(self.nbin+1)*self.rspacing
         self.d = self.bins[:-1] + 0.5*self.rspacing
         self.rdf_sum = np.zeros(self.nbin, float)
         if self.pairs_sr is not None:
             self.rdf_sum_sr = np.zeros(self.nbin, float)
+        if self.partials is not None:
+            self.rdf_sum_partials = np.zeros((len(self.partials), self.nbin), float)
         self.nsample = 0
         if outpath is None:
             outpath = pospath + '_rdf'
@@ -206,72 +214,148 @@ class RDF(AnalysisHook):
 
     def init_first(self):
         '''Setup some work arrays'''
-        # determine the number of atoms
-        if self.select0 is None:
-            self.natom0 = self.natom
+        # All atoms that take part in one of the RDFs. The pair search is
+        # carried out once for all of them.
+        selects = [(self.select0, self.select1)]
+        if self.partials is not None:
+            selects.extend(self.partials)
+        if any(select0 is None for select0, select1 in selects):
+            self.select = None
+            natom = self.natom
         else:
-            self.natom0 = len(self.select0)
-        self.pos0 = np.zeros((self.natom0, 3), float)
-        # the number of pairs
-        if self.select1 is None:
-            self.npair = (self.natom0*(self.natom0-1))/2
-            self.pos1 = None
-        else:
-            self.natom1 = len(self.select1)
-            self.pos1 = np.zeros((self.natom1, 3), float)
-            self.npair = self.natom0*self.natom1
-        # multiply the number of pairs by all images
-        self.npair *= (1 + 2*self.nimage)**3
+            self.select = np.unique(np.concatenate([
+                np.concatenate([select0, [] if select1 is None else select1])
+                for select0, select1 in selects
+            ]).astype(int))
+            natom = len(self.select)
+        self.pos = np.zeros((natom, 3), float)
+        # A mask for each RDF, selecting atoms in self.pos, and the number of
+        # pairs in the RDF.
+        self.masks = []
+        self.npairs = []
+        for select0, select1 in selects:
+            mask0 = np.zeros(natom, bool)
+            mask0[self._get_indexes(select0, natom)] = True
+            if select1 is None:
+                mask1 = None
+                natom0 = mask0.sum()
+                self.npairs.append((natom0*(natom0-1))/2)
+            else:
+                mask1 = np.zeros(natom, bool)
+                mask1[self._get_indexes(select1, natom)] = True
+                self.npairs.append(mask0.sum()*mask1.sum())
+            self.masks.append((mask0, mask1))
+        self.npair = self.npairs[0]
+        # Indexes of the short-range pairs in self.pos
+        if self.pairs_sr is not None:
+            index0 = self._get_indexes(self.select0, natom)
+            if self.select1 is None:
+                index1 = index0
+            else:
+                index1 = self._get_indexes(self.select1, natom)
+            self.sr0 = index0[self.pairs_sr[:,0]]
+            self.sr1 = index1[self.pairs_sr[:,1]]
         # Prepare the output
-        self.work = np.zeros(self.npair, float)
         AnalysisHook.init_first(self)
         if self.outg is not None:
             self.outg.create_dataset('rdf', (self.nbin,), float)
             self.outg['d'] = self.d
             if self.pairs_sr is not None:
                 self.outg.create_dataset('rdf_sr', (self.nbin,), float)
+            if self.partials is not None:
+                self.outg.create_dataset('rdf_partials', (len(self.partials), self.nbin), float)
+
+    def _get_indexes(self, select, natom):
+        '''Translate atom indexes to indexes in self.pos'''
+        if select is None:
+            return np.arange(natom)
+        elif self.select is None:
+            return np.asarray(select)
+        else:
+            return self.select.searchsorted(select)
 
     def read_online(self, st_pos, st_cell=None):
         if st_cell is not None:
             self._update_rvecs(st_cell.value)
-        if self.select0 is None:
-            self.pos0[:] = st_pos.value
-        else:
-            self.pos0[:] = st_pos.value[self.select0]
-        if self.select1 is not None:
-            self.pos1[:] = st_pos.value[self.select1]
-
-    def read_offline(self, i, ds_pos, ds_cell=None):
-        if ds_cell is not None:
-            self._update_rvecs(np.array(ds_cell[i]))
-        if self.select0 is None:
-            ds_pos.read_direct(self.pos0, (i,))
+        if self.select is None:
+            self.pos[:] = st_pos.value
         else:
-            ds_pos.read_direct(self.pos0, (i,self.select0))
-        if self.select1 is not None:
-            ds_pos.read_direct(self.pos1, (i,self.select1))
+            self.pos[:] = st_pos.value[self.select]
 
     def compute_iteration(self):
-        self.cell.compute_distances(self.work, self.pos0, self.pos1, nimage=self.nimage)
-        counts = np.histogram(self.work, bins=self.bins)[0]
-        normalization = (self.npair/(self.cell.volume*(1+2*self.nimage)**3)*(4*np.pi*self.rspacing))*self.d**2
-        self.rdf_sum += counts/normalization
+        self._accumulate(self.pos.reshape(1, -1, 3), self.cell.rvecs.reshape(1, 3, 3))
+
+    def compute_batch(self, indexes, ds_pos, ds_cell=None):
+        if self.select is not None:
+            ds_pos = ds_pos[:, self.select]
+        if ds_cell is None:
+            rvecs = np.repeat(self.cell.rvecs.reshape(1, 3, 3), len(indexes), axis=0)
+        else:
+            for j in xrange(len(indexes)):
+                self._update_rvecs(ds_cell[j])
+            rvecs = ds_cell
+        self._accumulate(ds_pos, rvecs)
+
+    def _accumulate(self, pos, rvecs):
+        '''Add the histograms of a batch of frames to the RDF sums'''
+        # The histograms are weighted by the volume of the frame.
+        volumes = abs(np.linalg.det(rvecs))
+        counts = np.zeros((len(self.masks), self.nbin), float)
+        for frames, i0, i1, distances in _search_pairs(pos, rvecs, self.bins[-1]):
+            ibins = (distances/self.rspacing).astype(int)
+            mask = ibins < self.nbin
+            frames, i0, i1, ibins = frames[mask], i0[mask], i1[mask], ibins[mask]
+            weights = volumes[frames]
+            for irdf, (mask0, mask1) in enumerate(self.masks):
+                if mask1 is None:
+                    mask = mask0[i0] & mask0[i1]
+                else:
+                    mask = (mask0[i0] & mask1[i1]) | (mask0[i1] & mask1[i0])
+                counts[irdf] += np.bincount(ibins[mask], weights[mask], self.nbin)
+        normalization = (4*np.pi*self.rspacing)*self.d**2
+        self.rdf_sum += counts[0]/(self.npairs[0]*normalization)
+        if self.partials is not None:
+            self.rdf_sum_partials += counts[1:]/(np.array(self.npairs[1:]).reshape(-1, 1)*normalization)
+        if self.pairs_sr is not None:
+            deltas = pos[:, self.sr1] - pos[:, self.sr0]
+            _mic(deltas, rvecs)
+            ibins = (np.sqrt((deltas**2).sum(axis=2))/self.rspacing).astype(int)
+            weights = np.repeat(volumes.reshape(-1, 1), ibins.shape[1], axis=1)
+            mask = ibins < self.nbin
+            counts_sr = np.bincount(ibins[mask], weights[mask], self.nbin)
+            self.rdf_sum_sr += counts_sr/(self.npairs[0]*normalization)
+        self.nsample += len(pos)
+
+    def get_accumulators(self):
+        result = {'rdf_sum': self.rdf_sum, 'nsample': self.nsample}
         if self.pairs_sr is not None:
-            self.cell.compute_distances(self.work[:len(self.pairs_sr)], self.pos0, self.pos1, pairs=self.pairs_sr, do_include=True)
-            counts_sr = np.histogram(self.work[:len(self.pairs_sr)], bins=self.bins)[0]
-            self.rdf_sum_sr += counts_sr/normalization
-        self.nsample += 1
+            result['rdf_sum_sr'] = self.rdf_sum_sr
+        if self.partials is not None:
+            result['rdf_sum_partials'] = self.rdf_sum_partials
+        return result
+
+    def merge_accumulators(self, accumulators):
+        self.rdf_sum += accumulators['rdf_sum']
+        self.nsample += accumulators['nsample']
+        if self.pairs_sr is not None:
+            self.rdf_sum_sr += accumulators['rdf_sum_sr']
+        if self.partials is not None:
+            self.rdf_sum_partials += accumulators['rdf_sum_partials']
 
     def compute_derived(self):
         # derive the RDF
         self.rdf = self.rdf_sum/self.nsample
         if self.pairs_sr is not None:
             self.rdf_sr = self.rdf_sum_sr/self.nsample
+        if self.partials is not None:
+            self.rdf_partials = self.rdf_sum_partials/self.nsample
         # store everything in the h5py file
         if self.outg is not None:
             self.outg['rdf'][:] = self.rdf
             if self.pairs_sr is not None:
                 self.outg['rdf_sr'][:] = self.rdf_sr
+            if self.partials is not None:
+                self.outg['rdf_partials'][:] = self.rdf_partials
 
     def plot(self, fn_png='rdf.png'):
         import matplotlib.pyplot as pt
@@ -284,3 +368,128 @@ class RDF(AnalysisHook):
         pt.ylabel('RDF')
         pt.xlim(self.bins[0]/xunit, self.bins[-1]/xunit)
         pt.savefig(fn_png)
+
+
+def _check_selects(select0, select1):
+    if select0 is not None:
+        if len(select0) != len(set(select0)):
+            raise ValueError('No duplicates are allowed in select0')
+        if len(select0) == 0:
+            raise ValueError('select0 can not be an empty list')
+    if select1 is not None:
+        if len(select1) != len(set(select1)):
+            raise ValueError('No duplicates are allowed in select1')
+        if len(select1) == 0:
+            raise ValueError('select1 can not be an empty list')
+    if select0 is not None and select1 is not None and len(select0) + len(select1) != len(set(select0) | set(select1)):
+        raise ValueError('No overlap is allowed between select0 and select1. If you want to compute and RDF within a set of atoms, omit the select1 argument.')
+    if select0 is None and select1 is not None:
+        raise ValueError('select1 can not be given without select0.')
+
+
+def _mic(deltas, rvecs):
+    '''Apply the minimum image convention in-place, like Cell.mic
+
+       **Arguments:**
+
+       deltas
+            An array with relative vectors of shape (nframe, n, 3).
+
+       rvecs
+            An array with cell vectors of shape (nframe, 3, 3).
+    '''
+    gvecs = np.linalg.inv(rvecs)
+    for i in xrange(3):
+        x = np.ceil(np.einsum('fnj,fj->fn', deltas, gvecs[:,:,i]) - 0.5)
+        deltas -= x.reshape(x.shape + (1,))*rvecs[:,i].reshape(-1, 1, 3)
+
+
+def _search_pairs(pos, rvecs, rmax, max_candidate=2**22, nsub=2):
+    '''Iterate over all pairs of atoms closer than rmax, with a cell list
+
+       **Arguments:**
+
+       pos
+            An array with atomic positions of shape (nframe, natom, 3).
+
+       rvecs
+            An array with cell vectors of shape (nframe, 3, 3).
+
+       rmax
+            The largest distance to consider.
+
+       **Optional arguments:**
+
+       max_candidate
+            The maximum number of candidate pairs that are compared at once.
+            This limits the memory usage.
+
+       nsub
+            The number of bins per rmax in each direction.
+
+       The atoms are assigned to bins of a regular grid in fractional
+       coordinates. The bins are at least rmax/nsub wide, such that only atoms
+       in nearby bins have to be compared. Each pair of different atoms is
+       found once for every periodic image closer than rmax.
+
+       Yields tuples (frames, i0, i1, distances) of arrays with the frame
+       index, the atom indexes and the distance of each pair.
+    '''
+    nframe, natom = pos.shape[:2]
+    # Wrap the atoms in the cell
+    gvecs = np.linalg.inv(rvecs)
+    frac = np.einsum('fni,fij->fnj', pos, gvecs)
+    frac -= np.floor(frac)
+    # The size of the grid and the number of nearby bins in each direction
+    # that have to be considered. There is no need for (many) more bins than
+    # atoms.
+    spacings = (1/np.sqrt((gvecs**2).sum(axis=1))).min(axis=0)
+    nbins = np.clip((nsub*spacings/rmax).astype(int), 1, max(1, int(round(natom**(1.0/3.0)))))
+    nranges = np.ceil(rmax*nbins/spacings).astype(int)
+    # Sort the atoms in the bins, with a separate grid for each frame. All
+    # work arrays below are in this order.
+    ibins = np.minimum((frac*nbins).astype(int), nbins-1)
+    frames = np.repeat(np.arange(nframe), natom)
+    ibins = ibins.reshape(-1, 3)
+    def get_keys(ibins):
+        return ((frames*nbins[0] + ibins[:,0])*nbins[1] + ibins[:,1])*nbins[2] + ibins[:,2]
+    keys = get_keys(ibins)
+    order = keys.argsort(kind='mergesort')
+    frames = frames[order]
+    ibins = ibins[order]
+    wrapped = np.einsum('fni,fij->fnj', frac, rvecs).reshape(-1, 3)[order]
+    counts = np.bincount(keys, minlength=nframe*nbins.prod())
+    begins = counts.cumsum() - counts
+    # Only half of the nearby bins are needed to find each pair once.
+    for offset in product(*[xrange(-nrange, nrange+1) for nrange in nranges]):
+        if offset < (0, 0, 0):
+            continue
+        shifted = ibins + offset
+        ibins_other = shifted % nbins
+        images = (shifted - ibins_other)/nbins
+        keys_other = get_keys(ibins_other)
+        ncandidates = counts[keys_other]
+        cumsum = ncandidates.cumsum()
+        # The positions of the atoms, translated to the image of the nearby bin
+        translated = wrapped - np.einsum('ni,nij->nj', images, rvecs[frames])
+        begin = 0
+        while begin < len(keys):
+            # Select a range of atoms such that the number of candidate
+            # pairs does not exceed max_candidate.
+            end = cumsum.searchsorted(cumsum[begin] - ncandidates[begin] + max_candidate, 'right')
+            end = max(end, begin+1)
+            n = ncandidates[begin:end]
+            i0 = np.repeat(np.arange(begin, end), n)
+            i1 = np.repeat(begins[keys_other[begin:end]] - (n.cumsum() - n), n)
+            i1 += np.arange(len(i0))
+            deltas = wrapped.take(i1, axis=0)
+            deltas -= np.repeat(translated[begin:end], n, axis=0)
+            distances = np.sqrt((deltas**2).sum(axis=1))
+            if offset == (0, 0, 0):
+                mask = (distances < rmax) & (i0 < i1)
+            else:
+                mask = (distances < rmax) & (i0 != i1)
+            i0 = order[i0[mask]]
+            i1 = order[i1[mask]]
+            yield i0/natom, i0 % natom, i1 % natom, distances[mask]
+            begin = end
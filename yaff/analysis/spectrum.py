@@ -38,7 +38,8 @@ __all__ = ['Spectrum']
 
 class Spectrum(AnalysisHook):
     def __init__(self, f=None, start=0, end=-1, step=1, bsize=4096, select=None,
-                 path='trajectory/vel', key='vel', outpath=None, weights=None):
+                 path='trajectory/vel', key='vel', outpath=None, weights=None,
+                 window=None, overlap=0):
         """
            **Optional arguments:**
 
@@ -86,6 +87,17 @@ class Spectrum(AnalysisHook):
                 from different time-dependent functions. If given, a linear
                 combination is made based on these weights.
 
+           window
+                A window function that is applied to each block before the
+                FFT. This may be one of 'bartlett', 'blackman', 'hamming' or
+                'hanning' or an array with bsize elements. The amplitudes are
+                divided by the mean of the squared window, such that they are
+                comparable to the ones without a window.
+
+           overlap
+                The number of samples by which subsequent blocks overlap. For
+                example, Welch's method uses overlap=bsize/2 with a window.
+
            The max_sample argument from get_slice is not used because the choice
            step value is an important parameter: it is best to choose step*bsize
            such that it coincides with a part of the trajectory in which the
@@ -105,6 +117,8 @@ class Spectrum(AnalysisHook):
 
            Depending on the FFT implementation in numpy, it may be interesting
            to tune the bsize argument. A power of 2 is typically a good choice.
+           All time-dependent functions in a block are transformed with a
+           single FFT call.
 
            When f is None, or when the path does not exist in the HDF5 file, the
            class can be used as an on-line analysis hook for the iterative
@@ -112,9 +126,22 @@ class Spectrum(AnalysisHook):
            is built up as the iterative algorithm progresses. The end option is
            ignored for an on-line analysis.
         """
+        if overlap < 0 or overlap >= bsize:
+            raise ValueError('The overlap must be non-negative and smaller than bsize.')
         self.bsize = bsize
         self.select = select
         self.weights = weights
+        self.overlap = overlap
+        if window is None:
+            self.window = None
+        elif isinstance(window, basestring):
+            if window not in ['bartlett', 'blackman', 'hamming', 'hanning']:
+                raise ValueError('Unknown window function: %s' % window)
+            self.window = getattr(np, window)(bsize)
+        else:
+            self.window = np.asarray(window, float)
+            if self.window.shape != (bsize,):
+                raise TypeError('The window must be an array with bsize elements.')
         self.ssize = self.bsize/2+1 # the length of the spectrum array
         self.amps = np.zeros(self.ssize, float)
         self.nfft = 0 # the number of fft calls, for statistics
@@ -123,25 +150,6 @@ class Spectrum(AnalysisHook):
         analysis_inputs = {'signal': AnalysisInput(path, key)}
         AnalysisHook.__init__(self, f, start, end, None, step, analysis_inputs, outpath, True)
 
-    def init_online(self):
-        AnalysisHook.init_online(self)
-        self.ncollect = 0
-
-    def _iter_indexes(self, array):
-        if self.select is None:
-            for indexes in np.ndindex(array.shape[1:]):
-                yield indexes
-        else:
-            for i0 in self.select:
-                for irest in np.ndindex(array.shape[2:]):
-                    yield (i0,) + irest
-
-    def _get_weight(self, indexes):
-        if self.weights is None:
-            return 1.0
-        else:
-            return self.weights[indexes]
-
     def init_timestep(self):
         self.freqs = np.arange(self.ssize)/(self.timestep*self.bsize)
         self.time = np.arange(self.ssize)*self.timestep
@@ -149,31 +157,28 @@ class Spectrum(AnalysisHook):
             self.outg['freqs'][:] = self.freqs
             self.outg['time'][:] = self.time
 
-    def offline_loop(self, ds_signal):
-        # Compute the amplitudes of the spectrum
-        current = self.start
-        stride = self.step*self.bsize
-        work = np.zeros(self.bsize, float)
-        while current <= self.end - stride:
-            for indexes in self._iter_indexes(ds_signal):
-                ds_signal.read_direct(work, (slice(current, current+stride, self.step),) + indexes)
-                self.amps += self._get_weight(indexes)*abs(np.fft.rfft(work))**2
-                self.nfft += 1
-            current += stride
-        # Compute related arrays
-        self.compute_derived()
-
     def configure_online(self, iterative, st_signal):
-        if self.select is None:
-            shape = (self.bsize,) + st_signal.shape
-        else:
-            shape = (self.bsize, self.select) + st_signal.shape[1:]
-        self.work = np.zeros(shape, float)
+        self.shape = st_signal.shape
 
     def configure_offline(self, ds_signal):
-        self.work = np.zeros(self.bsize)
+        self.shape = ds_signal.shape[1:]
 
     def init_first(self):
+        # The selected part of the signal and the corresponding weights
+        if self.select is None:
+            shape = self.shape
+        else:
+            shape = (len(self.select),) + self.shape[1:]
+        if self.weights is None:
+            self.work_weights = np.ones(shape, float).ravel()
+        elif self.select is None:
+            self.work_weights = np.asarray(self.weights, float).ravel()
+        else:
+            self.work_weights = np.asarray(self.weights, float)[self.select].ravel()
+        if self.window is not None:
+            self.work_weights /= (self.window**2).mean()
+        self.work = np.zeros((self.bsize,) + shape, float)
+        self.ncollect = 0
         AnalysisHook.init_first(self)
         if self.outg is not None:
             self.outg.create_dataset('amps', (self.ssize,), float)
@@ -183,23 +188,53 @@ class Spectrum(AnalysisHook):
 
     def read_online(self, st_signal):
         if self.select is None:
-            self.work[self.ncollect] = st_signal.value
+            self.signal = st_signal.value
         else:
-            self.work[self.ncollect] = st_signal.value[self.select]
-        self.ncollect += 1
+            self.signal = st_signal.value[self.select]
 
     def compute_iteration(self):
-        if self.ncollect == self.bsize:
-            # collected sufficient data to fill one block, computing FFT
-            for indexes in self._iter_indexes(self.work):
-                work = self.work[(slice(0, self.bsize),) + indexes]
-                self.amps += self._get_weight(indexes)*abs(np.fft.rfft(work))**2
-                self.nfft += 1
-            # compute some derived stuff
-            self.compute_derived()
-            # reset some things
-            self.work[:] = 0.0
-            self.ncollect = 0
+        self._push(self.signal.reshape((1,) + self.work.shape[1:]))
+
+    def compute_batch(self, indexes, ds_signal):
+        if self.select is not None:
+            ds_signal = ds_signal[:, self.select]
+        self._push(ds_signal)
+
+    def _push(self, signals):
+        '''Collect samples and compute the FFT of every full block'''
+        begin = 0
+        while begin < len(signals):
+            end = min(len(signals), begin + self.bsize - self.ncollect)
+            self.work[self.ncollect:self.ncollect+end-begin] = signals[begin:end]
+            self.ncollect += end - begin
+            begin = end
+            if self.ncollect == self.bsize:
+                # collected sufficient data to fill one block, computing FFT
+                work = self.work.reshape(self.bsize, -1)
+                if self.window is not None:
+                    work = work*self.window.reshape(-1, 1)
+                self.amps += np.dot(abs(np.fft.rfft(work, axis=0))**2, self.work_weights)
+                self.nfft += work.shape[1]
+                # keep the overlapping part for the next block
+                self.work[:self.overlap] = self.work[self.bsize-self.overlap:]
+                self.ncollect = self.overlap
+
+    def get_partition_block(self):
+        return self.bsize - self.overlap
+
+    def get_partition_overlap(self):
+        # Blocks are assigned to the partition that contains their last
+        # sample. The first blocks of a partition then start at most
+        # overlap samples before it, at a multiple of the block spacing.
+        hop = self.bsize - self.overlap
+        return ((self.overlap + hop - 1)/hop)*hop
+
+    def get_accumulators(self):
+        return {'amps': self.amps, 'nfft': self.nfft}
+
+    def merge_accumulators(self, accumulators):
+        self.amps += accumulators['amps']
+        self.nfft += accumulators['nfft']
 
     def compute_derived(self):
         self.ac = np.fft.irfft(self.amps)[:self.ssize]
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+# YAFF is yet another force-field code
+# Copyright (C) 2011 - 2013 Toon Verstraelen <Toon.Verstraelen@UGent.be>,
+# Louis Vanduyfhuys <Louis.Vanduyfhuys@UGent.be>, Center for Molecular Modeling
+# (CMM), Ghent University, Ghent, Belgium; all rights reserved unless otherwise
+# stated.
+#
+# This file is part of YAFF.
+#
+# YAFF is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# YAFF is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+'''Running statistics of state items'''
+
+
+import numpy as np
+
+from molmod.constants import boltzmann
+
+from yaff.analysis.hook import AnalysisInput, AnalysisHook
+from yaff.analysis.blav import BlockingAccumulator
+from yaff.analysis.pca import CovarianceAccumulator
+
+
+__all__ = ['RunningStatistics']
+
+
+class RunningStatistics(AnalysisHook):
+    def __init__(self, f=None, start=0, end=-1, max_sample=None, step=1,
+                 keys=None, covariances=None, temp=None, buffer_size=100,
+                 write_step=100, outpath='trajectory/stats'):
+        """Averages, fluctuations and error estimates of state items
+
+           For each selected state item, the mean, the variance and the
+           error on the mean (with the blocking method, see
+           :class:`yaff.analysis.blav.BlockingAccumulator`) are computed for
+           all components. Optionally, also the covariance matrix of all
+           components of an item is computed. The memory usage does not
+           depend on the length of the simulation.
+
+           **Optional arguments:**
+
+           f
+                An h5.File instance containing the trajectory data. If ``f``
+                is not given, or it does not contain all the datasets of the
+                selected state items, an on-line analysis is carried out.
+
+           start, end, max_sample, step
+                Optional arguments for the ``get_slice`` function. By default,
+                all frames are used.
+
+           keys
+                The keys of the state items to be analyzed. The off-line
+                analysis reads them from the datasets with the same name in
+                the trajectory group. Items without components, e.g. the cell
+                of an aperiodic system, are ignored. The default is
+                ``['epot', 'temp', 'press', 'volume', 'ptens', 'cell']``.
+
+           covariances
+                The keys of the state items for which the covariance matrix
+                of all components is computed. The default is all selected
+                keys except ``pos`` and ``vel``.
+
+           temp
+                The temperature of the ensemble. When given and the cell is
+                among the keys, the elastic compliance tensor and the elastic
+                constants are derived from the strain fluctuations, see
+                below.
+
+           buffer_size
+                The number of frames that is collected before they are
+                processed in an on-line analysis.
+
+           write_step
+                In an on-line analysis, the results are written every
+                ``write_step`` frames and at the end of the simulation.
+
+           outpath
+                The output path for the analysis. The results of each state
+                item are stored in a subgroup with the same name.
+
+           The strain fluctuation formula of Parrinello and Rahman is used
+           for the elastic properties:
+
+                Parrinello, M.; Rahman, A. J. Chem. Phys. 1982, 76, 2662-2666.
+
+           The Lagrangian strain is defined with the average cell as
+           reference. It is a linear function of the metric tensor of the
+           cell, whose covariance matrix is computed on the fly. The
+           compliance tensor is the covariance of the strain, multiplied by
+           the average volume and divided by kT. The elastic constants are
+           the inverse of the compliance tensor in Voigt notation. This is
+           only meaningful for simulations in the N(P)T ensemble with a
+           fully flexible cell.
+        """
+        if keys is None:
+            keys = ['epot', 'temp', 'press', 'volume', 'ptens', 'cell']
+        if covariances is None:
+            covariances = [key for key in keys if key not in ['pos', 'vel']]
+        for key in covariances:
+            if key not in keys:
+                raise ValueError('The key %s is not among the analyzed keys.' % key)
+        if buffer_size < 1:
+            raise ValueError('The buffer_size must be at least one.')
+        if write_step < 1:
+            raise ValueError('The write_step must be at least one.')
+        self.keys = list(keys)
+        self.covariance_keys = list(covariances)
+        self.temp = temp
+        self.buffer_size = buffer_size
+        self.write_step = write_step
+        analysis_inputs = dict(
+            (key, AnalysisInput('trajectory/%s' % key, key)) for key in keys
+        )
+        AnalysisHook.__init__(self, f, start, end, max_sample, step, analysis_inputs, outpath, False)
+
+    def configure_online(self, iterative, **state_items):
+        self.shapes = dict(
+            (name[3:], np.shape(st.value)) for name, st in state_items.iteritems()
+        )
+
+    def configure_offline(self, **datasets):
+        self.shapes = dict(
+            (name[3:], ds.shape[1:]) for name, ds in datasets.iteritems()
+        )
+
+    def init_first(self):
+        # Items without components can not be analyzed.
+        self.keys = [key for key in self.keys if np.product(self.shapes[key]) > 0]
+        self.covariance_keys = [key for key in self.covariance_keys if key in self.keys]
+        self.blockings = {}
+        self.cov_accumulators = {}
+        for key in self.keys:
+            self.blockings[key] = BlockingAccumulator(self.shapes[key])
+        for key in self.covariance_keys:
+            self.cov_accumulators[key] = CovarianceAccumulator(int(np.product(self.shapes[key])))
+        # Accumulators for the strain fluctuations
+        self.do_elastic = self.temp is not None and self.shapes.get('cell') == (3, 3)
+        if self.do_elastic:
+            self.metric_accumulator = CovarianceAccumulator(9)
+            self.volume_sum = 0.0
+        # Buffers for the on-line analysis
+        if self.online:
+            self.buffers = dict(
+                (key, np.zeros((self.buffer_size,) + self.shapes[key], float))
+                for key in self.keys
+            )
+            self.nbuffer = 0
+            self.counter = 0
+        AnalysisHook.init_first(self)
+
+    def read_online(self, **state_items):
+        self.values = dict(
+            (name[3:], st.value) for name, st in state_items.iteritems()
+        )
+
+    def compute_iteration(self):
+        for key in self.keys:
+            self.buffers[key][self.nbuffer] = self.values[key]
+        self.nbuffer += 1
+        self.counter += 1
+        if self.nbuffer == self.buffer_size:
+            self._flush()
+
+    def compute_batch(self, indexes, **batch):
+        for key in self.keys:
+            self._update(key, np.asarray(batch['ds_' + key], float))
+
+    def _flush(self):
+        '''Process the frames in the buffers of an on-line analysis'''
+        if self.nbuffer > 0:
+            for key in self.keys:
+                self._update(key, self.buffers[key][:self.nbuffer])
+            self.nbuffer = 0
+
+    def _update(self, key, samples):
+        self.blockings[key].update(samples)
+        if key in self.cov_accumulators:
+            self.cov_accumulators[key].update(samples.reshape(len(samples), -1))
+        if key == 'cell' and self.do_elastic:
+            # The metric tensor of each cell, i.e. the dot products of the
+            # cell vectors.
+            metrics = (samples[:,:,None,:]*samples[:,None,:,:]).sum(axis=3)
+            self.metric_accumulator.update(metrics.reshape(len(samples), 9))
+            self.volume_sum += abs(np.linalg.det(samples)).sum()
+
+    def compute_derived(self):
+        if self.online:
+            if self.counter % self.write_step != 0:
+                return
+            self._flush()
+        self._compute_results()
+
+    def _compute_results(self):
+        if len(self.keys) == 0 or len(self.blockings[self.keys[0]].nsamples) == 0:
+            return
+        self.nsample = self.blockings[self.keys[0]].nsamples[0]
+        self.means = {}
+        self.variances = {}
+        self.errors = {}
+        self.sinefs = {}
+        self.covariances = {}
+        for key in self.keys:
+            blocking = self.blockings[key]
+            self.means[key] = blocking.get_mean()
+            self.variances[key] = blocking.get_variance()
+            if self.nsample >= 2:
+                self.errors[key], self.sinefs[key] = blocking.get_error()
+            if key in self.cov_accumulators:
+                self.covariances[key] = self.cov_accumulators[key].get_cov_mat()[0]
+        if self.do_elastic:
+            self._compute_elastic()
+        if self.outg is not None:
+            self._write()
+
+    def _compute_elastic(self):
+        # The Lagrangian strain with respect to the average cell is
+        # eta = (M G M^T - 1)/2, with M the inverse of the average cell and
+        # G the metric tensor. Hence, cov(eta) = K cov(G) K^T/4 with K the
+        # Kronecker product of M with itself.
+        metric_cov = self.metric_accumulator.get_cov_mat()[0]
+        m = np.linalg.inv(self.means['cell'])
+        k = np.kron(m, m)
+        strain_cov = 0.25*np.dot(np.dot(k, metric_cov), k.T)
+        self.volume = self.volume_sum/self.nsample
+        self.compliance = (self.volume/(boltzmann*self.temp)*strain_cov).reshape(3, 3, 3, 3)
+        # The compliance matrix in Voigt notation, including the factors
+        # two for the shear strains.
+        voigt = [(0, 0), (1, 1), (2, 2), (1, 2), (0, 2), (0, 1)]
+        factors = np.array([1, 1, 1, 2, 2, 2], float)
+        compliance_voigt = np.zeros((6, 6), float)
+        for i0, (a, b) in enumerate(voigt):
+            for i1, (c, d) in enumerate(voigt):
+                compliance_voigt[i0, i1] = self.compliance[a, b, c, d]*factors[i0]*factors[i1]
+        if np.linalg.matrix_rank(compliance_voigt) == 6:
+            self.elastic = np.linalg.inv(compliance_voigt)
+        else:
+            self.elastic = np.zeros((6, 6), float) + np.nan
+
+    def _write(self):
+        def write(grp, name, value):
+            if name in grp:
+                grp[name][...] = value
+            else:
+                grp.create_dataset(name, data=value)
+        self.outg.attrs['nsample'] = self.nsample
+        for key in self.keys:
+            grp = self.outg.require_group(key)
+            write(grp, 'mean', self.means[key])
+            write(grp, 'var', self.variances[key])
+            if key in self.errors:
+                write(grp, 'error', self.errors[key])
+                write(grp, 'sinef', self.sinefs[key])
+            if key in self.covariances:
+                write(grp, 'cov', self.covariances[key])
+        if self.do_elastic:
+            write(self.outg, 'volume', self.volume)
+            write(self.outg, 'compliance', self.compliance)
+            write(self.outg, 'elastic', self.elastic)
+
+    def finalize(self, iterative):
+        # Write the results, irrespective of write_step
+        if self.online and not self._first_iteration:
+            self._flush()
+            self._compute_results()
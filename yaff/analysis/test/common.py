@@ -70,3 +70,22 @@ def get_opt_water32():
     opt.run(5)
     assert opt.counter == 5
     return dn_tmp, opt, hdf5.f
+
+
+def get_nve_water32_raw():
+    # Make a temporary directory
+    dn_tmp = tempfile.mkdtemp(suffix='yaff', prefix='nve_water_32_raw')
+    # Setup a test FF
+    ff = get_ff_water32()
+    # Run a test simulation, writing both an HDF5 and a raw trajectory
+    f = h5.File('%s/output.h5' % dn_tmp)
+    hdf5 = HDF5Writer(f)
+    raw = RawWriter('%s/output.raw' % dn_tmp, buffer_size=4)
+    nve = VerletIntegrator(ff, 1.0*femtosecond, hooks=[hdf5, raw], temp0=300)
+    nve.run(20)
+    assert nve.counter == 20
+    raw.close()
+    # The system is needed by some analysis routines.
+    fsys = h5.File('%s/system.h5' % dn_tmp)
+    ff.system.to_hdf5(fsys)
+    return dn_tmp, nve, f, RawTrajectoryFile('%s/output.raw' % dn_tmp, fsys)
@@ -42,3 +42,44 @@ def test_blav():
         assert os.path.isfile(fn_png)
     finally:
         shutil.rmtree(dn)
+
+
+def get_ar1_signals(n, phis):
+    # AR(1) processes have a statistical inefficiency (1+phi)/(1-phi)
+    signal = np.zeros((n, len(phis)))
+    noise = np.random.normal(0, 1, (n, len(phis)))
+    signal[0] = noise[0]
+    for i in xrange(1, n):
+        signal[i] = phis*signal[i-1] + noise[i]
+    return signal
+
+
+def test_blocking_ar1():
+    phis = np.array([0.0, 0.5, 0.9])
+    signal = get_ar1_signals(2**16, phis)
+    error, sinef = blocking(signal)
+    assert error.shape == (3,)
+    ratios = sinef/((1+phis)/(1-phis))
+    assert (ratios > 0.4).all() and (ratios < 1.6).all()
+    assert abs(error/signal.std(axis=0, ddof=1)/np.sqrt(sinef/len(signal)) - 1).max() < 1e-10
+
+
+def test_blocking_accumulator():
+    signal = np.random.normal(0, 1, (1000, 2, 3)).cumsum(axis=0)
+    accumulator0 = BlockingAccumulator((2, 3))
+    accumulator0.update(signal)
+    accumulator1 = BlockingAccumulator((2, 3))
+    for begin in xrange(0, len(signal), 77):
+        accumulator1.update(signal[begin:begin+77])
+    np.testing.assert_allclose(accumulator0.get_mean(), signal.mean(axis=0))
+    np.testing.assert_allclose(accumulator1.get_mean(), signal.mean(axis=0))
+    nblocks, errors, errors_errors = accumulator1.get_errors()
+    assert (nblocks == [1000, 500, 250, 125, 62, 31, 15, 7, 3]).all()
+    assert errors.shape == (9, 2, 3)
+    np.testing.assert_allclose(accumulator0.get_errors()[1], errors)
+    for result0, result1 in zip(accumulator0.get_error(), accumulator1.get_error()):
+        np.testing.assert_allclose(result0, result1)
+    # compare with a direct computation at the third level
+    averages = signal.reshape(250, 4, 2, 3).mean(axis=1)
+    np.testing.assert_allclose(errors[2], averages.std(axis=0)/np.sqrt(249))
+    np.testing.assert_allclose(errors_errors[2], errors[2]/np.sqrt(2*249))
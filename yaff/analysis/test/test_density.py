@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# YAFF is yet another force-field code
+# Copyright (C) 2011 - 2013 Toon Verstraelen <Toon.Verstraelen@UGent.be>,
+# Louis Vanduyfhuys <Louis.Vanduyfhuys@UGent.be>, Center for Molecular Modeling
+# (CMM), Ghent University, Ghent, Belgium; all rights reserved unless otherwise
+# stated.
+#
+# This file is part of YAFF.
+#
+# YAFF is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# YAFF is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+
+
+import shutil, h5py as h5, numpy as np
+
+from molmod.constants import boltzmann
+
+from yaff import *
+from yaff.analysis.test.common import get_nve_water32
+from yaff.sampling.test.common import get_ff_water32
+
+
+def test_density_grid_points():
+    # Atoms close to known grid points in cells that change shape
+    f = h5.File('yaff.analysis.test.test_density.test_density_grid_points.h5', driver='core', backing_store=False)
+    try:
+        shape = np.array([4, 5, 6])
+        nframe = 7
+        natom = 10
+        f['system/rvecs'] = np.diag([10.0, 11.0, 12.0])
+        f['system/numbers'] = np.ones(natom, int)
+        cells = np.diag([10.0, 11.0, 12.0]) + np.random.uniform(-1, 1, (nframe, 3, 3))
+        indexes = np.random.randint(0, 100, (nframe, natom, 3)) % shape
+        fracs = (indexes + np.random.uniform(-0.49, 0.49, indexes.shape))/shape
+        # add some periodic images
+        fracs += np.random.randint(-2, 3, fracs.shape)
+        f['trajectory/pos'] = np.einsum('naj,nji->nai', fracs, cells)
+        f['trajectory/cell'] = cells
+        dm = DensityMap(shape, f, cellpath='trajectory/cell', select=np.arange(1, natom))
+        expected = np.zeros(shape)
+        for i0, i1, i2 in indexes[:,1:].reshape(-1, 3):
+            expected[i0, i1, i2] += 1
+        np.testing.assert_allclose(dm.counts, expected/nframe)
+        volume = abs(np.linalg.det(cells)).mean()
+        np.testing.assert_allclose(dm.volume, volume)
+        np.testing.assert_allclose(dm.density, expected/nframe/volume*shape.prod())
+        np.testing.assert_equal(f['trajectory/pos_density/counts'][:], dm.counts)
+        np.testing.assert_equal(f['trajectory/pos_density/density'][:], dm.density)
+    finally:
+        f.close()
+
+
+def test_density_energy_grid():
+    dn_tmp, nve, f = get_nve_water32()
+    try:
+        system = nve.ff.system
+        select = system.get_indexes('O')
+        dm = DensityMap([10, 10, 10], f, select=select)
+        assert dm.counts.sum() == len(select)
+        grid = dm.get_energy_grid(300.0)
+        counts = dm.counts_sum.reshape(10, 10, 10)
+        mask = counts > 0
+        np.testing.assert_allclose(grid[mask], -boltzmann*300.0*np.log(counts[mask]/counts.mean()))
+        assert (grid[~mask] == grid[mask].max()).all()
+        # The grid can be used by ForcePartGrid, whose trilinear
+        # interpolation is exact at the grid points.
+        system_o = System(np.array([8]), np.dot([[0.3, 0.5, 0.9]], system.cell.rvecs), rvecs=system.cell.rvecs, ffatypes=['O'])
+        part = ForcePartGrid(system_o, {'O': grid})
+        assert abs(part.compute() - grid[3, 5, 9]) < 1e-10
+        # parallel analysis
+        driver = AnalysisDriver(f, nproc=2)
+        dm2 = driver.add(DensityMap, [10, 10, 10], f, select=select, outpath='trajectory/density2')
+        driver.run()
+        np.testing.assert_allclose(dm2.counts, dm.counts)
+    finally:
+        shutil.rmtree(dn_tmp)
+        f.close()
+
+
+def test_density_online():
+    ff = get_ff_water32()
+    f = h5.File('yaff.analysis.test.test_density.test_density_online.h5', driver='core', backing_store=False)
+    try:
+        hdf5 = HDF5Writer(f)
+        select = ff.system.get_indexes('O')
+        dm0 = DensityMap([6, 7, 8], select=select, buffer_size=4, write_step=3, outpath='trajectory/density')
+        assert dm0.online
+        nve = VerletIntegrator(ff, 1.0*femtosecond, hooks=[hdf5, dm0], temp0=300)
+        nve.run(6)
+        assert dm0.nsample == 7
+        dm1 = DensityMap([6, 7, 8], f, select=select)
+        assert not dm1.online
+        np.testing.assert_allclose(dm0.counts, dm1.counts)
+        np.testing.assert_allclose(dm0.density, dm1.density)
+    finally:
+        f.close()
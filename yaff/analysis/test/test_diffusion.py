@@ -22,10 +22,10 @@
 #
 #--
 
-import shutil, os, h5py as h5
+import shutil, os, h5py as h5, numpy as np
 
 from yaff import *
-from yaff.analysis.test.common import get_nve_water32
+from yaff.analysis.test.common import get_nve_water32, get_nve_water32_raw
 from yaff.sampling.test.common import get_ff_water32
 
 
@@ -88,3 +88,128 @@ def test_diff_bsize():
     nve.run(10)
     assert diff.msdcounters[0] == 7
     assert diff.msdcounters[1] == 2
+
+
+def test_diff_raw():
+    dn_tmp, nve, f, raw = get_nve_water32_raw()
+    try:
+        select = nve.ff.system.get_indexes('O')
+        diff0 = Diffusion(f, select=select)
+        diff1 = Diffusion(raw, select=select)
+        assert 'trajectory/pos_diff/msds' in raw.f
+        np.testing.assert_allclose(diff0.msds, diff1.msds)
+        np.testing.assert_allclose(diff0.time, diff1.time)
+    finally:
+        shutil.rmtree(dn_tmp)
+        f.close()
+        raw.close()
+
+
+def get_msds_reference(f, select, cell):
+    # Unwrap the positions and average over all time origins
+    pos = f['trajectory/pos'][:, select]
+    deltas = np.diff(pos, axis=0)
+    deltas -= np.dot(np.round(np.dot(deltas, cell.gvecs.T)), cell.rvecs)
+    pos = np.concatenate([pos[:1], pos[:1] + deltas.cumsum(axis=0)])
+    return np.array([
+        ((pos[lag:] - pos[:-lag])**2).sum(axis=2).mean()
+        for lag in xrange(1, len(pos))
+    ])
+
+
+def test_diff_fft_offline():
+    dn_tmp, nve, f, raw = get_nve_water32_raw()
+    try:
+        select = nve.ff.system.get_indexes('O')
+        msds = get_msds_reference(f, select, nve.ff.system.cell)
+        diff = Diffusion(f, select=select, mult=None, fft=True, groups=[select[:3], select[3:4]])
+        assert 'trajectory/pos_diff/msds_groups' in f
+        assert 'trajectory/pos_diff/msd001' not in f
+        assert (diff.msdcounters == np.arange(20, 0, -1)).all()
+        assert abs(diff.msds - msds).max() < 1e-10*msds.max()
+        assert abs(diff.msds_groups[0] - get_msds_reference(f, select[:3], nve.ff.system.cell)).max() < 1e-10*msds.max()
+        assert abs(diff.msds_groups[1] - get_msds_reference(f, select[3:4], nve.ff.system.cell)).max() < 1e-10*msds.max()
+        # Limited number of lags, processed in several blocks
+        diff = Diffusion(f, select=select, mult=3, fft=True)
+        assert abs(diff.msds - msds[:3]).max() < 1e-10*msds.max()
+    finally:
+        shutil.rmtree(dn_tmp)
+        f.close()
+        raw.close()
+
+
+def test_diff_fft_online():
+    # Setup a test FF
+    ff = get_ff_water32()
+    # Run a test simulation
+    f = h5.File('yaff.analysis.test.test_diffusion.test_diff_fft_online.h5', driver='core', backing_store=False)
+    try:
+        hdf5 = HDF5Writer(f)
+        select = ff.system.get_indexes('O')
+        diff0 = Diffusion(f, select=select, mult=3, fft=True)
+        nve = VerletIntegrator(ff, 1.0*femtosecond, hooks=[hdf5, diff0])
+        nve.run(40)
+        # Also run an off-line analysis and compare
+        diff1 = Diffusion(f, select=select, mult=3, fft=True)
+        assert abs(diff0.msdcounters - diff1.msdcounters).max() == 0
+        assert abs(diff0.msds - diff1.msds).max() < 1e-10*diff1.msds.max()
+        assert abs(diff0.A - diff1.A) < 1e-10*abs(diff1.A)
+    finally:
+        f.close()
+
+
+def test_diff_fft_errors():
+    ff = get_ff_water32()
+    select = ff.system.get_indexes('O')
+    for kwargs in dict(mult=None), dict(groups=[select]), dict(fft=True, bsize=30):
+        try:
+            Diffusion(None, select=select, **kwargs)
+            assert False
+        except ValueError:
+            pass
+
+
+def get_wrapped_file(name, variable, unwrapped=False):
+    # A random walk in a cubic cell, with positions wrapped in the cell of
+    # each frame.
+    np.random.seed(1)
+    nframe = 30
+    lengths = 10.0*(1 + 0.01*np.arange(nframe)*variable)
+    deltas = np.random.normal(0, 1.0, (nframe, 4, 3))
+    pos = np.zeros((nframe, 4, 3), float)
+    pos[0] = deltas[0]
+    for i in xrange(1, nframe):
+        pos[i] = pos[i-1] + deltas[i]
+        if not unwrapped:
+            pos[i] -= np.floor(pos[i]/lengths[i])*lengths[i]
+    f = h5.File('yaff.analysis.test.test_diffusion.%s.h5' % name, driver='core', backing_store=False)
+    f['system/rvecs'] = np.identity(3)*lengths[0]
+    f['trajectory/pos'] = pos
+    f['trajectory/time'] = np.arange(nframe, dtype=float)
+    f['trajectory/cell'] = np.identity(3)*lengths.reshape(-1, 1, 1)
+    return f
+
+
+def test_diff_unwrap():
+    ref = get_wrapped_file('ref', False, True)
+    f = get_wrapped_file('constant', False)
+    g = get_wrapped_file('variable', True)
+    try:
+        assert abs(f['trajectory/pos'][:] - ref['trajectory/pos'][:]).max() > 1
+        for fft in False, True:
+            # The same unwrapping in both modes
+            diff_ref = Diffusion(ref, mult=5, fft=fft)
+            diff = Diffusion(f, mult=5, fft=fft)
+            np.testing.assert_allclose(diff.msds, diff_ref.msds)
+            # A variable cell requires the cell vectors of each frame
+            try:
+                Diffusion(g, mult=5, fft=fft)
+                assert False
+            except ValueError:
+                pass
+            diff = Diffusion(g, mult=5, fft=fft, cellpath='trajectory/cell')
+            np.testing.assert_allclose(diff.msds, diff_ref.msds)
+    finally:
+        ref.close()
+        f.close()
+        g.close()
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+# YAFF is yet another force-field code
+# Copyright (C) 2011 - 2013 Toon Verstraelen <Toon.Verstraelen@UGent.be>,
+# Louis Vanduyfhuys <Louis.Vanduyfhuys@UGent.be>, Center for Molecular Modeling
+# (CMM), Ghent University, Ghent, Belgium; all rights reserved unless otherwise
+# stated.
+#
+# This file is part of YAFF.
+#
+# YAFF is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# YAFF is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+
+
+import os, shutil, h5py as h5, numpy as np
+
+from yaff import *
+from yaff.analysis.test.common import get_nve_water32, get_nve_water32_raw
+from yaff.sampling.test.common import get_ff_water32
+
+
+def test_driver():
+    dn_tmp, nve, f = get_nve_water32()
+    try:
+        select = nve.ff.system.get_indexes('O')
+        rdf0 = RDF(4.5*angstrom, 0.1*angstrom, f, select0=select, step=2)
+        diff0 = Diffusion(f, select=select, start=1)
+        spectrum0 = Spectrum(f, bsize=2)
+        amps0 = f['trajectory/vel_spectrum/amps'][:]
+        driver = AnalysisDriver(f, batch_size=2)
+        rdf1 = driver.add(RDF, 4.5*angstrom, 0.1*angstrom, f, select0=select, step=2)
+        diff1 = driver.add(Diffusion, f, select=select, start=1)
+        spectrum1 = driver.add(Spectrum, f, bsize=2)
+        # Nothing is computed before run is called.
+        assert not hasattr(rdf1, 'rdf')
+        driver.run()
+        assert rdf0.nsample == rdf1.nsample
+        np.testing.assert_equal(rdf0.rdf, rdf1.rdf)
+        np.testing.assert_equal(diff0.msds, diff1.msds)
+        np.testing.assert_equal(spectrum0.amps, spectrum1.amps)
+        np.testing.assert_equal(f['trajectory/vel_spectrum/amps'][:], amps0)
+        np.testing.assert_equal(f['trajectory/pos_rdf/rdf'][:], rdf0.rdf)
+    finally:
+        shutil.rmtree(dn_tmp)
+        f.close()
+
+
+def test_driver_fout():
+    dn_tmp, nve, f = get_nve_water32()
+    fout = h5.File('yaff.analysis.test.test_hook.test_driver_fout.h5', driver='core', backing_store=False)
+    try:
+        select = nve.ff.system.get_indexes('O')
+        driver = AnalysisDriver(f, fout)
+        rdf = driver.add(RDF, 4.5*angstrom, 0.1*angstrom, f, select0=select)
+        diff = driver.add(Diffusion, f, select=select)
+        driver.run()
+        assert 'trajectory/pos_rdf' not in f
+        assert 'trajectory/pos_diff' not in f
+        np.testing.assert_equal(fout['trajectory/pos_rdf/rdf'][:], rdf.rdf)
+        np.testing.assert_equal(fout['trajectory/pos_diff/msds'][:], diff.msds)
+    finally:
+        shutil.rmtree(dn_tmp)
+        f.close()
+        fout.close()
+
+
+def test_driver_errors():
+    dn_tmp, nve, f = get_nve_water32()
+    try:
+        driver = AnalysisDriver(f)
+        try:
+            driver.add(Diffusion, None)
+            assert False
+        except ValueError:
+            pass
+        # An error in the constructor does not affect later analyses.
+        try:
+            driver.add(Diffusion, f, bsize=1)
+            assert False
+        except ValueError:
+            pass
+        try:
+            driver.add(XYZWriter, '%s/tmp.xyz' % dn_tmp)
+            assert False
+        except ValueError:
+            pass
+        assert driver.hooks == []
+        # Analyses outside the driver are not affected.
+        diff = Diffusion(f)
+        assert 'trajectory/pos_diff/msds' in f
+        assert diff._defer_offline is False
+        diff = driver.add(Diffusion, f, outpath='trajectory/pos_diff2')
+        assert 'trajectory/pos_diff2' not in f
+        driver.run()
+        assert 'trajectory/pos_diff2/msds' in f
+    finally:
+        shutil.rmtree(dn_tmp)
+        f.close()
+
+
+def check_driver_parallel(f, nproc, **kwargs):
+    select = np.arange(0, 96, 3)
+    driver = AnalysisDriver(f, **kwargs)
+    rdf0 = driver.add(RDF, 4.5*angstrom, 0.1*angstrom, f, select0=select, start=1, outpath='trajectory/rdf0')
+    diff0 = driver.add(Diffusion, f, select=select, mult=4, outpath='trajectory/diff0')
+    fft0 = driver.add(Diffusion, f, select=select, mult=7, fft=True, outpath='trajectory/fft0')
+    spectrum0 = driver.add(Spectrum, f, bsize=4, outpath='trajectory/spectrum0')
+    welch0 = driver.add(Spectrum, f, bsize=5, overlap=3, window='hanning', outpath='trajectory/welch0')
+    driver.run()
+    driver = AnalysisDriver(f, nproc=nproc, **kwargs)
+    rdf1 = driver.add(RDF, 4.5*angstrom, 0.1*angstrom, f, select0=select, start=1, outpath='trajectory/rdf1')
+    diff1 = driver.add(Diffusion, f, select=select, mult=4, outpath='trajectory/diff1')
+    fft1 = driver.add(Diffusion, f, select=select, mult=7, fft=True, outpath='trajectory/fft1')
+    spectrum1 = driver.add(Spectrum, f, bsize=4, outpath='trajectory/spectrum1')
+    welch1 = driver.add(Spectrum, f, bsize=5, overlap=3, window='hanning', outpath='trajectory/welch1')
+    driver.run()
+    assert rdf0.nsample == rdf1.nsample
+    np.testing.assert_allclose(rdf0.rdf, rdf1.rdf)
+    np.testing.assert_equal(diff0.msdcounters, diff1.msdcounters)
+    np.testing.assert_allclose(diff0.msds, diff1.msds)
+    for m in xrange(4):
+        path = 'msd%03i' % (m+1)
+        # The unwrapped positions of a partition have a different origin,
+        # which affects the rounding errors.
+        np.testing.assert_allclose(f['trajectory/diff0'][path][:], f['trajectory/diff1'][path][:], rtol=1e-12)
+    np.testing.assert_equal(fft0.msdcounters, fft1.msdcounters)
+    np.testing.assert_allclose(fft0.msds, fft1.msds)
+    assert spectrum0.nfft == spectrum1.nfft
+    np.testing.assert_allclose(spectrum0.amps, spectrum1.amps)
+    np.testing.assert_equal(f['trajectory/spectrum1/amps'][:], spectrum1.amps)
+    assert welch0.nfft == welch1.nfft
+    np.testing.assert_allclose(welch0.amps, welch1.amps)
+
+
+def test_driver_parallel():
+    dn_tmp, nve, f, raw = get_nve_water32_raw()
+    try:
+        for nproc in 2, 3:
+            check_driver_parallel(f, nproc)
+        check_driver_parallel(f, 2, batch_size=3)
+        check_driver_parallel(raw, 3)
+    finally:
+        shutil.rmtree(dn_tmp)
+        f.close()
+        raw.close()
+
+
+
+def test_open_readonly():
+    from yaff.analysis.hook import _open_readonly
+    dn_tmp, nve, f = get_nve_water32()
+    old = os.environ.pop('HDF5_USE_FILE_LOCKING', None)
+    try:
+        # The environment of the process is not changed.
+        g = _open_readonly(f.filename)
+        assert 'HDF5_USE_FILE_LOCKING' not in os.environ
+        assert g.mode == 'r'
+        np.testing.assert_equal(g['trajectory/pos'][:], f['trajectory/pos'][:])
+        g.close()
+        os.environ['HDF5_USE_FILE_LOCKING'] = 'TRUE'
+        _open_readonly(f.filename).close()
+        assert os.environ['HDF5_USE_FILE_LOCKING'] == 'TRUE'
+    finally:
+        if old is None:
+            os.environ.pop('HDF5_USE_FILE_LOCKING', None)
+        else:
+            os.environ['HDF5_USE_FILE_LOCKING'] = old
+        shutil.rmtree(dn_tmp)
+        f.close()
+
+def test_driver_parallel_unsupported():
+    dn_tmp, nve, f = get_nve_water32()
+    try:
+        class NoMerge(Diffusion):
+            get_accumulators = AnalysisHook.get_accumulators
+        driver = AnalysisDriver(f, nproc=2)
+        driver.add(NoMerge, f)
+        try:
+            driver.run()
+            assert False
+        except ValueError:
+            pass
+    finally:
+        shutil.rmtree(dn_tmp)
+        f.close()
+
+
+def test_driver_parallel_core():
+    # Workers can not open an in-memory HDF5 file again.
+    dn_tmp, nve, f = get_nve_water32()
+    try:
+        g = h5.File('yaff.analysis.test.test_hook.test_driver_parallel_core.h5', driver='core', backing_store=False)
+        try:
+            f.copy('trajectory', g)
+            f.copy('system', g)
+            driver = AnalysisDriver(g, nproc=2)
+            driver.add(Diffusion, g)
+            try:
+                driver.run()
+                assert False
+            except ValueError:
+                pass
+        finally:
+            g.close()
+    finally:
+        shutil.rmtree(dn_tmp)
+        f.close()
+
+
+def test_strided_input():
+    f = h5.File('yaff.analysis.test.test_hook.test_strided_input.h5', driver='core', backing_store=False)
+    try:
+        hdf5 = HDF5Writer(f, strides={'pos': 5})
+        nve = VerletIntegrator(get_ff_water32(), 1.0*femtosecond, hooks=hdf5)
+        nve.run(20)
+        for cls, args in (RDF, (4.5*angstrom, 0.1*angstrom, f)), (Diffusion, (f,)):
+            try:
+                cls(*args)
+                assert False
+            except ValueError:
+                pass
+        # Analyses of unstrided datasets are not affected.
+        spectrum = Spectrum(f, bsize=4)
+        assert spectrum.end == 21
+    finally:
+        f.close()
+
+
+class OldStyleMeanPos(AnalysisHook):
+    '''An analysis written for the frame-by-frame read_offline protocol'''
+    def __init__(self, f, select, step=None):
+        self.select = select
+        analysis_inputs = {'pos': AnalysisInput('trajectory/pos', 'pos')}
+        AnalysisHook.__init__(self, f, 0, -1, None, step, analysis_inputs, 'trajectory/oldstyle')
+
+    def configure_offline(self, ds_pos):
+        self.pos = np.zeros((len(self.select), 3), float)
+        self.first = np.zeros(3, float)
+        self.pos_sum = 0.0
+        self.first_sum = 0.0
+        self.nframe = 0
+
+    def read_offline(self, i, ds_pos):
+        ds_pos.read_direct(self.pos, (i, self.select))
+        self.first[:] = ds_pos[i][0]
+
+    def compute_iteration(self):
+        self.pos_sum += self.pos
+        self.first_sum += self.first
+        self.nframe += 1
+
+    def compute_derived(self):
+        self.pos_mean = self.pos_sum/self.nframe
+        self.first_mean = self.first_sum/self.nframe
+
+
+def test_read_offline_compatibility():
+    dn_tmp, nve, f = get_nve_water32()
+    try:
+        select = np.array([0, 4, 5])
+        pos = f['trajectory/pos'][::2]
+        analysis = OldStyleMeanPos(f, select, step=2)
+        assert analysis.nframe == 3
+        np.testing.assert_allclose(analysis.pos_mean, pos[:, select].mean(axis=0))
+        np.testing.assert_allclose(analysis.first_mean, pos[:, 0].mean(axis=0))
+        driver = AnalysisDriver(f, batch_size=2)
+        analysis = driver.add(OldStyleMeanPos, f, select, step=2)
+        driver.run()
+        assert analysis.nframe == 3
+        np.testing.assert_allclose(analysis.pos_mean, pos[:, select].mean(axis=0))
+    finally:
+        shutil.rmtree(dn_tmp)
+        f.close()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# YAFF is yet another force-field code
+# Copyright (C) 2011 - 2013 Toon Verstraelen <Toon.Verstraelen@UGent.be>,
+# Louis Vanduyfhuys <Louis.Vanduyfhuys@UGent.be>, Center for Molecular Modeling
+# (CMM), Ghent University, Ghent, Belgium; all rights reserved unless otherwise
+# stated.
+#
+# This file is part of YAFF.
+#
+# YAFF is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# YAFF is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+
+
+import shutil, h5py as h5, numpy as np
+
+from yaff import *
+from yaff.analysis.test.common import get_nve_water32
+from yaff.sampling.test.common import get_ff_water32
+
+
+def get_water_ics(system):
+    ics = []
+    for i0, i1, i2 in system.iter_angles():
+        ics.append(Bond(i0, i1))
+        ics.append(BendAngle(i0, i1, i2))
+    # a duplicate
+    ics.append(Bond(i1, i0))
+    # an intermolecular distance, which is affected by the minimum image
+    # convention
+    ics.append(Bond(0, system.natom-1))
+    return ics
+
+
+def get_reference(ics, pos, cell):
+    result = np.zeros((len(pos), len(ics)))
+    for iframe in xrange(len(pos)):
+        for iic, ic in enumerate(ics):
+            deltas = []
+            for i, j in ic.index_pairs:
+                delta = pos[iframe, j] - pos[iframe, i]
+                cell.mic(delta)
+                deltas.append(delta)
+            if isinstance(ic, Bond):
+                result[iframe, iic] = np.linalg.norm(deltas[0])
+            else:
+                cosine = np.dot(deltas[0], deltas[1])/np.linalg.norm(deltas[0])/np.linalg.norm(deltas[1])
+                result[iframe, iic] = np.arccos(cosine)
+    return result
+
+
+def test_ic_offline():
+    dn_tmp, nve, f = get_nve_water32()
+    try:
+        system = nve.ff.system
+        ics = get_water_ics(system)
+        ics_series = InternalCoordinateSeries(ics, f, step=2)
+        values = f['trajectory/pos_ic/values'][:]
+        assert values.shape == (3, len(ics))
+        np.testing.assert_equal(ics_series.values, values)
+        assert f['trajectory/pos_ic/labels'][0] == ics[0].get_log()
+        expected = get_reference(ics, f['trajectory/pos'][::2], system.cell)
+        np.testing.assert_allclose(values, expected)
+        # The minimum image convention must be relevant for the last one.
+        assert expected[0,-1] < np.linalg.norm(f['trajectory/pos'][0,-1] - f['trajectory/pos'][0,0])
+        # parallel analysis
+        driver = AnalysisDriver(f, nproc=2)
+        ics_series = driver.add(InternalCoordinateSeries, ics, f, step=2, outpath='trajectory/pos_ic2')
+        driver.run()
+        np.testing.assert_equal(ics_series.values, values)
+        np.testing.assert_equal(f['trajectory/pos_ic2/values'][:], values)
+    finally:
+        shutil.rmtree(dn_tmp)
+        f.close()
+
+
+def test_ic_online():
+    ff = get_ff_water32()
+    f = h5.File('yaff.analysis.test.test_ic.test_ic_online.h5', driver='core', backing_store=False)
+    try:
+        hdf5 = HDF5Writer(f)
+        ics = get_water_ics(ff.system)
+        ics_series = InternalCoordinateSeries(ics, outpath='trajectory/ics')
+        assert ics_series.online
+        nve = VerletIntegrator(ff, 1.0*femtosecond, hooks=[hdf5, ics_series])
+        nve.run(5)
+        assert ics_series.values.shape == (6, len(ics))
+        expected = get_reference(ics, f['trajectory/pos'][:], ff.system.cell)
+        np.testing.assert_allclose(ics_series.values, expected)
+    finally:
+        f.close()
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+# YAFF is yet another force-field code
+# Copyright (C) 2011 - 2013 Toon Verstraelen <Toon.Verstraelen@UGent.be>,
+# Louis Vanduyfhuys <Louis.Vanduyfhuys@UGent.be>, Center for Molecular Modeling
+# (CMM), Ghent University, Ghent, Belgium; all rights reserved unless otherwise
+# stated.
+#
+# This file is part of YAFF.
+#
+# YAFF is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# YAFF is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+
+
+import shutil, numpy as np
+
+from yaff.analysis.pca import calc_cov_mat, calc_cov_mat_internal, \
+    calc_pca, CovarianceAccumulator, pca_similarity, pca_convergence, \
+    _calc_similarities
+from yaff.analysis.test.common import get_nve_water32_raw
+
+
+def test_cov_mat_raw():
+    dn_tmp, nve, f, raw = get_nve_water32_raw()
+    try:
+        cov_mat0, q_ref0 = calc_cov_mat(f, select=[0, 1, 2, 9])
+        cov_mat1, q_ref1 = calc_cov_mat(raw, select=[0, 1, 2, 9])
+        np.testing.assert_equal(q_ref0, q_ref1)
+        np.testing.assert_allclose(cov_mat0, cov_mat1)
+    finally:
+        shutil.rmtree(dn_tmp)
+        f.close()
+        raw.close()
+
+
+def test_cov_mat_accumulator():
+    q = np.random.normal(0, 1, (50, 12)) + np.random.normal(0, 100, 12)
+    cov_mat0, q_ref0 = calc_cov_mat_internal(q)
+    accumulator = CovarianceAccumulator(12)
+    for begin in xrange(0, 50, 7):
+        accumulator.update(q[begin:begin+7])
+    cov_mat1, q_ref1 = accumulator.get_cov_mat()
+    np.testing.assert_allclose(q_ref0, q_ref1)
+    np.testing.assert_allclose(cov_mat0, cov_mat1)
+    # merge two accumulators
+    accumulator0 = CovarianceAccumulator(12)
+    accumulator0.update(q[:20])
+    accumulator1 = CovarianceAccumulator(12)
+    accumulator1.update(q[20:])
+    accumulator0.merge(accumulator1)
+    np.testing.assert_allclose(cov_mat0, accumulator0.get_cov_mat()[0])
+    # fixed reference
+    cov_mat0, q_ref0 = calc_cov_mat_internal(q, q[0])
+    accumulator = CovarianceAccumulator(12, q[0])
+    for begin in xrange(0, 50, 7):
+        accumulator.update(q[begin:begin+7])
+    cov_mat1, q_ref1 = accumulator.get_cov_mat()
+    np.testing.assert_equal(q_ref1, q[0])
+    np.testing.assert_allclose(cov_mat0, cov_mat1)
+
+
+def test_cov_mat_batches():
+    dn_tmp, nve, f, raw = get_nve_water32_raw()
+    try:
+        q = f['trajectory/pos'][2:-3:2].reshape(-1, 96*3)
+        q *= np.sqrt(np.repeat(f['system/masses'][:], 3))
+        cov_mat0, q_ref0 = calc_cov_mat_internal(q)
+        for batch_size in None, 1, 3:
+            cov_mat1, q_ref1 = calc_cov_mat(raw, start=2, end=-3, step=2, batch_size=batch_size)
+            np.testing.assert_allclose(q_ref0, q_ref1)
+            np.testing.assert_allclose(cov_mat0, cov_mat1, atol=1e-10*abs(cov_mat0).max())
+    finally:
+        shutil.rmtree(dn_tmp)
+        f.close()
+        raw.close()
+
+
+def test_calc_pca_n_modes():
+    dn_tmp, nve, f, raw = get_nve_water32_raw()
+    try:
+        eigval0, eigvec0 = calc_pca('%s/pca0.h5' % dn_tmp, f=f)
+        eigval1, eigvec1 = calc_pca('%s/pca1.h5' % dn_tmp, f=f, n_modes=5, temp=300)
+        assert eigvec1.shape == (96*3, 5)
+        np.testing.assert_allclose(eigval0[:5], eigval1)
+        np.testing.assert_allclose(abs((eigvec0[:,:5]*eigvec1).sum(axis=0)), 1)
+        # The randomized eigensolver is reproducible
+        eigval2, eigvec2 = calc_pca('%s/pca2.h5' % dn_tmp, f=f, n_modes=5)
+        assert (eigval2 == eigval1).all()
+        assert (eigvec2 == eigvec1).all()
+        eigval3, eigvec3 = calc_pca('%s/pca3.h5' % dn_tmp, f=f, n_modes=5, seed=np.random.RandomState(1))
+        assert (eigval3 == eigval1).all()
+        assert (eigvec3 == eigvec1).all()
+    finally:
+        shutil.rmtree(dn_tmp)
+        f.close()
+        raw.close()
+
+
+def test_calc_similarities():
+    # blocks with more samples than coordinates, such that the reference
+    # sqrtm in pca_similarity is accurate
+    q = np.random.normal(0, 1, (200, 6)).cumsum(axis=0)
+    cov_mat_ref = calc_cov_mat_internal(q)[0]
+    sims = _calc_similarities(q, np.array([1, 4, 15]))
+    assert abs(sims[0] - 1) < 1e-6
+    for i, n_part in enumerate([4, 15]):
+        block_size = len(q)/n_part
+        expected = np.mean([
+            pca_similarity(calc_cov_mat_internal(q[j*block_size:(j+1)*block_size])[0], cov_mat_ref).real
+            for j in xrange(n_part)
+        ])
+        assert abs(sims[i+1] - expected) < 1e-6
+    # frames drawn with replacement are accounted for with their multiplicity
+    draws = np.random.randint(0, len(q), len(q))
+    sims = _calc_similarities(q, np.array([1, 3]), draws)
+    cov_mat_ref = calc_cov_mat_internal(q[draws])[0]
+    block_size = len(q)/3
+    expected = np.mean([
+        pca_similarity(calc_cov_mat_internal(q[draws[j*block_size:(j+1)*block_size]])[0], cov_mat_ref).real
+        for j in xrange(3)
+    ])
+    assert abs(sims[1] - expected) < 1e-6
+
+
+def test_pca_convergence_nproc():
+    dn_tmp, nve, f, raw = get_nve_water32_raw()
+    try:
+        np.random.seed(1)
+        result0 = pca_convergence(f, n_parts=[1, 2, 5], fn='%s/conv0' % dn_tmp, n_bootstrap=4)
+        np.random.seed(1)
+        result1 = pca_convergence(f, n_parts=[1, 2, 5], fn='%s/conv1' % dn_tmp, n_bootstrap=4, nproc=2)
+        np.testing.assert_allclose(result0, result1)
+        assert result0.shape == (3,)
+        assert (result0 > 0).all()
+    finally:
+        shutil.rmtree(dn_tmp)
+        f.close()
+        raw.close()
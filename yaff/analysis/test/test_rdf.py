@@ -26,7 +26,7 @@
 import shutil, os, h5py as h5, numpy as np
 
 from yaff import *
-from yaff.analysis.test.common import get_nve_water32
+from yaff.analysis.test.common import get_nve_water32, get_nve_water32_raw
 from yaff.sampling.test.common import get_ff_water32
 
 
@@ -196,3 +196,123 @@ def test_rdf_from_file_variable_cell():
         assert 'trajectory/pos_rdf/rdf' in f
         # The first part of the RDF should be zero.
         assert (rdf.rdf[:6] == 0.0).all()
+
+
+def test_rdf_tolerances():
+    # Lossy compression of the positions should hardly affect the RDF
+    ff = get_ff_water32()
+    f0 = h5.File('yaff.analysis.test.test_rdf.test_rdf_tolerances0.h5', driver='core', backing_store=False)
+    f1 = h5.File('yaff.analysis.test.test_rdf.test_rdf_tolerances1.h5', driver='core', backing_store=False)
+    try:
+        hdf50 = HDF5Writer(f0)
+        hdf51 = HDF5Writer(f1, tolerances={'pos': 1e-6})
+        nve = VerletIntegrator(ff, 1.0*femtosecond, hooks=[hdf50, hdf51])
+        nve.run(5)
+        select = ff.system.get_indexes('O')
+        rdf0 = RDF(4.5*angstrom, 0.1*angstrom, f0, select0=select)
+        rdf1 = RDF(4.5*angstrom, 0.1*angstrom, f1, select0=select)
+        assert rdf0.nsample == rdf1.nsample
+        assert abs(rdf0.rdf - rdf1.rdf).max() < 1e-10
+    finally:
+        f0.close()
+        f1.close()
+
+
+def test_rdf_raw():
+    dn_tmp, nve, f, raw = get_nve_water32_raw()
+    try:
+        select = nve.ff.system.get_indexes('O')
+        rdf0 = RDF(4.5*angstrom, 0.1*angstrom, f, select0=select)
+        rdf1 = RDF(4.5*angstrom, 0.1*angstrom, raw, select0=select)
+        assert 'trajectory/pos_rdf/rdf' in raw.f
+        assert rdf0.nsample == rdf1.nsample
+        np.testing.assert_equal(rdf0.rdf, rdf1.rdf)
+    finally:
+        shutil.rmtree(dn_tmp)
+        f.close()
+        raw.close()
+
+
+def check_rdf_reference(rdf, f, select0, select1=None, nimage=0):
+    # Compare with a histogram of all pair distances
+    cell = Cell(f['system/rvecs'][:])
+    if select1 is None:
+        npair = len(select0)*(len(select0)-1)/2
+    else:
+        npair = len(select0)*len(select1)
+    npair *= (1+2*nimage)**3
+    work = np.zeros(npair, float)
+    rdf_sum = 0.0
+    for pos in f['trajectory/pos'][:]:
+        pos1 = None if select1 is None else pos[select1]
+        cell.compute_distances(work, pos[select0], pos1, nimage=nimage)
+        counts = np.histogram(work, bins=rdf.bins)[0]
+        rdf_sum += counts/(npair/(cell.volume*(1+2*nimage)**3)*(4*np.pi*rdf.rspacing)*rdf.d**2)
+    assert abs(rdf.rdf - rdf_sum/rdf.nsample).max() < 1e-10
+
+
+def test_rdf_reference():
+    dn_tmp, nve, f = get_nve_water32()
+    try:
+        select0 = nve.ff.system.get_indexes('O')
+        select1 = nve.ff.system.get_indexes('H')
+        rdf = RDF(4.5*angstrom, 0.1*angstrom, f, select0=select0)
+        check_rdf_reference(rdf, f, select0)
+        rdf = RDF(4.5*angstrom, 0.1*angstrom, f, select0=select0, select1=select1)
+        check_rdf_reference(rdf, f, select0, select1)
+        rdf = RDF(9.0*angstrom, 0.1*angstrom, f, select0=select0, select1=select1, nimage=1)
+        check_rdf_reference(rdf, f, select0, select1, nimage=1)
+    finally:
+        shutil.rmtree(dn_tmp)
+        f.close()
+
+
+def test_rdf_partials():
+    dn_tmp, nve, f = get_nve_water32()
+    try:
+        select0 = nve.ff.system.get_indexes('O')
+        select1 = nve.ff.system.get_indexes('H')
+        partials = [(select0, None), (select0, select1), (select1, None)]
+        rdf = RDF(4.5*angstrom, 0.1*angstrom, f, select0=select0[:10], partials=partials)
+        assert f['trajectory/pos_rdf/rdf_partials'].shape == (3, rdf.nbin)
+        check_rdf_reference(rdf, f, select0[:10])
+        for (select0, select1), rdf_partial in zip(partials, rdf.rdf_partials):
+            rdf_single = RDF(4.5*angstrom, 0.1*angstrom, f, select0=select0, select1=select1, outpath='trajectory/single_rdf')
+            assert abs(rdf_partial - rdf_single.rdf).max() < 1e-10
+    finally:
+        shutil.rmtree(dn_tmp)
+        f.close()
+
+
+def test_search_pairs_triclinic():
+    from yaff.analysis.rdf import _search_pairs
+    np.random.seed(1)
+    rvecs = np.array([[[10.0, 0.0, 0.0], [3.0, 9.0, 0.0], [-2.0, 4.0, 11.0]]])
+    rvecs = np.concatenate([rvecs, rvecs*1.1])
+    pos = np.random.uniform(-20, 20, (2, 50, 3))
+    rmax = 6.0
+    # Brute force reference, with a generous number of images around the
+    # minimum image
+    expected = []
+    for iframe in xrange(2):
+        gvecs = np.linalg.inv(rvecs[iframe])
+        for i0 in xrange(50):
+            for i1 in xrange(i0+1, 50):
+                mic = pos[iframe, i1] - pos[iframe, i0]
+                mic -= np.dot(np.round(np.dot(mic, gvecs)), rvecs[iframe])
+                for image in np.ndindex(5, 5, 5):
+                    delta = mic + np.dot(np.array(image) - 2, rvecs[iframe])
+                    distance = np.linalg.norm(delta)
+                    if distance < rmax:
+                        expected.append((iframe, i0, i1, distance))
+    expected.sort()
+    for max_candidate in 1000, 2**22:
+        found = []
+        for frames, i0, i1, distances in _search_pairs(pos, rvecs, rmax, max_candidate):
+            for iframe, j0, j1, distance in zip(frames, i0, i1, distances):
+                found.append((iframe, min(j0, j1), max(j0, j1), distance))
+        found.sort()
+        assert len(found) == len(expected)
+        for row0, row1 in zip(found, expected):
+            assert row0[:3] == row1[:3]
+            assert abs(row0[3] - row1[3]) < 1e-10
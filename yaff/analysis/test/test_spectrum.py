@@ -25,7 +25,7 @@
 import shutil, os, h5py as h5, numpy as np
 
 from yaff import *
-from yaff.analysis.test.common import get_nve_water32
+from yaff.analysis.test.common import get_nve_water32, get_nve_water32_raw
 from yaff.sampling.test.common import get_ff_water32
 
 
@@ -96,17 +96,76 @@ def test_spectrum_online_weights():
     assert nve.counter == 5
 
 
-def test_spectrum_iter_indexes():
-    f = h5.File('yaff.analysis.test.test_spectrum.test_spectrum_iter_indexes.h5', driver='core', backing_store=False)
-    spectrum = Spectrum(f, bsize=10)
-    f.close()
-    l = list(spectrum._iter_indexes(np.zeros((10, 5, 3), float)))
-    assert l == [(0, 0), (0, 1), (0, 2), (1, 0), (1, 1), (1, 2), (2, 0), (2, 1),
-                 (2, 2), (3, 0), (3, 1), (3, 2), (4, 0), (4, 1), (4, 2)]
-    l = list(spectrum._iter_indexes(np.zeros((10, 5), float)))
-    assert l == [(0,), (1,), (2,), (3,), (4,)]
-    spectrum = Spectrum(f, bsize=10, select=[1,4])
-    l = list(spectrum._iter_indexes(np.zeros((10, 5, 3), float)))
-    assert l == [(1, 0), (1, 1), (1, 2), (4, 0), (4, 1), (4, 2)]
-    l = list(spectrum._iter_indexes(np.zeros((10, 5), float)))
-    assert l == [(1,), (4,)]
+def test_spectrum_select():
+    f = h5.File('yaff.analysis.test.test_spectrum.test_spectrum_select.h5', driver='core', backing_store=False)
+    try:
+        tgrp = f.create_group('trajectory')
+        tgrp['time'] = np.arange(20, dtype=float)
+        for name, shape in ('vel3', (20, 5, 3)), ('vel2', (20, 5)):
+            signal = np.random.normal(0, 1, shape)
+            tgrp[name] = signal
+            tgrp[name + '_sel'] = signal[:, [1, 4]]
+            # The batched FFTs cover all selected components
+            spectrum0 = Spectrum(f, bsize=10, select=[1, 4], path='trajectory/' + name, outpath='trajectory/spectrum0')
+            spectrum1 = Spectrum(f, bsize=10, path='trajectory/%s_sel' % name, outpath='trajectory/spectrum1')
+            assert spectrum0.nfft == 2*signal[0, [1, 4]].size
+            assert spectrum0.nfft == spectrum1.nfft
+            np.testing.assert_allclose(spectrum0.amps, spectrum1.amps)
+            expected = (abs(np.fft.rfft(signal[:10, [1, 4]], axis=0))**2).reshape(6, -1).sum(axis=1)
+            expected += (abs(np.fft.rfft(signal[10:, [1, 4]], axis=0))**2).reshape(6, -1).sum(axis=1)
+            np.testing.assert_allclose(spectrum0.amps, expected)
+    finally:
+        f.close()
+
+
+def test_spectrum_raw():
+    dn_tmp, nve, f, raw = get_nve_water32_raw()
+    try:
+        spectrum0 = Spectrum(f, bsize=4)
+        spectrum1 = Spectrum(raw, bsize=4)
+        assert 'trajectory/vel_spectrum/amps' in raw.f
+        np.testing.assert_equal(spectrum0.freqs, spectrum1.freqs)
+        np.testing.assert_allclose(spectrum0.amps, spectrum1.amps)
+        np.testing.assert_allclose(spectrum0.ac, spectrum1.ac)
+    finally:
+        shutil.rmtree(dn_tmp)
+        f.close()
+        raw.close()
+
+
+def test_spectrum_welch():
+    dn_tmp, nve, f, raw = get_nve_water32_raw()
+    try:
+        vel = f['trajectory/vel'][:]
+        weights = np.random.uniform(0, 1, (96, 3))
+        window = np.hanning(6)
+        spectrum = Spectrum(f, bsize=6, overlap=3, window='hanning', weights=weights, select=[1, 4, 7])
+        # Compare with a straightforward implementation
+        amps = 0.0
+        nfft = 0
+        for begin in xrange(0, len(vel)-5, 3):
+            for i in 1, 4, 7:
+                for j in xrange(3):
+                    signal = window*vel[begin:begin+6, i, j]
+                    amps += weights[i, j]*abs(np.fft.rfft(signal))**2/(window**2).mean()
+                    nfft += 1
+        assert spectrum.nfft == nfft
+        assert abs(spectrum.amps - amps).max() < 1e-10*amps.max()
+    finally:
+        shutil.rmtree(dn_tmp)
+        f.close()
+        raw.close()
+
+
+def test_spectrum_errors():
+    for kwargs in dict(overlap=4), dict(overlap=-1), dict(window='foo'):
+        try:
+            Spectrum(bsize=4, **kwargs)
+            assert False
+        except ValueError:
+            pass
+    try:
+        Spectrum(bsize=4, window=np.ones(3))
+        assert False
+    except TypeError:
+        pass
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# YAFF is yet another force-field code
+# Copyright (C) 2011 - 2013 Toon Verstraelen <Toon.Verstraelen@UGent.be>,
+# Louis Vanduyfhuys <Louis.Vanduyfhuys@UGent.be>, Center for Molecular Modeling
+# (CMM), Ghent University, Ghent, Belgium; all rights reserved unless otherwise
+# stated.
+#
+# This file is part of YAFF.
+#
+# YAFF is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# YAFF is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+
+
+import shutil, h5py as h5, numpy as np
+
+from molmod.constants import boltzmann
+
+from yaff import *
+from yaff.analysis.test.common import get_nve_water32
+from yaff.sampling.test.common import get_ff_water32
+
+
+def check_stats(stats, f, keys):
+    for key in keys:
+        data = f['trajectory/%s' % key][:]
+        assert len(data) == stats.nsample
+        np.testing.assert_allclose(stats.means[key], data.mean(axis=0))
+        np.testing.assert_allclose(stats.variances[key], data.var(axis=0), atol=1e-10*abs(data).max()**2)
+        data = data.reshape(len(data), -1)
+        cov = np.dot((data - data.mean(axis=0)).T, data - data.mean(axis=0))/len(data)
+        np.testing.assert_allclose(stats.covariances[key], cov, atol=1e-10*abs(data).max()**2)
+        assert stats.errors[key].shape == f['trajectory/%s' % key].shape[1:]
+        np.testing.assert_equal(stats.outg['%s/mean' % key][()], stats.means[key])
+        np.testing.assert_equal(stats.outg['%s/error' % key][()], stats.errors[key])
+        np.testing.assert_equal(stats.outg['%s/cov' % key][()], stats.covariances[key])
+
+
+def test_stats_offline():
+    dn_tmp, nve, f = get_nve_water32()
+    try:
+        keys = ['epot', 'temp', 'press', 'ptens', 'cell', 'epot_contribs']
+        stats = RunningStatistics(f, keys=keys)
+        assert stats.nsample == 6
+        assert 'trajectory/stats/ptens/sinef' in f
+        check_stats(stats, f, keys)
+    finally:
+        shutil.rmtree(dn_tmp)
+        f.close()
+
+
+def test_stats_online():
+    ff = get_ff_water32()
+    f = h5.File('yaff.analysis.test.test_stats.test_stats_online.h5', driver='core', backing_store=False)
+    try:
+        hdf5 = HDF5Writer(f)
+        keys = ['epot', 'temp', 'ptens', 'epot_contribs']
+        stats = RunningStatistics(f, keys=keys, buffer_size=3, write_step=4)
+        nve = VerletIntegrator(ff, 1.0*femtosecond, hooks=[hdf5, stats], temp0=300)
+        nve.run(9)
+        assert stats.online
+        # the results are written at the end of the run
+        assert stats.nsample == 10
+        assert f['trajectory/stats'].attrs['nsample'] == 10
+        check_stats(stats, f, keys)
+    finally:
+        f.close()
+
+
+def test_stats_elastic():
+    # Cells with isotropic strain fluctuations, for which the compliance is
+    # known.
+    f = h5.File('yaff.analysis.test.test_stats.test_stats_elastic.h5', driver='core', backing_store=False)
+    try:
+        rvecs0 = np.array([[10.0, 0.0, 0.0], [1.0, 11.0, 0.0], [0.5, -1.0, 12.0]])
+        scales = 1 + np.random.normal(0, 1e-3, 5000)
+        f['trajectory/cell'] = rvecs0*scales[:,None,None]
+        temp = 300.0
+        stats = RunningStatistics(f, keys=['cell'], temp=temp)
+        volume = np.linalg.det(rvecs0)
+        np.testing.assert_allclose(stats.volume, volume*(scales**3).mean())
+        # The strain is (scale**2 - 1)/2 times the identity.
+        strain = (scales**2/(scales**2).mean() - 1)/2
+        expected = stats.volume*strain.var()/(boltzmann*temp)
+        for a in xrange(3):
+            for b in xrange(3):
+                np.testing.assert_allclose(stats.compliance[a,a,b,b], expected, rtol=1e-2)
+        assert abs(stats.compliance[0,1,0,1]) < 1e-3*expected
+        # Only the bulk modulus is defined for isotropic fluctuations.
+        assert np.isnan(stats.elastic).all()
+        assert 'trajectory/stats/compliance' in f
+    finally:
+        f.close()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# YAFF is yet another force-field code
+# Copyright (C) 2011 - 2013 Toon Verstraelen <Toon.Verstraelen@UGent.be>,
+# Louis Vanduyfhuys <Louis.Vanduyfhuys@UGent.be>, Center for Molecular Modeling
+# (CMM), Ghent University, Ghent, Belgium; all rights reserved unless otherwise
+# stated.
+#
+# This file is part of YAFF.
+#
+# YAFF is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# YAFF is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+
+
+import threading, h5py as h5, numpy as np
+
+from yaff.analysis.utils import iter_batches
+
+
+def get_h5(name):
+    return h5.File('yaff.analysis.test.test_utils.%s.h5' % name, driver='core', backing_store=False)
+
+
+def check_iter_batches(datasets, start, end, step, **kwargs):
+    indexes = []
+    batches = dict((key, []) for key in datasets)
+    for batch_indexes, batch in iter_batches(datasets, start, end, step, **kwargs):
+        assert sorted(batch) == sorted(datasets)
+        indexes.append(batch_indexes)
+        for key, value in batch.iteritems():
+            assert len(value) == len(batch_indexes)
+            batches[key].append(value)
+    indexes = np.concatenate(indexes)
+    np.testing.assert_equal(indexes, np.arange(start, end, step))
+    for key, ds in datasets.iteritems():
+        np.testing.assert_equal(np.concatenate(batches[key]), ds[start:end:step])
+
+
+def test_iter_batches():
+    f = get_h5('test_iter_batches')
+    try:
+        pos = f.create_dataset('pos', data=np.random.normal(size=(53, 4, 3)), chunks=(7, 4, 3))
+        cell = f.create_dataset('cell', data=np.random.normal(size=(53, 3, 3)))
+        datasets = {'pos': pos, 'cell': cell}
+        for start, end, step in (0, 53, 1), (3, 50, 1), (3, 50, 4), (10, 11, 1), (5, 53, 13):
+            for batch_size in None, 1, 5, 20:
+                for readahead in 0, 2:
+                    check_iter_batches(datasets, start, end, step,
+                                       batch_size=batch_size, readahead=readahead)
+        check_iter_batches({'cell': cell}, 0, 53, 2, batch_size=4)
+        check_iter_batches(datasets, 0, 53, 1, window=1000)
+    finally:
+        f.close()
+
+
+def test_iter_batches_aligned():
+    f = get_h5('test_iter_batches_aligned')
+    try:
+        pos = f.create_dataset('pos', data=np.random.normal(size=(50, 4, 3)), chunks=(8, 4, 3))
+        # The batches do not cross chunk boundaries.
+        for indexes, batch in iter_batches({'pos': pos}, 3, 50, 1, batch_size=10):
+            assert indexes[0]/8 == indexes[-1]/8
+        sizes = [len(indexes) for indexes, batch in iter_batches({'pos': pos}, 3, 50, 1, batch_size=20)]
+        assert sizes == [13, 16, 16, 2]
+        # The size of a batch is limited by the window.
+        sizes = [len(indexes) for indexes, batch in iter_batches({'pos': pos}, window=12*96)]
+        assert max(sizes) == 8
+    finally:
+        f.close()
+
+
+class FailingDataset(object):
+    shape = (10,)
+    dtype = np.dtype(float)
+
+    def __getitem__(self, index):
+        if index.start >= 5:
+            raise IOError('Read error.')
+        return np.zeros(len(range(10)[index]))
+
+
+def test_iter_batches_error():
+    for readahead in 0, 2:
+        indexes = []
+        try:
+            for batch_indexes, batch in iter_batches({'x': FailingDataset()}, batch_size=2, readahead=readahead):
+                indexes.extend(batch_indexes)
+            assert False
+        except IOError, e:
+            assert str(e) == 'Read error.'
+        assert indexes == [0, 1, 2, 3, 4, 5]
+
+
+def test_iter_batches_break():
+    nthread = threading.active_count()
+    x = np.arange(100)
+    for indexes, batch in iter_batches({'x': x}, batch_size=2, readahead=1):
+        if indexes[0] == 10:
+            break
+    # The readahead thread is stopped when the iteration is interrupted.
+    iterator = iter_batches({'x': x}, batch_size=2, readahead=1)
+    iterator.next()
+    iterator.close()
+    assert threading.active_count() == nthread
@@ -24,10 +24,14 @@
 '''Auxiliary analysis routines'''
 
 
-import h5py as h5
+import sys
+import threading
+import Queue
 
+import numpy as np
 
-__all__ = ['get_slice']
+
+__all__ = ['get_slice', 'iter_batches']
 
 
 def get_slice(f, start=0, end=-1, max_sample=None, step=None):
@@ -72,7 +76,14 @@ def get_slice(f, start=0, end=-1, max_sample=None, step=None):
     if f is None or 'trajectory' not in f:
         nrow = None
     else:
-        nrow = min(ds.shape[0] for ds in f['trajectory'].itervalues() if isinstance(ds, h5.Dataset))
+        # Datasets written with a different stride (see HDF5Writer) do not
+        # determine the number of time steps, unless there are no others.
+        # Only datasets have a shape. This also works for RawTrajectoryFile.
+        datasets = [ds for ds in f['trajectory'].itervalues() if hasattr(ds, 'shape')]
+        unstrided = [ds for ds in datasets if 'stride' not in ds.attrs]
+        if len(unstrided) > 0:
+            datasets = unstrided
+        nrow = min(ds.shape[0] for ds in datasets)
         if end < 0:
             end = nrow + end + 1
         else:
@@ -91,3 +102,114 @@ def get_slice(f, start=0, end=-1, max_sample=None, step=None):
     elif max_sample is not None:
         raise ValueError('Both step and max_sample are given at the same time.')
     return start, end, step
+
+
+def _iter_batches_low(datasets, start, end, step, batch_size, window):
+    if batch_size is None:
+        frame_size = sum(
+            ds.dtype.itemsize*int(np.prod(ds.shape[1:]))
+            for ds in datasets.itervalues()
+        )
+        batch_size = max(1, window/max(frame_size, 1))
+    # Align the row ranges of the batches with the HDF5 chunks, such that
+    # each chunk is decompressed only once.
+    nrow = batch_size*step
+    for ds in datasets.itervalues():
+        chunks = getattr(ds, 'chunks', None)
+        if chunks is not None:
+            nrow = max(chunks[0], (nrow/chunks[0])*chunks[0])
+            break
+    for begin in xrange((start/nrow)*nrow, end, nrow):
+        # The first frame in [begin, begin+nrow)
+        first = start + max(0, (begin - start + step - 1)/step)*step
+        last = min(begin + nrow, end)
+        if first >= last:
+            continue
+        indexes = np.arange(first, last, step)
+        batch = dict((key, ds[first:last:step]) for key, ds in datasets.iteritems())
+        yield indexes, batch
+
+
+def iter_batches(datasets, start=0, end=None, step=1, batch_size=None,
+                 window=16*1024**2, readahead=2):
+    '''Iterate over batches of frames in a trajectory
+
+       **Arguments:**
+
+       datasets
+            A dictionary with h5.Dataset instances (or RawDataset instances).
+            The first axis of each dataset is the time axis.
+
+       **Optional arguments:**
+
+       start, end, step
+            The frames to be read, like in get_slice. When end is not given,
+            all frames until the end of the shortest dataset are read.
+
+       batch_size
+            The number of frames in one batch. When not given, it is
+            derived from window.
+
+       window
+            The approximate size of one batch in bytes, used when batch_size
+            is not given.
+
+       readahead
+            The number of batches that are read by a background thread while
+            the previous batch is processed. When zero, all batches are read
+            in the calling thread.
+
+       The row ranges of the batches are aligned with the HDF5 chunks of
+       the datasets. At most readahead+2 batches are kept in memory.
+
+       Each iteration yields a tuple ``(indexes, batch)``, where indexes is
+       an array with the frame indexes in the batch and batch is a
+       dictionary with the same keys as datasets, containing arrays with
+       the corresponding frames.
+    '''
+    if end is None:
+        end = min(ds.shape[0] for ds in datasets.itervalues())
+    if step < 1:
+        raise ValueError('The step must be strictly positive.')
+    batches = _iter_batches_low(datasets, start, end, step, batch_size, window)
+    if readahead == 0:
+        for item in batches:
+            yield item
+        return
+
+    queue = Queue.Queue(readahead)
+    stop = threading.Event()
+
+    def put(item):
+        # Give up when the consumer has stopped iterating.
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in batches:
+                if not put((item, None)):
+                    return
+            put((None, None))
+        except:
+            put((None, sys.exc_info()))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, exc_info = queue.get()
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if item is None:
+                break
+            yield item
+    finally:
+        stop.set()
+        thread.join()
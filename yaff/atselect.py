@@ -31,9 +31,12 @@
 
 from collections import namedtuple
 
+import numpy as np
+
 
 __all__ = [
     'check_name', 'find_first', 'lex_find', 'lex_split', 'atsel_compile', 'iter_matches',
+    'iter_bond_matches',
 ]
 
 
@@ -155,6 +158,32 @@ class Rule(object):
             result = '(%s)' % result
         return result
 
+    def get_mask(self, system, cache=None):
+        """Evaluate the rule for all atoms in a system at once
+
+           **Arguments:**
+
+           system
+                A ``System`` instance.
+
+           **Optional arguments:**
+
+           cache
+                A dictionary in which the masks of (sub)rules are stored. When
+                the same dictionary is used for several rules, shared
+                subexpressions are only evaluated once.
+
+           **Returns:** a boolean array with ``natom`` elements, which is True
+           for all atoms that match the rule.
+        """
+        if cache is None:
+            cache = {}
+        result = cache.get(self)
+        if result is None:
+            result = self._get_mask_low(system, cache)
+            cache[self] = result
+        return result
+
 
 class All(Rule):
     precedence = 100
@@ -174,6 +203,12 @@ class All(Rule):
                 return False
         return True
 
+    def _get_mask_low(self, system, cache):
+        result = np.ones(system.natom, bool)
+        for fn in self.fns:
+            result &= fn.get_mask(system, cache)
+        return result
+
     def _get_string_low(self):
         return '&'.join(fn.get_string(self.precedence) for fn in self.fns)
 
@@ -196,6 +231,12 @@ class Any(Rule):
                 return True
         return False
 
+    def _get_mask_low(self, system, cache):
+        result = np.zeros(system.natom, bool)
+        for fn in self.fns:
+            result |= fn.get_mask(system, cache)
+        return result
+
     def _get_string_low(self):
         return '|'.join(fn.get_string(self.precedence) for fn in self.fns)
 
@@ -214,6 +255,9 @@ class Not(Rule):
     def __call__(self, system, i):
         return not self.fn(system, i)
 
+    def _get_mask_low(self, system, cache):
+        return ~self.fn.get_mask(system, cache)
+
     def _get_string_low(self):
         return '!' + self.fn.get_string(self.precedence)
 
@@ -245,7 +289,19 @@ class BaseNeighs(Rule):
         for j in system.neighs1[i]:
             if self.fn is None or self.fn(system, j):
                 num += 1
-        return num
+        return self._compare(num)
+
+    def _get_mask_low(self, system, cache):
+        pairs = cache.get('neighbor_pairs')
+        if pairs is None:
+            pairs = _get_neighbor_pairs(system)
+            cache['neighbor_pairs'] = pairs
+        if self.fn is None:
+            weights = None
+        else:
+            weights = self.fn.get_mask(system, cache)[pairs[:,1]]
+        nums = np.bincount(pairs[:,0], weights, system.natom)
+        return self._compare(nums)
 
     def _get_string_low(self):
         if self.fn is None:
@@ -258,24 +314,24 @@ class CountNeighs(BaseNeighs):
     precedence = 80
     first = '='
 
-    def __call__(self, system, i):
-        return BaseNeighs.__call__(self, system, i) == self.num
+    def _compare(self, num):
+        return num == self.num
 
 
 class LessNeighs(BaseNeighs):
     precedence = 80
     first = '<'
 
-    def __call__(self, system, i):
-        return BaseNeighs.__call__(self, system, i) < self.num
+    def _compare(self, num):
+        return num < self.num
 
 
 class MoreNeighs(BaseNeighs):
     precedence = 80
     first = '>'
 
-    def __call__(self, system, i):
-        return BaseNeighs.__call__(self, system, i) > self.num
+    def _compare(self, num):
+        return num > self.num
 
 
 class Name(Rule):
@@ -323,6 +379,21 @@ class Name(Rule):
                     return False
         return True
 
+    def _get_mask_low(self, system, cache):
+        result = np.ones(system.natom, bool)
+        if self.scope is not None:
+            if system.scopes is None:
+                raise ValueError('The system does not have scopes.')
+            result &= np.asarray(system.scopes)[system.scope_ids] == self.scope
+        if self.ffatype != '*':
+            if self.ffatype is not None:
+                if system.ffatypes is None:
+                    raise ValueError('The system does not have ffatypes.')
+                result &= np.asarray(system.ffatypes)[system.ffatype_ids] == self.ffatype
+            if self.number is not None:
+                result &= system.numbers == self.number
+        return result
+
     def _get_string_low(self):
         if self.ffatype is not None:
             result = self.ffatype
@@ -335,8 +406,30 @@ class Name(Rule):
         return result
 
 
+def _get_neighbor_pairs(system):
+    """Return all (atom, neighbor) pairs as an integer array with two columns
+
+       Every pair occurs only once, such that counting the rows for a given
+       atom is consistent with the sets in ``system.neighs1``.
+    """
+    if system.bonds is None:
+        raise ValueError('The system does not have bond data.')
+    bonds = np.asarray(system.bonds, int).reshape(-1, 2)
+    pairs = np.concatenate([bonds, bonds[:,::-1]])
+    if len(pairs) > 0:
+        # remove duplicates, e.g. due to bonds that are listed twice.
+        keys = np.unique(pairs[:,0]*system.natom + pairs[:,1])
+        pairs = np.array([keys//system.natom, keys%system.natom]).T
+    return pairs
+
+
 rules = [All, Any, Not, CountNeighs, LessNeighs, MoreNeighs, Name]
 
+# Compiled rules do not have any state, so they can be reused for identical
+# (sub)expressions. The get_mask method also relies on this to avoid the
+# repeated evaluation of common subexpressions.
+_compiled = {}
+
 
 def atsel_compile(s):
     """Compiles an ATSELECT line into a boolean function
@@ -353,7 +446,12 @@ def atsel_compile(s):
             A function that takes two arguments: ``system`` and ``i``, where
             system is a ``System`` instance and ``i`` is an atom index. The
             function returns ``True`` if the atom matches the ATSELECT line
-            in the string ``s``.
+            in the string ``s``. The method ``rule.get_mask(system)``
+            evaluates the rule for all atoms at once and returns a boolean
+            array.
+
+       Compiled rules are memoized, i.e. compiling the same line twice returns
+       the same object.
     """
     # first get rid of the whitespace
     s = s.replace(' ', '')
@@ -365,9 +463,13 @@ def atsel_compile(s):
 def _compile_low(s):
     while len(s) >= 2 and s[0] == '(' and s[-1] == ')':
         s = s[1:-1]
+    result = _compiled.get(s)
+    if result is not None:
+        return result
     for rule in rules:
         result = rule._compile(s)
         if result is not None:
+            _compiled[s] = result
             return result
     raise ValueError('Do not know how to compile: %s' % s)
 
@@ -534,3 +636,239 @@ def iter_matches(dm0, dm1, allowed, threshold=1e-3, error_sq_fn=None, overlappin
                 # Discard the current stack and reduce the allowed lists.
                 stack.drop()
             yield match
+
+
+class BondMatcher(object):
+    """Depth-first search for induced subgraphs, used by iter_bond_matches."""
+
+    def __init__(self, neighs0, neighs1, allowed):
+        """Initialize BondMatcher instance.
+
+        See iter_bond_matches for the meaning of the parameters.
+        """
+        self.neighs0 = [frozenset(neighs0[i0]) for i0 in xrange(len(neighs0))]
+        self.neighs1 = [frozenset(neighs1[i1]) for i1 in xrange(len(neighs1))]
+        self.allowed_sets = self._prune(allowed)
+        self.allowed = [sorted(a) for a in self.allowed_sets]
+        if len(self.allowed) == 0 or any(len(a) == 0 for a in self.allowed):
+            # There is no hope of finding a solution.
+            self.order = None
+        else:
+            self._init_order()
+
+    def _prune(self, allowed):
+        """Reduce the allowed lists with simple invariants.
+
+        A vertex in graph 0 can only correspond to a vertex in graph 1 when it
+        has at least as many bonds and when each neighbor in graph 1 has at
+        least one allowed counterpart among the neighbors in graph 0. The
+        second criterion is applied repeatedly until nothing changes.
+        """
+        allowed_sets = []
+        n0 = len(self.neighs0)
+        for i1, a in enumerate(allowed):
+            degree1 = len(self.neighs1[i1])
+            allowed_sets.append(set(
+                i0 for i0 in a if 0 <= i0 < n0 and len(self.neighs0[i0]) >= degree1
+            ))
+        changed = True
+        while changed:
+            changed = False
+            for i1, a in enumerate(allowed_sets):
+                pruned = set(i0 for i0 in a if all(
+                    not allowed_sets[j1].isdisjoint(self.neighs0[i0])
+                    for j1 in self.neighs1[i1]
+                ))
+                if len(pruned) < len(a):
+                    allowed_sets[i1] = pruned
+                    changed = True
+        return allowed_sets
+
+    def _init_order(self):
+        """Fix the order in which the vertices of graph 1 are matched.
+
+        Each vertex is preferably bonded to many previous vertices, such that
+        its candidates can be taken from the neighbors of a matched vertex.
+        Ties are broken by taking the vertex with the fewest candidates. A
+        vertex without previous neighbors only occurs at the start of each
+        connected component of graph 1.
+        """
+        n1 = len(self.neighs1)
+        positions = {}
+        self.order = []
+        self.parents = []
+        self.previous = []
+        self.next = []
+        while len(self.order) < n1:
+            best_key = None
+            for i1 in xrange(n1):
+                if i1 not in positions:
+                    nprev = sum(j1 in positions for j1 in self.neighs1[i1])
+                    key = (-nprev, len(self.allowed[i1]), -len(self.neighs1[i1]), i1)
+                    if best_key is None or key < best_key:
+                        best_key = key
+            i1 = best_key[-1]
+            previous = [j1 for j1 in self.neighs1[i1] if j1 in positions]
+            if len(previous) > 0:
+                self.parents.append(min(previous, key=positions.get))
+            else:
+                self.parents.append(None)
+            self.previous.append(previous)
+            positions[i1] = len(self.order)
+            self.order.append(i1)
+        for i1 in self.order:
+            self.next.append([j1 for j1 in self.neighs1[i1] if positions[j1] > positions[i1]])
+
+    def get_roots(self):
+        """Return the candidates for the first vertex in the search order."""
+        if self.order is None:
+            return []
+        return self.allowed[self.order[0]]
+
+    def _get_candidates(self, k, match, used, blocked):
+        """Return the candidates for the k-th vertex in the search order."""
+        i1 = self.order[k]
+        parent = self.parents[k]
+        if parent is None:
+            candidates = self.allowed[i1]
+        else:
+            candidates = sorted(self.allowed_sets[i1].intersection(self.neighs0[match[parent]]))
+        # A candidate must be bonded to the counterparts of the previous neighbors
+        # and to no other vertex matched so far.
+        required = frozenset(match[j1] for j1 in self.previous[k])
+        result = []
+        for i0 in candidates:
+            if i0 in used or i0 in blocked:
+                continue
+            neighs0 = self.neighs0[i0]
+            if neighs0.intersection(used) != required:
+                continue
+            # Look ahead: the neighbors that are not matched yet must still have
+            # enough available counterparts.
+            next1 = self.next[k]
+            free = [j0 for j0 in neighs0 if j0 not in used and j0 not in blocked]
+            if len(free) >= len(next1) and \
+               all(not self.allowed_sets[j1].isdisjoint(free) for j1 in next1):
+                result.append(i0)
+        return result
+
+    def iter_root(self, root, blocked=frozenset()):
+        """Iterate over all matches with the first vertex mapped on ``root``.
+
+        The vertices of graph 0 in ``blocked`` are not considered.
+        """
+        if self.order is None or root in blocked:
+            return
+        n1 = len(self.order)
+        match = [None]*n1
+        match[self.order[0]] = root
+        used = set([root])
+        if n1 == 1:
+            yield (root,)
+            return
+        # Each element on the stack contains the remaining candidates for the
+        # vertex at the corresponding position in the search order.
+        stack = [self._get_candidates(1, match, used, blocked)[::-1]]
+        while len(stack) > 0:
+            k = len(stack)
+            i1 = self.order[k]
+            if match[i1] is not None:
+                used.discard(match[i1])
+                match[i1] = None
+            if len(stack[-1]) == 0:
+                stack.pop(-1)
+                continue
+            i0 = stack[-1].pop(-1)
+            match[i1] = i0
+            used.add(i0)
+            if k == n1 - 1:
+                yield tuple(match)
+            else:
+                stack.append(self._get_candidates(k + 1, match, used, blocked)[::-1])
+
+
+_worker_matcher = None
+
+
+def _init_match_worker(matcher):
+    global _worker_matcher
+    _worker_matcher = matcher
+
+
+def _match_root_worker(root):
+    return list(_worker_matcher.iter_root(root))
+
+
+def _first_match_root_worker(root):
+    return next(_worker_matcher.iter_root(root), None)
+
+
+def iter_bond_matches(neighs0, neighs1, allowed, overlapping=True, nproc=None):
+    """Iterate over all renumberings of graph 1 that are present in graph 0.
+
+    Parameters
+    ----------
+    neighs0 : list (length n0) of sets of integer indexes
+        The bonded neighbors of each vertex in the reference graph. A
+        dictionary with integer keys, e.g. ``System.neighs1``, is also
+        accepted.
+    neighs1 : list (length n1) of sets of integer indexes, n1 <= n0
+        The bonded neighbors of each vertex in the graph to be reordered.
+    allowed : list (length n1) of lists of integer indexes
+        For each vertex in graph 1, the allowed corresponding indexes in graph 0,
+        e.g. based on chemical elements or atom types.
+    overlapping : bool
+        When set to False, the algorithm excludes matches that are permutations of
+        previous matches or that have a partial overlap with any previous match.
+    nproc : int or None
+        When larger than one, the candidates for the first matched vertex are
+        distributed over a pool of ``nproc`` processes. The matches are yielded
+        in the same order as without a pool. Without overlapping matches, each
+        process only searches the first match of its candidate. When this match
+        overlaps with a previous one, the search is repeated in the calling
+        process, excluding the vertices of previous matches.
+
+    Yields
+    ------
+    match : tuple
+        All possible renumberings of vertices in graph 1 that match with (a subset of)
+        graph 0. All elements of the tuple are integers.
+
+    This is a faster alternative to iter_matches when only bonds need to be
+    compared: bonded pairs in graph 1 must correspond to bonded pairs in graph 0
+    and non-bonded pairs to non-bonded pairs. Partial matches are only extended
+    with neighbors of vertices that are already matched and candidates are pruned
+    beforehand by their degree and the allowed lists of their neighbors.
+    """
+    matcher = BondMatcher(neighs0, neighs1, allowed)
+    roots = matcher.get_roots()
+    if nproc is None or nproc <= 1:
+        blocked = set()
+        for root in roots:
+            for match in matcher.iter_root(root, blocked):
+                yield match
+                if not overlapping:
+                    # All other matches with the same root would overlap.
+                    blocked.update(match)
+                    break
+    else:
+        from multiprocessing import Pool
+        pool = Pool(nproc, _init_match_worker, (matcher,))
+        try:
+            if overlapping:
+                for matches in pool.imap(_match_root_worker, roots):
+                    for match in matches:
+                        yield match
+            else:
+                blocked = set()
+                for iroot, match in enumerate(pool.imap(_first_match_root_worker, roots)):
+                    root = roots[iroot]
+                    if match is not None and not blocked.isdisjoint(match):
+                        # The first match without the blocked vertices comes
+                        # later in the search, or does not exist.
+                        match = next(matcher.iter_root(root, blocked), None)
+                    if match is not None:
+                        blocked.update(match)
+                        yield match
+        finally:
+            pool.terminate()
@@ -265,6 +265,36 @@ class ForceField(ForcePart):
         result = sum([part.compute(gpos, vtens) for part in self.parts])
         return result
 
+    def compute_parts(self, gpos=None, vtens=None):
+        """Compute the energy and derivatives with less overhead than compute
+
+           The contributions of all parts are added directly to the arrays
+           gpos and vtens, without the intermediate copies and checks for
+           not-a-number values in the derivatives of the ``compute`` method.
+           The ``energy`` attribute of each part is updated, but the backup
+           copies ``gpos`` and ``vtens`` of the parts are not. This is used
+           by integrators to take many steps in a row.
+
+           **Optional arguments:**
+
+           gpos, vtens
+                See ``compute``. The results are added to the current
+                contents of the arrays.
+
+           The energy is returned.
+        """
+        if self.needs_nlist_update:
+            self.nlist.update()
+            self.needs_nlist_update = False
+        energy = 0.0
+        for part in self.parts:
+            part.energy = part._internal_compute(gpos, vtens)
+            energy += part.energy
+        if np.isnan(energy):
+            raise ValueError('The energy is not-a-number (nan).')
+        self.energy = energy
+        return energy
+
 
 class ForcePartPair(ForcePart):
     '''A pairwise (short-range) non-bonding interaction term.
@@ -733,6 +733,24 @@ def test_add_part():
     assert ff.compute() == ff.part_valence.energy + ff.part_press.energy
 
 
+def test_compute_parts():
+    system = get_system_water32()
+    fn_pars = context.get_fn('test/parameters_water.txt')
+    ff = ForceField.generate(system, fn_pars)
+    gpos1 = np.zeros(system.pos.shape)
+    vtens1 = np.zeros((3, 3))
+    energy1 = ff.compute(gpos1, vtens1)
+    energies1 = [part.energy for part in ff.parts]
+    gpos2 = np.zeros(system.pos.shape)
+    vtens2 = np.zeros((3, 3))
+    energy2 = ff.compute_parts(gpos2, vtens2)
+    assert abs(energy1 - energy2) < 1e-10
+    np.testing.assert_allclose([part.energy for part in ff.parts], energies1)
+    np.testing.assert_allclose(gpos2, gpos1, atol=1e-12)
+    np.testing.assert_allclose(vtens2, vtens1, atol=1e-12)
+    assert ff.compute_parts() == ff.energy
+
+
 def test_generator_formaldehyde_oopangle():
     system = get_system_formaldehyde()
     fn_pars = context.get_fn('test/parameters_formaldehyde_inversion.txt')
@@ -24,16 +24,107 @@
 '''Trajectory writers'''
 
 
+import os
+import sys
+import json
+import threading
+import Queue
+
+import numpy as np
+
 from yaff.sampling.iterative import Hook, AttributeStateItem, PosStateItem, CellStateItem, ConsErrStateItem
 from yaff.sampling.nvt import NHCThermostat, NHCAttributeStateItem
 from yaff.sampling.npt import MTKBarostat, MTKAttributeStateItem, TBCombination
 
 
-__all__ = ['HDF5Writer', 'XYZWriter', 'RestartWriter']
+__all__ = [
+    'BackgroundWriter', 'HDF5Writer', 'RawWriter', 'RawDataset', 'RawGroup',
+    'RawTrajectoryFile', 'read_raw_header', 'raw_to_hdf5', 'XYZWriter',
+    'RestartWriter',
+]
+
+
+class BackgroundWriter(object):
+    '''Carries out write operations in a separate thread
+
+       The main loop puts work items in a bounded queue and a daemon thread
+       passes them one by one to a write function. When the queue is full,
+       ``put`` blocks until the thread has caught up, such that a slow disk
+       can never cause unbounded memory usage. An exception raised in the
+       thread is raised again in the main thread at the next call to
+       ``put`` or ``close``.
+    '''
+    _stop = object()
+
+    def __init__(self, write, queue_size=4):
+        """
+           **Arguments:**
+
+           write
+                A function that takes one work item as argument.
+
+           **Optional arguments:**
+
+           queue_size
+                The maximum number of work items waiting in the queue.
+        """
+        if queue_size < 1:
+            raise ValueError('The queue_size must be at least one.')
+        self.write = write
+        self.queue = Queue.Queue(queue_size)
+        self.exc_info = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is self._stop:
+                return
+            # After a failure, the remaining items are only discarded, such
+            # that the main thread never blocks on a full queue.
+            if self.exc_info is None:
+                try:
+                    self.write(item)
+                except:
+                    self.exc_info = sys.exc_info()
+
+    def check(self):
+        '''Raise the exception from the writer thread, if any'''
+        if self.exc_info is not None:
+            exc_info = self.exc_info
+            self.exc_info = None
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def put(self, item):
+        '''Add a work item to the queue, blocking while the queue is full'''
+        self.check()
+        self.queue.put(item)
+
+    def close(self):
+        '''Write all pending items, stop the thread and check for errors'''
+        if self.thread.is_alive():
+            self.queue.put(self._stop)
+            self.thread.join()
+        self.check()
+
+
+def get_scaleoffset_digits(tolerance):
+    '''Return the number of decimal digits needed for a given tolerance
+
+       With D decimal digits, the HDF5 scale-offset filter rounds each number
+       to the nearest multiple of 10**-D, such that the absolute error is at
+       most 0.5*10**-D.
+    '''
+    return max(0, int(np.ceil(-np.log10(2*tolerance) - 1e-10)))
 
 
 class HDF5Writer(Hook):
-    def __init__(self, f, start=0, step=1):
+    def __init__(self, f, start=0, step=1, buffer_size=1, chunk_size=None,
+                 compression=None, compression_opts=None, flush_interval=None,
+                 background=False, queue_size=4, keys=None, strides=None,
+                 subsets=None, tolerances=None):
         """
            **Argument:**
 
@@ -47,51 +138,623 @@ class HDF5Writer(Hook):
 
            step
                 The hook will be called every `step` iterations.
+
+           buffer_size
+                The number of frames that are collected in memory before they
+                are written to the file. All datasets are then extended and
+                written in one block, which avoids many small writes. The
+                frames in the buffer are lost when the program crashes.
+
+           chunk_size
+                The number of frames in one HDF5 chunk. When not given, the
+                buffer_size is used if it is larger than one. Otherwise, the
+                chunk shape is determined by h5py.
+
+           compression, compression_opts
+                The compression filter for all trajectory datasets and its
+                options, e.g. 'gzip' and 4. These are passed on to
+                ``h5py.Group.create_dataset``.
+
+           flush_interval
+                When given, the HDF5 file is flushed to disk after every
+                ``flush_interval`` frames that are written. This controls how
+                much data may get lost, on top of the buffer, when the program
+                crashes.
+
+           background
+                When True, the buffered frames are written to the file by a
+                BackgroundWriter thread, such that the integrator does not
+                wait for the disk. The file should not be accessed by other
+                code while ``Iterative.run`` is in progress.
+
+           queue_size
+                The maximum number of buffers waiting to be written by the
+                background thread. When the queue is full, the integrator
+                waits for the writer thread.
+
+           keys
+                A list with the keys of the state items to be written. When
+                not given, all state items are written.
+
+           strides
+                A dictionary with a stride (in iterations) for some datasets.
+                Each stride must be a multiple of `step`. Other datasets are
+                written every `step` iterations. For each dataset with a
+                different stride, the datasets ``<name>_counter`` and
+                ``<name>_time`` are added, which contain the counter and the
+                time of the rows in that dataset. All these datasets get a
+                ``stride`` attribute. The off-line analyses in yaff.analysis
+                refuse datasets with a stride, because their rows do not line
+                up with the other trajectory data.
+
+           subsets
+                A dictionary of the form ``{name: (key, indexes)}``. For each
+                entry, a dataset `name` is written with the rows `indexes` of
+                the state item `key`, e.g. the positions of a subset of atoms.
+                When `name` equals `key`, the dataset with all atoms is
+                replaced by the subset. The indexes are stored in the
+                ``indexes`` attribute of the dataset.
+
+           tolerances
+                A dictionary with absolute error tolerances (in atomic units)
+                for some floating point datasets, e.g. ``{'pos': 1e-4, 'vel':
+                1e-7}``. These datasets are stored with lossy compression:
+                each number is rounded to D decimal digits with HDF5's
+                scale-offset filter, where D is the smallest integer for
+                which 0.5*10**-D does not exceed the tolerance. The shuffle
+                filter is added to make the remaining bits compress better
+                with `compression`, which defaults to 'gzip' for these
+                datasets. The rounding is undone transparently when the data
+                are read with h5py, so the maximum absolute error on every
+                element is bounded by the tolerance. The tolerance is stored
+                in the ``tolerance`` attribute of the dataset. For an NVE
+                simulation of 32 water molecules, tolerances of 1e-4 and 1e-7
+                reduce the size of the pos and vel datasets by factors of 3.4
+                and 3.8, respectively.
+
+           At the end of ``Iterative.run``, all buffered frames are written
+           and the file is flushed. Errors raised in the background thread
+           are raised again in the main loop.
+
+           For example, to write the positions of the guest atoms at every
+           step and those of all atoms every 100 steps::
+
+               HDF5Writer(f, strides={'pos': 100, 'vel': 100},
+                          subsets={'pos_guest': ('pos', iguest)})
         """
+        if buffer_size < 1:
+            raise ValueError('The buffer_size must be at least one.')
+        if strides is None:
+            strides = {}
+        if subsets is None:
+            subsets = {}
+        if tolerances is None:
+            tolerances = {}
+        for name, tolerance in tolerances.iteritems():
+            if not tolerance > 0:
+                raise ValueError('The tolerance of %s must be strictly positive.' % name)
+        for name, stride in strides.iteritems():
+            if stride < 1 or stride % step != 0:
+                raise ValueError('The stride of %s must be a positive multiple of step.' % name)
+        if chunk_size is None and buffer_size > 1:
+            chunk_size = buffer_size
         self.f = f
+        self.buffer_size = buffer_size
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.flush_interval = flush_interval
+        self.background = background
+        self.queue_size = queue_size
+        self._buffer = []
+        self._nunflushed = 0
+        self.keys = keys
+        self.strides = strides
+        self.tolerances = tolerances
+        self.subsets = dict((name, (key, np.asarray(indexes)))
+                            for name, (key, indexes) in subsets.iteritems())
+        self._writer = None
         Hook.__init__(self, start, step)
 
+    @property
+    def needs_vtens(self):
+        return self.keys is None or not self.vtens_keys.isdisjoint(self.keys)
+
+    def get_state(self, iterative):
+        """Return the dictionary with state items to be written."""
+        return iterative.state
+
+    def get_stride(self, name):
+        """Return the stride of a dataset, including the extra counter and time datasets."""
+        for suffix in '', '_counter', '_time':
+            if name.endswith(suffix):
+                stride = self.strides.get(name[:len(name)-len(suffix)])
+                if stride is not None:
+                    return stride
+        return self.step
+
+    def iter_datasets(self, iterative):
+        """Iterate over all datasets to be written.
+
+           Each iteration yields a tuple ``(name, item, indexes)``. `indexes`
+           is None, unless only a subset of the rows of the state item is
+           written.
+        """
+        state = self.get_state(iterative)
+        for key, item in sorted(state.iteritems()):
+            if self.keys is not None and key not in self.keys:
+                continue
+            if key in self.subsets:
+                continue
+            yield key, item, None
+        for name, (key, indexes) in sorted(self.subsets.iteritems()):
+            item = state.get(key)
+            if item is None:
+                raise ValueError('The subset %s refers to an unknown state item %s.' % (name, key))
+            if name != key and name in state:
+                raise ValueError('The subset %s has the same name as a state item.' % name)
+            yield name, item, indexes
+
     def __call__(self, iterative):
         if 'system' not in self.f:
             self.dump_system(iterative.ff.system)
         if 'trajectory' not in self.f:
             self.init_trajectory(iterative)
-        tgrp = self.f['trajectory']
-        # determine the row to write the current iteration to. If a previous
-        # iterations was not completely written, then the last row is reused.
-        row = min(tgrp[key].shape[0] for key in iterative.state if key in tgrp.keys())
-        for key, item in iterative.state.iteritems():
+        # Take a copy of all values, because the state items may be updated
+        # in-place before the buffer is written.
+        frame = {}
+        for name, item, indexes in self.iter_datasets(iterative):
             if item.value is None:
                 continue
             if len(item.shape) > 0 and min(item.shape) == 0:
                 continue
             if item.dtype is type(None):
                 continue
-            ds = tgrp[key]
-            if ds.shape[0] <= row:
+            stride = self.get_stride(name)
+            if (iterative.counter - self.start) % stride != 0:
+                continue
+            if indexes is None:
+                frame[name] = np.array(item.value, dtype=item.dtype)
+            else:
+                frame[name] = np.array(item.value[indexes], dtype=item.dtype)
+            if stride != self.step:
+                frame['%s_counter' % name] = iterative.counter
+                frame['%s_time' % name] = getattr(iterative, 'time', 0.0)
+        self._buffer.append(frame)
+        if len(self._buffer) >= self.buffer_size:
+            self.write_buffer()
+
+    def write_buffer(self):
+        """Write all buffered frames to the file.
+
+           In background mode, the frames are only handed over to the writer
+           thread.
+        """
+        if len(self._buffer) == 0:
+            return
+        frames = self._buffer
+        self._buffer = []
+        if self.background:
+            if self._writer is None:
+                self._writer = BackgroundWriter(self._write_frames, self.queue_size)
+            self._writer.put(frames)
+        else:
+            self._write_frames(frames)
+
+    def _write_frames(self, frames):
+        tgrp = self.f['trajectory']
+        names = set()
+        for frame in frames:
+            names.update(frame)
+        # determine the row to write the first buffered frame to, for each
+        # group of datasets with the same stride. If a previous iteration was
+        # not completely written, then the last row is reused.
+        rows = {}
+        for name in names:
+            stride = self.get_stride(name)
+            rows[stride] = min(rows.get(stride, tgrp[name].shape[0]), tgrp[name].shape[0])
+        for name in names:
+            row = rows[self.get_stride(name)]
+            values = [frame[name] for frame in frames if name in frame]
+            ds = tgrp[name]
+            if ds.shape[0] < row + len(values):
                 # do not over-allocate. hdf5 works with chunks internally.
-                ds.resize(row+1, axis=0)
-            ds[row] = item.value
+                ds.resize(row + len(values), axis=0)
+            ds[row:row + len(values)] = np.array(values, dtype=ds.dtype)
+        self._nunflushed += len(frames)
+        if self.flush_interval is not None and self._nunflushed >= self.flush_interval:
+            self.f.flush()
+            self._nunflushed = 0
+
+    def finalize(self, iterative):
+        self.write_buffer()
+        if self._writer is not None:
+            writer = self._writer
+            self._writer = None
+            writer.close()
+        if self._nunflushed > 0:
+            self.f.flush()
+            self._nunflushed = 0
 
     def dump_system(self, system):
         system.to_hdf5(self.f)
 
     def init_trajectory(self, iterative):
         tgrp = self.f.create_group('trajectory')
-        for key, item in iterative.state.iteritems():
+        for name, item, indexes in self.iter_datasets(iterative):
+            if len(item.shape) > 0 and min(item.shape) == 0:
+                continue
+            if item.dtype is type(None):
+                continue
+            if indexes is None:
+                item_shape = item.shape
+            else:
+                item_shape = (len(indexes),) + item.shape[1:]
+            dset = self._create_dataset(tgrp, name, item_shape, item.dtype)
+            if name in self.tolerances:
+                dset.attrs['tolerance'] = self.tolerances[name]
+            if indexes is not None:
+                dset.attrs['indexes'] = indexes
+            stride = self.get_stride(name)
+            if stride != self.step:
+                dset.attrs['stride'] = stride
+                for extra_name, dtype in ('%s_counter' % name, int), ('%s_time' % name, float):
+                    extra = self._create_dataset(tgrp, extra_name, (), dtype)
+                    extra.attrs['stride'] = stride
+            for attr_name, value in item.iter_attrs(iterative):
+               tgrp.attrs[attr_name] = value
+
+    def _create_dataset(self, tgrp, name, item_shape, dtype):
+        maxshape = (None,) + item_shape
+        shape = (0,) + item_shape
+        if self.chunk_size is None:
+            chunks = None
+        else:
+            chunks = (self.chunk_size,) + item_shape
+        kwargs = {}
+        compression = self.compression
+        tolerance = self.tolerances.get(name)
+        if tolerance is not None:
+            if np.dtype(dtype).kind != 'f':
+                raise TypeError('A tolerance can only be used for floating point datasets, got %s.' % name)
+            kwargs['scaleoffset'] = get_scaleoffset_digits(tolerance)
+            kwargs['shuffle'] = True
+            if compression is None:
+                compression = 'gzip'
+        return tgrp.create_dataset(
+            name, shape, maxshape=maxshape, dtype=dtype, chunks=chunks,
+            compression=compression, compression_opts=self.compression_opts,
+            **kwargs)
+
+
+RAW_MAGIC = 'YAFFRAW1'
+RAW_HEADER_SIZE = 4096
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray) or isinstance(value, np.generic):
+        return value.tolist()
+    elif isinstance(value, tuple):
+        return list(value)
+    return value
+
+
+def read_raw_header(fn):
+    '''Read the header of a raw trajectory file
+
+       **Arguments:**
+
+       fn
+            The filename of the raw trajectory.
+
+       Returns a list of fields ``(key, dtype, shape)`` and a dictionary with
+       trajectory attributes.
+    '''
+    with open(fn, 'rb') as f:
+        header = f.read(RAW_HEADER_SIZE)
+    if len(header) != RAW_HEADER_SIZE or not header.startswith(RAW_MAGIC):
+        raise IOError('The file %s is not a raw Yaff trajectory.' % fn)
+    info = json.loads(header[len(RAW_MAGIC):])
+    fields = [(str(key), np.dtype(str(fdtype)), tuple(shape)) for key, fdtype, shape in info['fields']]
+    return fields, info['attrs']
+
+
+class RawWriter(Hook):
+    '''Appends frames to a memory-mappable binary trajectory file
+
+       The file starts with a fixed header of RAW_HEADER_SIZE bytes. This
+       header contains RAW_MAGIC, followed by a JSON description of the
+       fields in each frame and of the trajectory attributes, padded with
+       spaces. The frames follow as contiguous records, without any
+       padding, such that the whole trajectory can be loaded with
+       ``numpy.memmap``. A partially written frame at the end of the file,
+       e.g. after a crash, is ignored by the reader and overwritten by the
+       writer.
+
+       Use RawTrajectoryFile to analyze the trajectory and raw_to_hdf5 to
+       convert it to the usual HDF5 layout.
+    '''
+    def __init__(self, fn, start=0, step=1, keys=None, buffer_size=100):
+        """
+           **Arguments:**
+
+           fn
+                The filename of the raw trajectory. When the file already
+                exists, new frames are appended, which requires that the
+                fields in the file match the state items.
+
+           **Optional arguments:**
+
+           start
+                The first iteration at which this hook should be called.
+
+           step
+                The hook will be called every `step` iterations.
+
+           keys
+                A list with the keys of the state items to be written. When
+                not given, all state items are written.
+
+           buffer_size
+                The number of frames that are collected in memory before they
+                are written to the file in a single call.
+        """
+        if buffer_size < 1:
+            raise ValueError('The buffer_size must be at least one.')
+        self.fn = fn
+        self.keys = keys
+        self.buffer_size = buffer_size
+        self._file = None
+        self._buffer = None
+        self._nbuffer = 0
+        Hook.__init__(self, start, step)
+
+    @property
+    def needs_vtens(self):
+        return self.keys is None or not self.vtens_keys.isdisjoint(self.keys)
+
+    def init_file(self, iterative):
+        fields = []
+        attrs = {}
+        for key, item in sorted(iterative.state.iteritems()):
+            if self.keys is not None and key not in self.keys:
+                continue
+            if item.value is None:
+                continue
             if len(item.shape) > 0 and min(item.shape) == 0:
                 continue
             if item.dtype is type(None):
                 continue
-            maxshape = (None,) + item.shape
-            shape = (0,) + item.shape
-            dset = tgrp.create_dataset(key, shape, maxshape=maxshape, dtype=item.dtype)
+            fields.append((key, np.dtype(item.dtype), item.shape))
             for name, value in item.iter_attrs(iterative):
-               tgrp.attrs[name] = value
+                attrs[name] = _to_json(value)
+        if len(fields) == 0:
+            raise ValueError('No state items to be written to %s.' % self.fn)
+        dtype = np.dtype([(key, fdtype, shape) for key, fdtype, shape in fields])
+        if os.path.isfile(self.fn) and os.path.getsize(self.fn) > 0:
+            if fields != read_raw_header(self.fn)[0]:
+                raise ValueError('The fields in %s do not match the state items.' % self.fn)
+            self._file = open(self.fn, 'r+b')
+            # Drop a partially written frame, if any.
+            nframe = (os.path.getsize(self.fn) - RAW_HEADER_SIZE)/dtype.itemsize
+            self._file.truncate(RAW_HEADER_SIZE + nframe*dtype.itemsize)
+            self._file.seek(0, os.SEEK_END)
+        else:
+            info = {
+                'fields': [(key, fdtype.str, shape) for key, fdtype, shape in fields],
+                'attrs': attrs,
+            }
+            header = RAW_MAGIC + json.dumps(info)
+            if len(header) > RAW_HEADER_SIZE:
+                raise ValueError('The header of %s is too long.' % self.fn)
+            self._file = open(self.fn, 'wb')
+            self._file.write(header.ljust(RAW_HEADER_SIZE))
+        self._buffer = np.zeros(self.buffer_size, dtype)
+
+    def __call__(self, iterative):
+        if self._file is None:
+            self.init_file(iterative)
+        record = self._buffer[self._nbuffer]
+        for key in self._buffer.dtype.names:
+            record[key] = iterative.state[key].value
+        self._nbuffer += 1
+        if self._nbuffer == self.buffer_size:
+            self.write_buffer()
+
+    def write_buffer(self):
+        """Append all buffered frames to the file."""
+        if self._nbuffer > 0:
+            self._buffer[:self._nbuffer].tofile(self._file)
+            self._nbuffer = 0
+
+    def finalize(self, iterative):
+        if self._file is not None:
+            self.write_buffer()
+            self._file.flush()
+
+    def close(self):
+        """Write the buffered frames and close the file."""
+        if self._file is not None:
+            self.write_buffer()
+            self._file.close()
+            self._file = None
+
+
+class RawDataset(object):
+    '''A read-only view on one field of a raw trajectory
+
+       This mimics the parts of the h5py.Dataset interface that are used by
+       the analysis routines.
+    '''
+    def __init__(self, array):
+        self.array = array
+        self.attrs = {}
+
+    shape = property(lambda self: self.array.shape)
+    dtype = property(lambda self: self.array.dtype)
+
+    def __len__(self):
+        return self.array.shape[0]
+
+    def __getitem__(self, index):
+        return np.array(self.array[index])
+
+    def read_direct(self, dest, source_sel=None, dest_sel=None):
+        if source_sel is None:
+            source_sel = Ellipsis
+        if dest_sel is None:
+            dest_sel = Ellipsis
+        dest[dest_sel] = self.array[source_sel]
+
+
+class RawGroup(object):
+    '''The trajectory group of a raw trajectory, see RawTrajectoryFile'''
+    def __init__(self, datasets, attrs):
+        self.datasets = datasets
+        self.attrs = attrs
+
+    def __contains__(self, key):
+        return key in self.datasets
+
+    def __getitem__(self, key):
+        return self.datasets[key]
+
+    def __iter__(self):
+        return iter(sorted(self.datasets))
+
+    def keys(self):
+        return sorted(self.datasets)
+
+    def itervalues(self):
+        for key in self.keys():
+            yield self.datasets[key]
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self.datasets[key]
+
+
+class RawTrajectoryFile(object):
+    '''Presents a raw trajectory as an h5py.File for the analysis routines
+
+       The paths ``trajectory`` and ``trajectory/<key>`` refer to the memory
+       mapped raw trajectory. All other paths are looked up in an HDF5 file,
+       which should contain the ``system`` group for analyses that need it,
+       and in which the results of the analyses are stored. For example::
+
+           f = h5.File('system.h5')
+           RDF(4.5*angstrom, 0.1*angstrom, RawTrajectoryFile('traj.raw', f))
+    '''
+    def __init__(self, fn, f=None):
+        """
+           **Arguments:**
+
+           fn
+                The filename of the raw trajectory.
+
+           **Optional arguments:**
+
+           f
+                An h5.File instance. When not given, an in-memory HDF5 file is
+                used, such that results of analyses are discarded at the end.
+        """
+        fields, attrs = read_raw_header(fn)
+        dtype = np.dtype([(key, fdtype, shape) for key, fdtype, shape in fields])
+        nframe = (os.path.getsize(fn) - RAW_HEADER_SIZE)/dtype.itemsize
+        if nframe > 0:
+            records = np.memmap(fn, dtype, 'r', RAW_HEADER_SIZE, (nframe,))
+        else:
+            records = np.zeros(0, dtype)
+        datasets = dict((key, RawDataset(records[key])) for key in dtype.names)
+        self.fn = fn
+        self.records = records
+        self.trajectory = RawGroup(datasets, attrs)
+        if f is None:
+            import h5py as h5
+            f = h5.File('yaff.sampling.io.RawTrajectoryFile.%i.h5' % id(self),
+                        'w', driver='core', backing_store=False)
+        self.f = f
+
+    def _split(self, path):
+        path = path.strip('/')
+        if path == 'trajectory':
+            return path, None
+        elif path.startswith('trajectory/'):
+            key = path[11:]
+            if key in self.trajectory:
+                return path, key
+        return path, False
+
+    def __contains__(self, path):
+        path, key = self._split(path)
+        if key is False:
+            return path in self.f
+        return True
+
+    def __getitem__(self, path):
+        path, key = self._split(path)
+        if key is None:
+            return self.trajectory
+        elif key is False:
+            return self.f[path]
+        return self.trajectory[key]
+
+    def __delitem__(self, path):
+        path, key = self._split(path)
+        if key is not False:
+            raise TypeError('The raw trajectory is read-only.')
+        del self.f[path]
+
+    def create_group(self, path):
+        path, key = self._split(path)
+        if key is not False:
+            raise TypeError('The raw trajectory is read-only.')
+        return self.f.create_group(path)
+
+    def close(self):
+        self.f.close()
+
+
+def raw_to_hdf5(fn, f, block_size=1000, **kwargs):
+    '''Convert a raw trajectory into the HDF5 layout of HDF5Writer
+
+       **Arguments:**
+
+       fn
+            The filename of the raw trajectory.
+
+       f
+            An h5.File instance. The trajectory group may not exist yet.
+
+       **Optional arguments:**
+
+       block_size
+            The number of frames copied at once.
+
+       All other keyword arguments are passed on to
+       ``h5py.Group.create_dataset``, e.g. compression='gzip'.
+    '''
+    raw = RawTrajectoryFile(fn)
+    try:
+        tgrp = f.create_group('trajectory')
+        for name, value in raw.trajectory.attrs.iteritems():
+            tgrp.attrs[name] = value
+        for key, ds_raw in raw.trajectory.iteritems():
+            ds = tgrp.create_dataset(
+                key, ds_raw.shape, maxshape=(None,) + ds_raw.shape[1:],
+                dtype=ds_raw.dtype, **kwargs)
+            for begin in xrange(0, ds_raw.shape[0], block_size):
+                end = min(begin + block_size, ds_raw.shape[0])
+                ds[begin:end] = ds_raw[begin:end]
+    finally:
+        raw.close()
 
 
 class XYZWriter(Hook):
-    def __init__(self, fn_xyz, select=None, start=0, step=1):
+    needs_vtens = False
+
+    def __init__(self, fn_xyz, select=None, start=0, step=1, background=False,
+                 queue_size=4):
         """
            **Argument:**
 
@@ -109,10 +772,21 @@ class XYZWriter(Hook):
 
            step
                 The hook will be called every `step` iterations.
+
+           background
+                When True, the frames are written by a BackgroundWriter
+                thread.
+
+           queue_size
+                The maximum number of frames waiting to be written by the
+                background thread.
         """
         self.fn_xyz = fn_xyz
         self.select = select
         self.xyz_writer = None
+        self.background = background
+        self.queue_size = queue_size
+        self._writer = None
         Hook.__init__(self, start, step)
 
     def __call__(self, iterative):
@@ -133,11 +807,27 @@ class XYZWriter(Hook):
             pos = iterative.ff.system.pos
         else:
             pos = iterative.ff.system.pos[self.select]
-        self.xyz_writer.dump(title, pos)
+        if self.background:
+            if self._writer is None:
+                self._writer = BackgroundWriter(self._write_frame, self.queue_size)
+            self._writer.put((title, pos.copy()))
+        else:
+            self.xyz_writer.dump(title, pos)
+
+    def _write_frame(self, frame):
+        self.xyz_writer.dump(*frame)
 
+    def finalize(self, iterative):
+        if self._writer is not None:
+            writer = self._writer
+            self._writer = None
+            writer.close()
 
-class RestartWriter(Hook):
-    def __init__(self, f, start=0, step=1000):
+
+class RestartWriter(HDF5Writer):
+    needs_vtens = False
+
+    def __init__(self, f, start=0, step=1000, background=False, queue_size=4):
         """
             **Argument:**
 
@@ -151,11 +841,14 @@ class RestartWriter(Hook):
 
             step
                 The hook will be called every `step` iterations.
+
+            background, queue_size
+                See HDF5Writer.
         """
-        self.f = f
         self.state = None
         self.default_state = None
-        Hook.__init__(self, start, step)
+        HDF5Writer.__init__(self, f, start, step, background=background,
+                            queue_size=queue_size)
 
     def init_state(self, iterative):
         # Basic properties needed for the restart
@@ -206,44 +899,8 @@ class RestartWriter(Hook):
         self.state_list = [state_item.copy() for state_item in self.default_state]
         self.state = dict((item.key, item) for item in self.state_list)
 
-
-    def __call__(self, iterative):
-        if 'system' not in self.f:
-            self.dump_system(iterative.ff.system)
-        if 'trajectory' not in self.f:
-            self.init_trajectory(iterative)
-        tgrp = self.f['trajectory']
-        # determine the row to write the current iteration to. If a previous
-        # iterations was not completely written, then the last row is reused.
-        row = min(tgrp[key].shape[0] for key in self.state if key in tgrp.keys())
-        for key, item in self.state.iteritems():
-            if item.value is None:
-                continue
-            if len(item.shape) > 0 and min(item.shape) == 0:
-                continue
-            if item.dtype is type(None):
-                continue
-            ds = tgrp[key]
-            if ds.shape[0] <= row:
-                # do not over-allocate. hdf5 works with chunks internally.
-                ds.resize(row+1, axis=0)
-            ds[row] = item.value
-
-    def dump_system(self, system):
-        system.to_hdf5(self.f)
-
-    def init_trajectory(self, iterative):
-        tgrp = self.f.create_group('trajectory')
-        for key, item in self.state.iteritems():
-            if len(item.shape) > 0 and min(item.shape) == 0:
-                continue
-            if item.dtype is type(None):
-                continue
-            maxshape = (None,) + item.shape
-            shape = (0,) + item.shape
-            dset = tgrp.create_dataset(key, shape, maxshape=maxshape, dtype=item.dtype)
-            for name, value in item.iter_attrs(iterative):
-               tgrp.attrs[name] = value
+    def get_state(self, iterative):
+        return self.state
 
     def dump_restart(self, hook):
         rgrp = self.f['/restart']
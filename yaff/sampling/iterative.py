@@ -24,12 +24,10 @@
 '''Base class for iterative algorithms'''
 
 
-import numpy as np
+import numpy as np, sys, weakref
 
 from molmod.units import *
 
-from yaff import *
-
 from yaff.log import log, timer
 from yaff.pes.ff import ForcePartValence, ForcePartPair
 from yaff.pes.ext import PairPotEI
@@ -117,20 +115,78 @@ class Iterative(object):
 
     def run(self, nstep=None):
         with log.section(self.log_name), timer.section(self.log_name):
-            if nstep is None:
-                while True:
-                    if self.propagate():
-                        break
-            else:
-                for i in xrange(nstep):
-                    if self.propagate():
-                        break
+            try:
+                if nstep is None:
+                    while True:
+                        if self.propagate():
+                            break
+                else:
+                    istep = 0
+                    while istep < nstep:
+                        # Steps in which no hooks are called may be taken in
+                        # one go by the subclass, see propagate_quiet.
+                        nquiet = self.get_quiet_steps(nstep - istep)
+                        if nquiet > 0:
+                            self.propagate_quiet(nquiet)
+                            istep += nquiet
+                        else:
+                            if self.propagate():
+                                break
+                            istep += 1
+            except:
+                # Buffered output is still written and background threads are
+                # stopped before the exception is passed on.
+                exc_info = sys.exc_info()
+                try:
+                    self._finalize_all()
+                except Exception:
+                    if log.do_warning:
+                        log.warn('Finalizing the hooks failed after an earlier error.')
+                raise exc_info[0], exc_info[1], exc_info[2]
+            self._finalize_all()
+
+    def _finalize_all(self):
+        # Finalize the algorithm and all hooks, also when one of them fails.
+        # The first exception is raised afterwards.
+        exc_info = None
+        try:
             self.finalize()
+        except Exception:
+            exc_info = sys.exc_info()
+        for hook in self.hooks:
+            try:
+                hook.finalize(self)
+            except Exception:
+                if exc_info is None:
+                    exc_info = sys.exc_info()
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
 
     def propagate(self):
         self.counter += 1
         self.call_hooks()
 
+    def get_quiet_steps(self, nmax):
+        '''Return the number of upcoming steps in which no hooks are called
+
+           **Arguments:**
+
+           nmax
+                The maximum number of steps.
+
+           Subclasses that implement ``propagate_quiet`` override this method.
+           By default, all steps are taken with ``propagate``.
+        '''
+        return 0
+
+    def propagate_quiet(self, nstep):
+        '''Take nstep steps without calling any hooks
+
+           This is only called for steps counted by ``get_quiet_steps``, which
+           must not end the iterative algorithm.
+        '''
+        raise NotImplementedError
+
     def finalize():
         raise NotImplementedError
 
@@ -138,18 +194,60 @@ class Iterative(object):
 class StateItem(object):
     def __init__(self, key):
         self.key = key
-        self.shape = None
-        self.dtype = None
+        self._shape = None
+        self._dtype = None
+        self._value = None
+        self._iterative = None
+        self._uptodate = False
 
     def update(self, iterative):
-        self.value = self.get_value(iterative)
-        if self.shape is None:
-            if isinstance(self.value, np.ndarray):
-                self.shape = self.value.shape
-                self.dtype = self.value.dtype
-            else:
-                self.shape = tuple([])
-                self.dtype = type(self.value)
+        """Mark the value as outdated.
+
+           The value is only recomputed when it is used, such that hooks only
+           pay for the state items they actually read.
+        """
+        # A weak reference avoids a reference cycle with the iterative.
+        self._iterative = weakref.ref(iterative)
+        self._uptodate = False
+
+    def _get_value(self):
+        if not self._uptodate and self._iterative is not None:
+            self._value = self.get_value(self._iterative())
+            self._uptodate = True
+            if self._shape is None:
+                if isinstance(self._value, np.ndarray):
+                    self._shape = self._value.shape
+                    self._dtype = self._value.dtype
+                else:
+                    self._shape = tuple([])
+                    self._dtype = type(self._value)
+        return self._value
+
+    def _set_value(self, value):
+        self._value = value
+        self._uptodate = True
+
+    value = property(_get_value, _set_value)
+
+    def _get_shape(self):
+        if self._shape is None:
+            self._get_value()
+        return self._shape
+
+    def _set_shape(self, shape):
+        self._shape = shape
+
+    shape = property(_get_shape, _set_shape)
+
+    def _get_dtype(self):
+        if self._shape is None:
+            self._get_value()
+        return self._dtype
+
+    def _set_dtype(self, dtype):
+        self._dtype = dtype
+
+    dtype = property(_get_dtype, _set_dtype)
 
     def get_value(self, iterative):
         raise NotImplementedError
@@ -378,6 +476,11 @@ class Hook(object):
     name = None
     kind = None
     method = None
+    # When True, the virial tensor is computed together with the forces in
+    # the steps where the hook is called. Hooks that do not use the keys in
+    # vtens_keys may set this to False to avoid this extra work.
+    needs_vtens = True
+    vtens_keys = frozenset(['vtens', 'ptens', 'press'])
     def __init__(self, start=0, step=1):
         """
            **Optional arguments:**
@@ -394,5 +497,27 @@ class Hook(object):
     def expects_call(self, counter):
         return counter >= self.start and (counter - self.start) % self.step == 0
 
+    def get_next_call(self, counter):
+        '''Return the first iteration, not before counter, with a call
+
+           None is returned when the hook will not be called. When a subclass
+           overrides ``expects_call`` but not this method, the next call
+           cannot be predicted and counter is returned, which disables the
+           quiet steps of ``Iterative.run`` while this hook is present.
+        '''
+        if self.expects_call.__func__ is not Hook.expects_call.__func__:
+            return counter
+        return self._get_next_regular_call(counter)
+
+    def _get_next_regular_call(self, counter):
+        '''The first iteration, not before counter, according to start and step'''
+        if counter <= self.start:
+            return self.start
+        return counter + (self.start - counter) % self.step
+
     def __call__(self, iterative):
         raise NotImplementedError
+
+    def finalize(self, iterative):
+        """Called at the end of ``Iterative.run``, e.g. to write buffered output."""
+        pass
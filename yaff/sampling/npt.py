@@ -132,6 +132,10 @@ class TBCombination(VerletHook):
                 baro_ndof = self.barostat.baro_ndof
                 self.econs_correction += baro_ndof*kt*self.thermostat.chain.pos[0]
 
+    @property
+    def needs_vtens(self):
+        return self.barostat.needs_vtens
+
     def expectscall(self, iterative, kind):
         # returns whether the thermostat/barostat should be called in this iteration
         if kind == 'thermo':
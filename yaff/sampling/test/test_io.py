@@ -0,0 +1,443 @@
+# -*- coding: utf-8 -*-
+# YAFF is yet another force-field code
+# Copyright (C) 2011 - 2013 Toon Verstraelen <Toon.Verstraelen@UGent.be>,
+# Louis Vanduyfhuys <Louis.Vanduyfhuys@UGent.be>, Center for Molecular Modeling
+# (CMM), Ghent University, Ghent, Belgium; all rights reserved unless otherwise
+# stated.
+#
+# This file is part of YAFF.
+#
+# YAFF is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# YAFF is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+
+
+import tempfile, shutil, h5py as h5, numpy as np
+
+from yaff import *
+from yaff.sampling.test.common import get_ff_water32
+
+
+def get_h5(name):
+    return h5.File('yaff.sampling.test.test_io.%s.h5' % name, driver='core', backing_store=False)
+
+
+def compare_trajectories(tgrp0, tgrp1):
+    assert sorted(tgrp0) == sorted(tgrp1)
+    for key in tgrp0:
+        assert tgrp0[key].shape == tgrp1[key].shape
+        np.testing.assert_equal(tgrp0[key][:], tgrp1[key][:])
+
+
+def test_hdf5_buffered():
+    f0 = get_h5('test_hdf5_buffered0')
+    f1 = get_h5('test_hdf5_buffered1')
+    try:
+        hdf50 = HDF5Writer(f0)
+        hdf51 = HDF5Writer(f1, buffer_size=4, compression='gzip', flush_interval=8)
+        nve = VerletIntegrator(get_ff_water32(), 1.0*femtosecond, hooks=[hdf50, hdf51])
+        # Before the run, only the initial state is in the buffer.
+        assert f1['trajectory/pos'].shape[0] == 0
+        nve.run(9)
+        assert f1['trajectory/pos'].chunks == (4, 96, 3)
+        assert f1['trajectory/pos'].compression == 'gzip'
+        # After the run, the remainder of the buffer is written too.
+        assert f1['trajectory/pos'].shape[0] == 10
+        compare_trajectories(f0['trajectory'], f1['trajectory'])
+        # Continue with a second run
+        nve.run(2)
+        compare_trajectories(f0['trajectory'], f1['trajectory'])
+        assert f1['trajectory/counter'][-1] == 11
+    finally:
+        f0.close()
+        f1.close()
+
+
+def test_hdf5_chunk_size():
+    f = get_h5('test_hdf5_chunk_size')
+    try:
+        hdf5 = HDF5Writer(f, step=2, chunk_size=16)
+        nve = VerletIntegrator(get_ff_water32(), 1.0*femtosecond, hooks=hdf5)
+        nve.run(4)
+        assert f['trajectory/pos'].chunks == (16, 96, 3)
+        assert f['trajectory/epot'].chunks == (16,)
+        np.testing.assert_equal(f['trajectory/counter'][:], [0, 2, 4])
+    finally:
+        f.close()
+
+
+def test_restart_writer():
+    f = get_h5('test_restart_writer')
+    try:
+        restart = RestartWriter(f, step=2)
+        nve0 = VerletIntegrator(get_ff_water32(), 1.0*femtosecond, hooks=restart)
+        nve0.run(4)
+        assert f['restart/timestep'][()] == 1.0*femtosecond
+        np.testing.assert_equal(f['trajectory/counter'][:], [2, 4])
+        for key in 'time', 'pos', 'vel', 'cell', 'econs', 'ekin_sum':
+            assert f['trajectory/%s' % key].shape[0] == 2
+        np.testing.assert_equal(f['trajectory/pos'][-1], nve0.pos)
+        np.testing.assert_equal(f['trajectory/vel'][-1], nve0.vel)
+    finally:
+        f.close()
+
+
+def test_hdf5_background():
+    f0 = get_h5('test_hdf5_background0')
+    f1 = get_h5('test_hdf5_background1')
+    try:
+        hdf50 = HDF5Writer(f0)
+        hdf51 = HDF5Writer(f1, buffer_size=3, background=True, queue_size=1)
+        nve = VerletIntegrator(get_ff_water32(), 1.0*femtosecond, hooks=[hdf50, hdf51])
+        nve.run(10)
+        # The writer thread is stopped at the end of the run.
+        assert hdf51._writer is None
+        compare_trajectories(f0['trajectory'], f1['trajectory'])
+        nve.run(2)
+        compare_trajectories(f0['trajectory'], f1['trajectory'])
+    finally:
+        f0.close()
+        f1.close()
+
+
+class FailingHook(Hook):
+    def __init__(self, counter):
+        self.counter = counter
+        Hook.__init__(self)
+
+    def __call__(self, iterative):
+        if iterative.counter == self.counter:
+            raise RuntimeError('Failing on purpose')
+
+
+def test_finalize_after_error():
+    dn = tempfile.mkdtemp('yaff', 'test_finalize_after_error')
+    f = get_h5('test_finalize_after_error')
+    try:
+        fn_raw = '%s/traj.raw' % dn
+        hdf5 = HDF5Writer(f, buffer_size=5, background=True)
+        raw = RawWriter(fn_raw, buffer_size=5)
+        nve = VerletIntegrator(get_ff_water32(), 1.0*femtosecond, hooks=[hdf5, raw, FailingHook(7)])
+        try:
+            nve.run(10)
+            assert False
+        except RuntimeError:
+            pass
+        # The buffered frames up to the failing iteration are written and the
+        # writer thread is stopped.
+        assert hdf5._writer is None
+        np.testing.assert_equal(f['trajectory/counter'][:], np.arange(8))
+        np.testing.assert_equal(RawTrajectoryFile(fn_raw)['trajectory/counter'][:], np.arange(8))
+        raw.close()
+    finally:
+        shutil.rmtree(dn)
+        f.close()
+
+
+def test_xyz_background():
+    from molmod.io import XYZFile
+    dn = tempfile.mkdtemp('yaff', 'test_xyz_background')
+    try:
+        xyz0 = XYZWriter('%s/traj0.xyz' % dn)
+        xyz1 = XYZWriter('%s/traj1.xyz' % dn, select=[1, 2, 5], background=True)
+        nve = VerletIntegrator(get_ff_water32(), 1.0*femtosecond, hooks=[xyz0, xyz1])
+        nve.run(5)
+        assert xyz1._writer is None
+        del xyz0, xyz1, nve
+        geometries0 = XYZFile('%s/traj0.xyz' % dn).geometries
+        geometries1 = XYZFile('%s/traj1.xyz' % dn).geometries
+        assert geometries1.shape == (6, 3, 3)
+        np.testing.assert_equal(geometries0[:,[1, 2, 5]], geometries1)
+    finally:
+        shutil.rmtree(dn)
+
+
+def test_background_writer_backpressure():
+    import threading
+    event = threading.Event()
+    written = []
+    def write(item):
+        event.wait()
+        written.append(item)
+    bw = BackgroundWriter(write, queue_size=2)
+    bw.put(0)
+    bw.put(1)
+    bw.put(2)
+    # The first item is being written, the other two fill up the queue.
+    assert bw.queue.full()
+    event.set()
+    bw.close()
+    assert written == [0, 1, 2]
+    assert not bw.thread.is_alive()
+
+
+def test_background_writer_error():
+    def write(item):
+        if item == 1:
+            raise IOError('Disk full.')
+    bw = BackgroundWriter(write)
+    bw.put(0)
+    bw.put(1)
+    bw.put(2)
+    try:
+        bw.close()
+        assert False
+    except IOError, e:
+        assert str(e) == 'Disk full.'
+    assert not bw.thread.is_alive()
+
+
+def test_hdf5_background_error():
+    f = get_h5('test_hdf5_background_error')
+    try:
+        hdf5 = HDF5Writer(f, background=True)
+        nve = VerletIntegrator(get_ff_water32(), 1.0*femtosecond, hooks=hdf5)
+        # Sabotage the trajectory, such that the next write fails.
+        del f['trajectory/pos']
+        try:
+            nve.run(3)
+            assert False
+        except KeyError:
+            pass
+    finally:
+        f.close()
+
+
+def test_hdf5_strides_subsets():
+    f0 = get_h5('test_hdf5_strides_subsets0')
+    f1 = get_h5('test_hdf5_strides_subsets1')
+    try:
+        iguest = np.array([3, 4, 5, 90])
+        hdf50 = HDF5Writer(f0)
+        hdf51 = HDF5Writer(
+            f1, buffer_size=3, keys=['counter', 'time', 'epot', 'pos', 'vel'],
+            strides={'pos': 4, 'vel': 4, 'vel_guest': 2},
+            subsets={'pos_guest': ('pos', iguest), 'vel_guest': ('vel', iguest)},
+        )
+        nve = VerletIntegrator(get_ff_water32(), 1.0*femtosecond, hooks=[hdf50, hdf51])
+        nve.run(9)
+        tgrp0 = f0['trajectory']
+        tgrp1 = f1['trajectory']
+        assert sorted(tgrp1) == [
+            'counter', 'epot', 'pos', 'pos_counter', 'pos_guest', 'pos_time',
+            'time', 'vel', 'vel_counter', 'vel_guest', 'vel_guest_counter',
+            'vel_guest_time', 'vel_time']
+        for key in 'counter', 'time', 'epot':
+            np.testing.assert_equal(tgrp0[key][:], tgrp1[key][:])
+        np.testing.assert_equal(tgrp1['pos_counter'][:], [0, 4, 8])
+        np.testing.assert_equal(tgrp1['pos_time'][:], tgrp0['time'][::4])
+        np.testing.assert_equal(tgrp1['pos'][:], tgrp0['pos'][::4])
+        np.testing.assert_equal(tgrp1['vel'][:], tgrp0['vel'][::4])
+        np.testing.assert_equal(tgrp1['pos_guest'][:], tgrp0['pos'][:,iguest])
+        np.testing.assert_equal(tgrp1['pos_guest'].attrs['indexes'], iguest)
+        np.testing.assert_equal(tgrp1['vel_guest_counter'][:], [0, 2, 4, 6, 8])
+        np.testing.assert_equal(tgrp1['vel_guest'][:], tgrp0['vel'][::2,iguest])
+        assert tgrp1['vel'].attrs['stride'] == 4
+        assert tgrp1['vel_time'].attrs['stride'] == 4
+        # Only the datasets written at every step determine the slice
+        from yaff.analysis.utils import get_slice
+        assert get_slice(f1, 0, -1, step=1) == (0, 10, 1)
+    finally:
+        f0.close()
+        f1.close()
+
+
+def test_hdf5_subset_replace():
+    f = get_h5('test_hdf5_subset_replace')
+    try:
+        hdf5 = HDF5Writer(f, keys=['pos'], subsets={'pos': ('pos', [0, 1, 2])})
+        nve = VerletIntegrator(get_ff_water32(), 1.0*femtosecond, hooks=hdf5)
+        nve.run(2)
+        assert list(f['trajectory']) == ['pos']
+        assert f['trajectory/pos'].shape == (3, 3, 3)
+        np.testing.assert_equal(f['trajectory/pos'][-1], nve.pos[:3])
+    finally:
+        f.close()
+
+
+def test_hdf5_strides_error():
+    f = get_h5('test_hdf5_strides_error')
+    try:
+        try:
+            HDF5Writer(f, step=2, strides={'pos': 3})
+            assert False
+        except ValueError:
+            pass
+        hdf5 = HDF5Writer(f, subsets={'foo': ('bar', [0])})
+        try:
+            VerletIntegrator(get_ff_water32(), 1.0*femtosecond, hooks=hdf5)
+            assert False
+        except ValueError:
+            pass
+    finally:
+        f.close()
+
+
+def test_scaleoffset_digits():
+    from yaff.sampling.io import get_scaleoffset_digits
+    assert get_scaleoffset_digits(0.5) == 0
+    assert get_scaleoffset_digits(0.05) == 1
+    assert get_scaleoffset_digits(0.04) == 2
+    assert get_scaleoffset_digits(1e-4) == 4
+    assert get_scaleoffset_digits(4e-5) == 5
+
+
+def test_hdf5_tolerances():
+    f0 = get_h5('test_hdf5_tolerances0')
+    f1 = get_h5('test_hdf5_tolerances1')
+    try:
+        tolerances = {'pos': 1e-4, 'vel': 1e-7, 'pos_guest': 1e-6}
+        hdf50 = HDF5Writer(f0)
+        hdf51 = HDF5Writer(f1, buffer_size=4, tolerances=tolerances,
+                           subsets={'pos_guest': ('pos', [0, 1, 2])})
+        nve = VerletIntegrator(get_ff_water32(), 1.0*femtosecond, hooks=[hdf50, hdf51])
+        nve.run(10)
+        tgrp0 = f0['trajectory']
+        tgrp1 = f1['trajectory']
+        for key, tolerance in tolerances.iteritems():
+            ds = tgrp1[key]
+            assert ds.scaleoffset is not None
+            assert ds.shuffle
+            assert ds.compression == 'gzip'
+            assert ds.dtype == float
+            assert ds.attrs['tolerance'] == tolerance
+            error = abs(ds[:] - tgrp0[key[:3]][:,:ds.shape[1]]).max()
+            assert error <= tolerance
+            assert error > 0
+        assert tgrp1['cell'].scaleoffset is None
+        np.testing.assert_equal(tgrp0['cell'][:], tgrp1['cell'][:])
+    finally:
+        f0.close()
+        f1.close()
+
+
+def test_hdf5_tolerances_error():
+    f = get_h5('test_hdf5_tolerances_error')
+    try:
+        try:
+            HDF5Writer(f, tolerances={'pos': 0.0})
+            assert False
+        except ValueError:
+            pass
+        hdf5 = HDF5Writer(f, tolerances={'counter': 1.0})
+        try:
+            VerletIntegrator(get_ff_water32(), 1.0*femtosecond, hooks=hdf5)
+            assert False
+        except TypeError:
+            pass
+    finally:
+        f.close()
+
+
+def test_hdf5_tolerances_reftrajectory():
+    dn = tempfile.mkdtemp('yaff', 'test_hdf5_tolerances_reftrajectory')
+    try:
+        fn_h5 = '%s/traj.h5' % dn
+        with h5.File(fn_h5, 'w') as f:
+            hdf5 = HDF5Writer(f, tolerances={'pos': 1e-6})
+            nve = VerletIntegrator(get_ff_water32(), 1.0*femtosecond, hooks=hdf5)
+            nve.run(4)
+            epot0 = f['trajectory/epot'][:]
+        # The energies recomputed from the compressed positions should match
+        # up to the tolerance times the largest force.
+        f = get_h5('test_hdf5_tolerances_reftrajectory')
+        try:
+            ref = RefTrajectory(get_ff_water32(), fn_h5, hooks=HDF5Writer(f))
+            ref.run()
+            epot1 = f['trajectory/epot'][:]
+            assert abs(epot0 - epot1).max() < 1e-4
+        finally:
+            f.close()
+    finally:
+        shutil.rmtree(dn)
+
+
+def test_raw():
+    dn = tempfile.mkdtemp('yaff', 'test_raw')
+    f0 = get_h5('test_raw0')
+    f1 = get_h5('test_raw1')
+    try:
+        fn_raw = '%s/traj.raw' % dn
+        hdf5 = HDF5Writer(f0)
+        raw = RawWriter(fn_raw, buffer_size=3)
+        nve = VerletIntegrator(get_ff_water32(), 1.0*femtosecond, hooks=[hdf5, raw])
+        nve.run(4)
+        # The frames are written by finalize at the end of the run.
+        assert len(RawTrajectoryFile(fn_raw)['trajectory/pos']) == 5
+        # A partially written frame is ignored by the reader
+        nve.run(2)
+        with open(fn_raw, 'ab') as f:
+            f.write('\x00'*100)
+        traj = RawTrajectoryFile(fn_raw)
+        assert traj['trajectory'].attrs['ndof'] == f0['trajectory'].attrs['ndof']
+        compare_trajectories(f0['trajectory'], traj['trajectory'])
+        # and is overwritten by a new writer
+        raw.close()
+        raw = RawWriter(fn_raw)
+        nve.hooks.append(raw)
+        nve.run(3)
+        raw.close()
+        # convert to hdf5
+        raw_to_hdf5(fn_raw, f1, block_size=4, compression='gzip')
+        assert f1['trajectory/pos'].compression == 'gzip'
+        assert f1['trajectory'].attrs['ndof'] == f0['trajectory'].attrs['ndof']
+        compare_trajectories(f0['trajectory'], f1['trajectory'])
+    finally:
+        shutil.rmtree(dn)
+        f0.close()
+        f1.close()
+
+
+def test_raw_keys():
+    dn = tempfile.mkdtemp('yaff', 'test_raw_keys')
+    try:
+        fn_raw = '%s/traj.raw' % dn
+        raw = RawWriter(fn_raw, keys=['counter', 'pos'])
+        nve = VerletIntegrator(get_ff_water32(), 1.0*femtosecond, hooks=raw)
+        nve.run(2)
+        raw.close()
+        fields, attrs = read_raw_header(fn_raw)
+        assert fields == [('counter', np.dtype(int), ()), ('pos', np.dtype(float), (96, 3))]
+        assert attrs == {}
+        traj = RawTrajectoryFile(fn_raw)
+        assert 'trajectory/pos' in traj
+        assert 'trajectory/vel' not in traj
+        np.testing.assert_equal(traj['trajectory/counter'][:], [0, 1, 2])
+        pos = np.zeros((2, 96, 3))
+        traj['trajectory/pos'].read_direct(pos, (slice(1, 3),))
+        np.testing.assert_equal(pos[-1], nve.pos)
+        # Appending requires the same fields
+        raw = RawWriter(fn_raw, keys=['pos'])
+        try:
+            VerletIntegrator(get_ff_water32(), 1.0*femtosecond, hooks=raw)
+            assert False
+        except ValueError:
+            pass
+    finally:
+        shutil.rmtree(dn)
+
+
+def test_raw_not_raw():
+    dn = tempfile.mkdtemp('yaff', 'test_raw_not_raw')
+    try:
+        fn_raw = '%s/traj.raw' % dn
+        with open(fn_raw, 'w') as f:
+            f.write('foo')
+        try:
+            RawTrajectoryFile(fn_raw)
+            assert False
+        except IOError:
+            pass
+    finally:
+        shutil.rmtree(dn)
@@ -147,3 +147,171 @@ def test_kinetic_annealing():
     nve = VerletIntegrator(get_ff_water32(), 1.0*femtosecond, hooks=KineticAnnealing())
     nve.run(5)
     assert nve.counter == 5
+
+
+class CountingStateItem(StateItem):
+    def __init__(self):
+        StateItem.__init__(self, 'counting')
+        self.ncall = 0
+
+    def get_value(self, iterative):
+        self.ncall += 1
+        return iterative.counter
+
+
+class ReadHook(Hook):
+    def __init__(self, key, start=0, step=1):
+        self.key = key
+        self.values = []
+        Hook.__init__(self, start, step)
+
+    def __call__(self, iterative):
+        self.values.append(iterative.state[self.key].value)
+
+
+def test_lazy_state_items():
+    item = CountingStateItem()
+    hook0 = ReadHook('epot')
+    hook1 = ReadHook('counting', step=3)
+    nve = VerletIntegrator(get_ff_water32(), 1.0*femtosecond, state=[item], hooks=[hook0, hook1])
+    nve.run(7)
+    # Only evaluated when it is read
+    assert item.ncall == 3
+    assert hook1.values == [0, 3, 6]
+    assert len(hook0.values) == 8
+
+
+def test_lazy_properties():
+    ff = get_ff_water32()
+    nve = VerletIntegrator(ff, 1.0*femtosecond)
+    nve.run(2)
+    pos1 = nve.pos.copy()
+    nve.run(1)
+    np.testing.assert_allclose(nve.delta, nve.pos - pos1)
+    assert abs(nve.rmsd_delta - np.sqrt(((nve.pos - pos1)**2).mean())) < 1e-12
+    assert abs(nve.rmsd_gpos - np.sqrt((nve.gpos**2).mean())) < 1e-12
+    assert abs(nve.temp - nve.ekin/nve.ndof*2.0/boltzmann) < 1e-10
+    assert abs(nve.etot - nve.ekin - nve.epot) < 1e-12
+    ptens = (np.dot(nve.vel.T*nve.masses, nve.vel) - nve.vtens)/ff.system.cell.volume
+    np.testing.assert_allclose(nve.ptens, ptens)
+    assert abs(nve.press - np.trace(ptens)/3) < 1e-15
+    assert nve.cons_err > 0
+    # The cached values are reset by the next step
+    nve.run(1)
+    assert abs(nve.rmsd_gpos - np.sqrt((nve.gpos**2).mean())) < 1e-12
+    np.testing.assert_allclose(nve.delta, nve.pos - nve.posoud)
+
+
+
+class ShiftHook(VerletHook):
+    '''Moves all atoms before each step, like a barostat rescaling'''
+    method = 'thermostat'
+
+    def init(self, iterative):
+        pass
+
+    def pre(self, iterative):
+        iterative.pos += 0.1*angstrom
+
+    def post(self, iterative):
+        pass
+
+
+def test_delta_pre_hook():
+    nve = VerletIntegrator(get_ff_water32(), 1.0*femtosecond, hooks=[ShiftHook()])
+    nve.run(2)
+    pos1 = nve.pos.copy()
+    nve.run(1)
+    # The displacement includes the changes made by the pre hook
+    np.testing.assert_allclose(nve.delta, nve.pos - pos1)
+    assert abs(nve.rmsd_delta - np.sqrt(((nve.pos - pos1)**2).mean())) < 1e-12
+    assert nve.rmsd_delta > 0.1*angstrom/2
+
+def test_vtens_on_demand():
+    # Reference with the virial tensor in every step
+    ff = get_ff_water32()
+    ff.system.set_standard_masses()
+    vel0 = get_random_vel(300, True, ff.system.masses)
+    hook_ref = ReadHook('vtens')
+    nve = VerletIntegrator(ff, 1.0*femtosecond, vel0=vel0, hooks=[hook_ref])
+    nve.run(6)
+    # Count the force field evaluations with a virial tensor
+    ff = get_ff_water32()
+    compute = ff.compute
+    ncalls = []
+    def counting_compute(gpos=None, vtens=None):
+        ncalls.append(vtens is not None)
+        return compute(gpos, vtens)
+    ff.compute = counting_compute
+    hook = ReadHook('vtens', step=3)
+    xyz = XYZWriter('/dev/null')
+    nve = VerletIntegrator(ff, 1.0*femtosecond, vel0=vel0, hooks=[hook, xyz])
+    nve.run(6)
+    assert ncalls == [True, False, False, True, False, False, True]
+    np.testing.assert_allclose(hook.values[0], hook_ref.values[0])
+    np.testing.assert_allclose(hook.values[1], hook_ref.values[3])
+    np.testing.assert_allclose(hook.values[2], hook_ref.values[6])
+    # Without hooks that need it, the virial is computed when it is used
+    nve.run(1)
+    assert ncalls[-1] is False
+    vtens = nve.vtens.copy()
+    assert ncalls[-1] is True
+    vtens_ref = np.zeros((3, 3), float)
+    compute(None, vtens_ref)
+    np.testing.assert_allclose(vtens, vtens_ref)
+
+
+def test_quiet_steps():
+    ff = get_ff_water32()
+    ff.system.set_standard_masses()
+    vel0 = get_random_vel(300, True, ff.system.masses)
+    # Reference in which a hook is called in every step
+    hook_ref = ReadHook('epot')
+    nve_ref = VerletIntegrator(ff, 1.0*femtosecond, vel0=vel0, hooks=[hook_ref])
+    nve_ref.run(10)
+    # Only a few steps with hooks
+    ff = get_ff_water32()
+    hook = ReadHook('epot', start=2, step=4)
+    nve = VerletIntegrator(ff, 1.0*femtosecond, vel0=vel0, hooks=[hook, VerletScreenLog(step=100)])
+    assert nve.get_quiet_steps(10) == 1
+    assert hook.get_next_call(3) == 6
+    assert hook.get_next_call(6) == 6
+    propagate = nve.propagate
+    counters = []
+    def counting_propagate():
+        counters.append(nve.counter)
+        return propagate()
+    nve.propagate = counting_propagate
+    nve.run(10)
+    assert counters == [1, 5, 9]
+    assert nve.counter == 10
+    assert abs(nve.time - nve_ref.time) < 1e-10
+    np.testing.assert_allclose(hook.values, [hook_ref.values[i] for i in (2, 6, 10)], rtol=1e-10)
+    np.testing.assert_allclose(nve.pos, nve_ref.pos, rtol=1e-10)
+    np.testing.assert_allclose(nve.vel, nve_ref.vel, rtol=1e-10)
+    np.testing.assert_allclose(nve.delta, nve_ref.delta, rtol=1e-8)
+    np.testing.assert_allclose(nve.vtens, nve_ref.vtens, rtol=1e-8)
+    assert abs(nve.econs - nve_ref.econs) < 1e-10
+    assert abs(nve.cons_err - nve_ref.cons_err) < 1e-8
+
+
+class IrregularHook(Hook):
+    '''Overrides expects_call without get_next_call'''
+    def __init__(self):
+        self.calls = []
+        Hook.__init__(self)
+
+    def expects_call(self, counter):
+        return counter in (3, 7, 11)
+
+    def __call__(self, iterative):
+        self.calls.append(iterative.counter)
+
+
+def test_quiet_steps_custom_expects_call():
+    hook = IrregularHook()
+    assert hook.get_next_call(1) == 1
+    nve = VerletIntegrator(get_ff_water32(), 1.0*femtosecond, hooks=[hook, VerletScreenLog(step=100)])
+    assert nve.get_quiet_steps(15) == 0
+    nve.run(15)
+    assert hook.calls == [3, 7, 11]
@@ -93,7 +93,7 @@ class RefTrajectory(Iterative):
                 The counter value associated with the initial state.
         """
         self.traj = h5py.File(fn_traj, 'r')
-        self.nframes = len(self.traj['trajectory/pos'][:])
+        self.nframes = self.traj['trajectory/pos'].shape[0]
         Iterative.__init__(self, ff, state, hooks, counter0)
 
     def _add_default_hooks(self):
@@ -31,6 +31,7 @@ from molmod import boltzmann, kjmol
 from math import factorial as fact
 
 from yaff.log import log, timer
+from yaff.pes.ff import ForceField
 from yaff.sampling.iterative import Iterative, StateItem, AttributeStateItem, \
     PosStateItem, DipoleStateItem, DipoleVelStateItem, VolumeStateItem, \
     CellStateItem, EPotContribStateItem, Hook
@@ -42,6 +43,25 @@ __all__ = [
 ]
 
 
+def _lazy_property(name, doc):
+    """Return a property that is only computed when it is used
+
+       The value is computed with the method ``_compute_<name>`` and cached
+       until the next call to ``compute_properties``, i.e. the next step.
+    """
+    compute = '_compute_' + name
+
+    def getter(self):
+        if name not in self._properties:
+            self._properties[name] = getattr(self, compute)()
+        return self._properties[name]
+
+    def setter(self, value):
+        self._properties[name] = value
+
+    return property(getter, setter, doc=doc)
+
+
 class TemperatureStateItem(StateItem):
     def __init__(self):
         StateItem.__init__(self, 'temp')
@@ -185,8 +205,15 @@ class VerletIntegrator(Iterative):
 
         # Working arrays
         self.gpos = np.zeros(self.pos.shape, float)
-        self.delta = np.zeros(self.pos.shape, float)
-        self.vtens = np.zeros((3, 3), float)
+        self._vtens = np.zeros((3, 3), float)
+        # True when the virial tensor does not correspond to the current
+        # positions and cell vectors, see the vtens property.
+        self._vtens_outdated = True
+        # Properties that are computed when they are used, see _lazy_property
+        self._properties = {}
+        # True when Verlet hooks were called after the last computation of the
+        # kinetic energy
+        self._ekin_outdated = True
 
         # Tracks quality of the conserved quantity
         self._cons_err_tracker = ConsErrTracker(restart_h5)
@@ -312,7 +339,9 @@ class VerletIntegrator(Iterative):
         # Standard initialization of Verlet algorithm
         self.gpos[:] = 0.0
         self.ff.update_pos(self.pos)
-        self.epot = self.ff.compute(self.gpos)
+        self._vtens[:] = 0.0
+        self.epot = self.ff.compute(self.gpos, self._vtens)
+        self._vtens_outdated = False
         self.acc = -self.gpos/self.masses.reshape(-1,1)
         self.posoud = self.pos.copy()
 
@@ -328,6 +357,10 @@ class VerletIntegrator(Iterative):
         Iterative.initialize(self) # Includes calls to conventional hooks
 
     def propagate(self):
+        # Positions at the end of the previous step, for the lazy delta
+        # property. This includes the changes made by the pre hooks below.
+        self.posoud[:] = self.pos
+
         # Allow specialized hooks to modify the state before the regular verlet
         # step.
         self.call_verlet_hooks('pre')
@@ -338,25 +371,118 @@ class VerletIntegrator(Iterative):
         self.pos += self.timestep*self.vel
         self.ff.update_pos(self.pos)
         self.gpos[:] = 0.0
-        self.vtens[:] = 0.0
-        self.epot = self.ff.compute(self.gpos, self.vtens)
+        if self._needs_vtens():
+            self._vtens[:] = 0.0
+            self.epot = self.ff.compute(self.gpos, self._vtens)
+            self._vtens_outdated = False
+        else:
+            # The virial is only computed when it is used, see vtens.
+            self.epot = self.ff.compute(self.gpos)
+            self._vtens_outdated = True
         self.acc = -self.gpos/self.masses.reshape(-1,1)
         self.vel += 0.5*self.acc*self.timestep
         self.ekin = self._compute_ekin()
+        self._ekin_outdated = False
 
         # Allow specialized verlet hooks to modify the state after the step
         self.call_verlet_hooks('post')
 
-        # Calculate the total position change
-        self.posnieuw = self.pos.copy()
-        self.delta[:] = self.posnieuw-self.posoud
-        self.posoud[:] = self.posnieuw
-
         # Common post-processing of a single step
         self.time += self.timestep
         self.compute_properties()
         Iterative.propagate(self) # Includes call to conventional hooks
 
+    def get_quiet_steps(self, nmax):
+        '''See :meth:`yaff.sampling.iterative.Iterative.get_quiet_steps`'''
+        nquiet = nmax
+        for hook in self.hooks:
+            if isinstance(hook, VerletHook):
+                # Verlet hooks are called with the current counter
+                ncall = hook.get_next_call(self.counter)
+                if ncall is not None:
+                    nquiet = min(nquiet, ncall - self.counter)
+            else:
+                ncall = hook.get_next_call(self.counter+1)
+                if ncall is not None:
+                    nquiet = min(nquiet, ncall - self.counter - 1)
+        return nquiet
+
+    def propagate_quiet(self, nstep):
+        '''Take nstep regular Verlet steps without calling any hooks
+
+           This gives the same results as ``propagate``, but the Python
+           overhead per step is kept to a minimum: the forces are computed
+           with ``ForceField.compute_parts``, the virial tensor is not
+           computed and only the conserved quantity is tracked.
+        '''
+        if isinstance(self.ff, ForceField):
+            compute = self.ff.compute_parts
+        else:
+            compute = self.ff.compute
+        masses = self.masses.reshape(-1,1)
+        econs_correction = [hook.econs_correction for hook in self.hooks if isinstance(hook, VerletHook)]
+        pos = self.pos
+        vel = self.vel
+        gpos = self.gpos
+        for istep in xrange(nstep):
+            # Positions at the end of the previous step (no pre hooks here)
+            self.posoud[:] = pos
+            acc = -gpos/masses
+            vel += 0.5*acc*self.timestep
+            pos += self.timestep*vel
+            self.ff.update_pos(pos)
+            gpos[:] = 0.0
+            epot = compute(gpos)
+            acc = -gpos/masses
+            vel += 0.5*acc*self.timestep
+            ekin = 0.5*(vel**2*masses).sum()
+            econs = ekin + epot
+            for correction in econs_correction:
+                econs += correction
+            self._cons_err_tracker.update(ekin, econs)
+            self.time += self.timestep
+        # Same state as after a call to propagate, without the hooks
+        self.acc = acc
+        self.epot = epot
+        self.ekin = ekin
+        self.econs = econs
+        self._ekin_outdated = True
+        self._vtens_outdated = True
+        self._properties = {}
+        self.counter += nstep
+
+    def _needs_vtens(self):
+        '''Return True when a hook uses the virial tensor in the current step
+
+           The Verlet hooks are called with the current counter, the
+           conventional hooks after the counter is incremented.
+        '''
+        for hook in self.hooks:
+            if isinstance(hook, VerletHook):
+                if hook.needs_vtens and hook.expects_call(self.counter):
+                    return True
+            elif hook.needs_vtens and hook.expects_call(self.counter+1):
+                return True
+        return False
+
+    def _get_vtens(self):
+        if self._vtens_outdated:
+            self._vtens[:] = 0.0
+            self.ff.compute(None, self._vtens)
+            self._vtens_outdated = False
+        return self._vtens
+
+    def _set_vtens(self, vtens):
+        self._vtens[:] = vtens
+        self._vtens_outdated = False
+
+    vtens = property(_get_vtens, _set_vtens, doc='''The virial tensor.
+
+        The virial tensor is only computed together with the forces in steps
+        where a hook with ``needs_vtens`` is called. In all other steps, it is
+        computed with an additional force field evaluation when it is used.
+        ''')
+
     def _compute_ekin(self):
         '''Auxiliary routine to compute the kinetic energy
 
@@ -365,12 +491,14 @@ class VerletIntegrator(Iterative):
         return 0.5*(self.vel**2*self.masses.reshape(-1,1)).sum()
 
     def compute_properties(self, restart_h5=None):
-        self.rmsd_gpos = np.sqrt((self.gpos**2).mean())
-        self.rmsd_delta = np.sqrt((self.delta**2).mean())
-        self.ekin = self._compute_ekin()
-        self.temp = self.ekin/self.ndof*2.0/boltzmann
-        self.etot = self.ekin + self.epot
-        self.econs = self.etot
+        # Only the properties needed to track the conserved quantity are
+        # computed at every step. All other properties are computed when they
+        # are used, e.g. by a hook. See _lazy_property.
+        self._properties = {}
+        if self._ekin_outdated:
+            self.ekin = self._compute_ekin()
+        self._ekin_outdated = True
+        self.econs = self.ekin + self.epot
         for hook in self.hooks:
             if isinstance(hook, VerletHook):
                 self.econs += hook.econs_correction
@@ -378,10 +506,41 @@ class VerletIntegrator(Iterative):
             self.econs = restart_h5['trajectory/econs'][-1]
         else:
             self._cons_err_tracker.update(self.ekin, self.econs)
-        self.cons_err = self._cons_err_tracker.get()
+
+    def _compute_delta(self):
+        return self.pos - self.posoud
+
+    def _compute_rmsd_delta(self):
+        return np.sqrt((self.delta**2).mean())
+
+    def _compute_rmsd_gpos(self):
+        return np.sqrt((self.gpos**2).mean())
+
+    def _compute_temp(self):
+        return self.ekin/self.ndof*2.0/boltzmann
+
+    def _compute_etot(self):
+        return self.ekin + self.epot
+
+    def _compute_cons_err(self):
+        return self._cons_err_tracker.get()
+
+    def _compute_ptens(self):
         if self.ff.system.cell.nvec > 0:
-            self.ptens = (np.dot(self.vel.T*self.masses, self.vel) - self.vtens)/self.ff.system.cell.volume
-            self.press = np.trace(self.ptens)/3
+            return (np.dot(self.vel.T*self.masses, self.vel) - self.vtens)/self.ff.system.cell.volume
+
+    def _compute_press(self):
+        if self.ff.system.cell.nvec > 0:
+            return np.trace(self.ptens)/3
+
+    delta = _lazy_property('delta', 'The displacement of the atoms in the last step.')
+    rmsd_delta = _lazy_property('rmsd_delta', 'The root-mean-square displacement in the last step.')
+    rmsd_gpos = _lazy_property('rmsd_gpos', 'The root-mean-square gradient of the energy.')
+    temp = _lazy_property('temp', 'The instantaneous temperature.')
+    etot = _lazy_property('etot', 'The sum of the kinetic and the potential energy.')
+    cons_err = _lazy_property('cons_err', 'The error on the conserved quantity, see ConsErrTracker.')
+    ptens = _lazy_property('ptens', 'The pressure tensor, only for periodic systems.')
+    press = _lazy_property('press', 'The pressure, only for periodic systems.')
 
     def finalize(self):
         if log.do_medium:
@@ -396,6 +555,8 @@ class VerletIntegrator(Iterative):
         with timer.section('%s special hooks' % self.log_name):
             for hook in self.hooks:
                 if isinstance(hook, VerletHook) and hook.expects_call(self.counter):
+                    # The hook may change the velocities.
+                    self._ekin_outdated = True
                     if kind == 'init':
                         hook.init(self)
                     elif kind == 'pre':
@@ -411,6 +572,11 @@ class VerletHook(Hook):
 
        This is mainly used for the implementation of thermostats and barostats.
     '''
+    @property
+    def needs_vtens(self):
+        # Only the barostats use the virial tensor.
+        return self.method == 'barostat'
+
     def __init__(self, start=0, step=1):
         """
            **Optional arguments:**
@@ -439,10 +605,20 @@ class VerletHook(Hook):
 
 class VerletScreenLog(Hook):
     '''A screen logger for the Verlet algorithm'''
+    needs_vtens = False
+
     def __init__(self, start=0, step=1):
         Hook.__init__(self, start, step)
         self.time0 = None
 
+    def expects_call(self, counter):
+        # Nothing is printed at lower log levels.
+        return log.do_medium and Hook.expects_call(self, counter)
+
+    def get_next_call(self, counter):
+        if log.do_medium:
+            return self._get_next_regular_call(counter)
+
     def __call__(self, iterative):
         if log.do_medium:
             if self.time0 is None:
@@ -24,10 +24,10 @@
 '''Representation of a molecular systems'''
 
 
-import numpy as np, h5py as h5
+import numpy as np
 
 from yaff.log import log
-from yaff.atselect import check_name, atsel_compile, iter_matches
+from yaff.atselect import check_name, atsel_compile, iter_bond_matches
 from yaff.pes.ext import Cell
 
 
@@ -45,6 +45,222 @@ def _unravel_triangular(i):
     return i0, i1
 
 
+def _compose_pairs(keys_a, keys_b, natom):
+    """Combine two relations between atoms
+
+       **Arguments:**
+
+       keys_a, keys_b
+            Sorted arrays with pairs of atoms (i, j), encoded as i*natom + j.
+
+       natom
+            The number of atoms.
+
+       **Returns:** a sorted array of unique keys i*natom + k for which there is
+       a j such that (i, j) is in keys_a and (j, k) is in keys_b.
+    """
+    ia, ja = np.divmod(keys_a, natom)
+    ib, kb = np.divmod(keys_b, natom)
+    starts = np.searchsorted(ib, np.arange(natom + 1))
+    counts = starts[ja + 1] - starts[ja]
+    offsets = np.cumsum(counts) - counts
+    indexes = np.arange(counts.sum()) + np.repeat(starts[ja] - offsets, counts)
+    return np.unique(np.repeat(ia, counts)*natom + kb[indexes])
+
+
+def _filter_pairs(keys, natom, excluded):
+    """Remove diagonal pairs and pairs in one of the excluded relations
+
+       The result is made symmetric, i.e. for each (i, j) also (j, i) is
+       included.
+    """
+    i, j = np.divmod(keys, natom)
+    mask = i != j
+    for other in excluded:
+        mask &= ~np.in1d(keys, other, assume_unique=True)
+    return np.union1d(keys[mask], j[mask]*natom + i[mask])
+
+
+def _pairs_to_neighs(keys, natom):
+    """Convert an array of pair keys into a dictionary of sets"""
+    i, j = np.divmod(keys, natom)
+    starts = np.searchsorted(i, np.arange(natom + 1)).tolist()
+    j = j.tolist()
+    return dict((i0, set(j[starts[i0]:starts[i0+1]])) for i0 in xrange(natom))
+
+
+def _lazy_attribute(name, doc):
+    """Return a property that reads HDF5 datasets into memory on first access
+
+       The ``from_hdf5`` method (with ``lazy=True``) passes h5py datasets to
+       the constructor instead of arrays. These are only converted to numpy
+       arrays when the attribute is used for the first time.
+    """
+    key = '_' + name
+
+    def getter(self):
+        value = getattr(self, key)
+        if hasattr(value, 'read_direct'):
+            array = np.empty(value.shape, value.dtype)
+            if array.size > 0:
+                value.read_direct(array)
+            value = array
+            setattr(self, key, value)
+        return value
+
+    def setter(self, value):
+        setattr(self, key, value)
+
+    return property(getter, setter, doc=doc)
+
+
+def _get_number(symbol):
+    """Convert a symbol or a number from an XYZ file to an atomic number"""
+    from molmod.periodic import periodic
+    try:
+        return int(symbol)
+    except ValueError:
+        atom_info = periodic[symbol]
+        if atom_info is None:
+            return 0
+        return atom_info.number
+
+
+def _load_xyz(fn, block_size=65536):
+    """Load the first frame of an XYZ file
+
+       **Arguments:**
+
+       fn
+            The XYZ file.
+
+       **Optional arguments:**
+
+       block_size
+            The number of lines that are parsed at once.
+
+       **Returns:** numbers, pos (in atomic units)
+
+       This gives the same result as ``molmod.Molecule.from_file``, but the
+       lines are converted in blocks with NumPy, which is a lot faster for
+       big systems.
+    """
+    from molmod.units import angstrom
+    with open(fn) as f:
+        try:
+            natom = int(f.readline())
+        except ValueError:
+            raise IOError('Could not read the number of atoms from \'%s\'.' % fn)
+        f.readline()
+        symbols = np.zeros(natom, object)
+        pos = np.zeros((natom, 3), float)
+        begin = 0
+        while begin < natom:
+            end = min(begin + block_size, natom)
+            lines = [f.readline() for i in xrange(end - begin)]
+            split_lines = [line.split() for line in lines]
+            ncol = len(split_lines[0])
+            if ncol >= 4 and all(len(line_words) == ncol for line_words in split_lines):
+                words = [word for line_words in split_lines for word in line_words]
+            else:
+                # Lines with different numbers of columns, or a truncated file.
+                words = []
+                for line, line_words in zip(lines, split_lines):
+                    if len(line_words) < 4:
+                        raise IOError('Could not read atom line from \'%s\': %s' % (fn, line))
+                    words.extend(line_words[:4])
+                ncol = 4
+            table = np.array(words).reshape(-1, ncol)
+            symbols[begin:end] = table[:,0]
+            try:
+                pos[begin:end] = table[:,1:4].astype(float)
+            except ValueError:
+                raise IOError('Could not read coordinates from \'%s\'.' % fn)
+            begin = end
+    unique_symbols, inverse = np.unique(symbols.astype(str), return_inverse=True)
+    numbers = np.array([_get_number(symbol) for symbol in unique_symbols], int)
+    return numbers[inverse].reshape(natom), pos*angstrom
+
+
+def _load_chk(fn):
+    """Load a checkpoint file
+
+       **Arguments:**
+
+       fn
+            The checkpoint file.
+
+       **Returns:** a dictionary with the contents of the file.
+
+       This gives the same result as ``molmod.io.load_chk``, but arrays of
+       numbers are converted in one go with ``np.fromstring`` instead of one
+       element at a time.
+    """
+    result = {}
+    with open(fn) as f:
+        while True:
+            line = f.readline()
+            if line == '':
+                break
+            if len(line) < 54:
+                raise IOError('Header lines must be at least 54 characters long.')
+            key = line[:40].strip()
+            kind = line[47:52].strip()
+            value = line[53:-1]
+            if kind == 'str':
+                result[key] = value
+            elif kind == 'int':
+                result[key] = int(value)
+            elif kind == 'bln':
+                result[key] = value.lower() in ['true', '1', 'yes']
+            elif kind == 'flt':
+                result[key] = float(value)
+            elif kind[3:5] == 'ar':
+                shape = tuple(int(i) for i in value.split(','))
+                result[key] = _load_chk_array(f, kind[:3], shape)
+            elif kind == 'none':
+                result[key] = None
+            else:
+                raise IOError('Unsupported kind: %s' % kind)
+    return result
+
+
+def _load_chk_array(f, kind, shape):
+    """Read the data of an array from an open checkpoint file
+
+       The checkpoint format stores at most four elements per line. Lines are
+       read in blocks that are just big enough to contain the remaining
+       elements, until the array is complete.
+    """
+    size = int(np.product(shape))
+    words = []
+    while len(words) < size:
+        nline = (size - len(words) + 3)/4
+        lines = [f.readline() for i in xrange(nline)]
+        if lines[-1] == '':
+            raise IOError('Insufficient data')
+        if kind in ('int', 'flt'):
+            dtype = (int if kind == 'int' else float)
+            block = np.fromstring(''.join(lines), dtype, sep=' ')
+            if len(words) == 0 and len(block) >= size:
+                words = block
+                break
+            words = np.concatenate([words, block])
+        else:
+            words.extend(''.join(lines).split())
+    if kind == 'str':
+        array = np.array(words[:size], np.dtype('U22'))
+    elif kind == 'int':
+        array = np.asarray(words[:size], int)
+    elif kind == 'bln':
+        array = np.array([word.lower() in ['true', '1', 'yes'] for word in words[:size]], bool)
+    elif kind == 'flt':
+        array = np.asarray(words[:size], float)
+    else:
+        raise IOError('Unsupported kind: %sar' % kind)
+    return array.reshape(shape)
+
+
 class System(object):
     def __init__(self, numbers, pos, scopes=None, scope_ids=None, ffatypes=None,
                  ffatype_ids=None, bonds=None, rvecs=None, charges=None,
@@ -142,6 +358,11 @@ class System(object):
              bonds from a given atom, respectively. This means that i in
              system.neighs3[j] is ``True`` if there are three bonds between
              atoms i and j.
+
+           The arguments pos, bonds and charges may also be h5py datasets.
+           These are only read into memory when they are used, see
+           ``from_hdf5``. The derived bond attributes are then also computed
+           on first use.
         '''
         if len(numbers.shape) != 1:
             raise ValueError('Argument numbers must be a one-dimensional array.')
@@ -182,8 +403,25 @@ class System(object):
             log.hline()
             log.blank()
 
+    pos = _lazy_attribute('pos', 'A numpy array (N,3) with atomic coordinates in Bohr.')
+    bonds = _lazy_attribute('bonds', 'A numpy array (B,2) with atom indexes of the bonded pairs.')
+    charges = _lazy_attribute('charges', 'An array of atomic charges.')
+
+    def __getattr__(self, name):
+        # Only called when the attribute is not found in the usual way, i.e.
+        # when the derived bond attributes are not computed yet.
+        if name in ('neighs1', 'neighs2', 'neighs3', 'neighs4') and \
+           self.__dict__.get('_bonds') is not None:
+            with log.section('SYS'):
+                self._init_derived_bonds()
+            return self.__dict__[name]
+        raise AttributeError('\'%s\' object has no attribute \'%s\'' % (self.__class__.__name__, name))
+
     def _init_derived(self):
-        if self.bonds is not None:
+        if hasattr(self._bonds, 'read_direct'):
+            # Postpone the bond analysis until the neighbors are needed.
+            pass
+        elif self.bonds is not None:
             self._init_derived_bonds()
         if self.scopes is not None:
             self._init_derived_scopes()
@@ -195,66 +433,49 @@ class System(object):
             raise ValueError('The ffatype_ids only make sense when the ffatypes argument is given.')
 
     def _init_derived_bonds(self):
+        # The relations between atoms are first computed as sorted arrays of
+        # pairs (i0, i1), encoded as i0*natom + i1.
+        natom = self.natom
+        bonds = np.asarray(self.bonds, int).reshape(-1, 2)
         # 1-bond neighbors
-        self.neighs1 = dict((i,set([])) for i in xrange(self.natom))
-        for i0, i1 in self.bonds:
-            self.neighs1[i0].add(i1)
-            self.neighs1[i1].add(i0)
-        # 2-bond neighbors
-        self.neighs2 = dict((i,set([])) for i in xrange(self.natom))
-        for i0, n0 in self.neighs1.iteritems():
-            for i1 in n0:
-                for i2 in self.neighs1[i1]:
-                    # Require that there are no shorter paths than two bonds between
-                    # i0 and i2. Also avoid duplicates.
-                    if i2 > i0 and i2 not in self.neighs1[i0]:
-                        self.neighs2[i0].add(i2)
-                        self.neighs2[i2].add(i0)
-        # 3-bond neighbors
-        self.neighs3 = dict((i,set([])) for i in xrange(self.natom))
-        for i0, n0 in self.neighs1.iteritems():
-            for i1 in n0:
-                for i3 in self.neighs2[i1]:
-                    # Require that there are no shorter paths than three bonds
-                    # between i0 and i3. Also avoid duplicates.
-                    if i3 != i0 and i3 not in self.neighs1[i0] and i3 not in self.neighs2[i0]:
-                        self.neighs3[i0].add(i3)
-                        self.neighs3[i3].add(i0)
-        # 4-bond neighbors
-        self.neighs4 = dict((i,set([])) for i in xrange(self.natom))
-        for i0, n0 in self.neighs1.iteritems():
-            for i1 in n0:
-                for i4 in self.neighs3[i1]:
-                    # Require that there are no shorter paths than three bonds
-                    # between i0 and i4. Also avoid duplicates.
-                    if i4 != i0 and i4 not in self.neighs1[i0] and i4 not in self.neighs2[i0] and i4 not in self.neighs3[i0]:
-                        self.neighs4[i0].add(i4)
-                        self.neighs4[i4].add(i0)
+        keys1 = np.union1d(bonds[:,0]*natom + bonds[:,1], bonds[:,1]*natom + bonds[:,0])
+        # 2-bond neighbors. Require that there are no shorter paths than two
+        # bonds.
+        keys2 = _filter_pairs(_compose_pairs(keys1, keys1, natom), natom, [keys1])
+        # 3-bond neighbors. Require that there are no shorter paths than three
+        # bonds.
+        keys3 = _filter_pairs(_compose_pairs(keys1, keys2, natom), natom, [keys1, keys2])
+        # 4-bond neighbors. Require that there are no shorter paths than four
+        # bonds.
+        keys4 = _filter_pairs(_compose_pairs(keys1, keys3, natom), natom, [keys1, keys2, keys3])
+        self.neighs1 = _pairs_to_neighs(keys1, natom)
+        self.neighs2 = _pairs_to_neighs(keys2, natom)
+        self.neighs3 = _pairs_to_neighs(keys3, natom)
+        self.neighs4 = _pairs_to_neighs(keys4, natom)
         # report some basic stuff on screen
         if log.do_medium:
             log('Analysis of the bonds:')
-            bond_types = {}
-            for i0, i1 in self.bonds:
-                key = tuple(sorted([self.numbers[i0], self.numbers[i1]]))
-                bond_types[key] = bond_types.get(key, 0) + 1
+            bond_nums = np.sort(self.numbers[bonds], axis=1)
+            bond_types, counts = np.unique(bond_nums[:,0]*1000 + bond_nums[:,1], return_counts=True)
             log.hline()
             log(' First   Second   Count')
-            for (num0, num1), count in sorted(bond_types.iteritems()):
-                log('%6i   %6i   %5i' % (num0, num1, count))
+            for bond_type, count in zip(bond_types, counts):
+                log('%6i   %6i   %5i' % (bond_type/1000, bond_type%1000, count))
             log.hline()
             log.blank()
 
             log('Analysis of the neighbors:')
             log.hline()
-            log('Number of first neighbors:  %6i' % (sum(len(n) for n in self.neighs1.itervalues())/2))
-            log('Number of second neighbors: %6i' % (sum(len(n) for n in self.neighs2.itervalues())/2))
-            log('Number of third neighbors:  %6i' % (sum(len(n) for n in self.neighs3.itervalues())/2))
+            log('Number of first neighbors:  %6i' % (len(keys1)/2))
+            log('Number of second neighbors: %6i' % (len(keys2)/2))
+            log('Number of third neighbors:  %6i' % (len(keys3)/2))
             # Collect all types of 'environments' for each element. This is
             # useful to double check the bonds
             envs = {}
+            numbers = self.numbers.tolist()
             for i0 in xrange(self.natom):
-                num0 = self.numbers[i0]
-                nnums = tuple(sorted(self.numbers[i1] for i1 in self.neighs1[i0]))
+                num0 = numbers[i0]
+                nnums = tuple(sorted(numbers[i1] for i1 in self.neighs1[i0]))
                 key = (num0, nnums)
                 envs[key] = envs.get(key, 0)+1
             # Print the environments on screen
@@ -379,7 +600,7 @@ class System(object):
 
     def _get_natom(self):
         """The number of atoms"""
-        return len(self.pos)
+        return len(self.numbers)
 
     natom = property(_get_natom)
 
@@ -391,10 +612,10 @@ class System(object):
 
     def _get_nbond(self):
         '''The number of bonds'''
-        if self.bonds is None:
+        if self._bonds is None:
             return 0
         else:
-            return len(self.bonds)
+            return len(self._bonds)
 
     nbond = property(_get_nbond)
 
@@ -428,15 +649,18 @@ class System(object):
            .chk
                 Internal text-based checkpoint format. It just contains a
                 dictionary with the constructor arguments.
+
+           .h5
+                Internal binary checkpoint format, see ``from_hdf5``.
+
+           The xyz and chk files are parsed in blocks with NumPy, which keeps
+           the loading time of big systems low.
         """
         with log.section('SYS'):
             kwargs = {}
             for fn in fns:
                 if fn.endswith('.xyz'):
-                    from molmod import Molecule
-                    mol = Molecule.from_file(fn)
-                    kwargs['numbers'] = mol.numbers.copy()
-                    kwargs['pos'] = mol.coordinates.copy()
+                    kwargs['numbers'], kwargs['pos'] = _load_xyz(fn)
                 elif fn.endswith('.psf'):
                     from molmod.io import PSFFile
                     psf = PSFFile(fn)
@@ -444,16 +668,16 @@ class System(object):
                     kwargs['bonds'] = np.array(psf.bonds, copy=False)
                     kwargs['charges'] = np.array(psf.charges, copy=False)
                 elif fn.endswith('.chk'):
-                    from molmod.io import load_chk
                     allowed_keys = [
                         'numbers', 'pos', 'scopes', 'scope_ids', 'ffatypes',
                         'ffatype_ids', 'bonds', 'rvecs', 'charges', 'radii',
                         'valence_charges', 'dipoles', 'radii2', 'masses',
                     ]
-                    for key, value in load_chk(fn).iteritems():
+                    for key, value in _load_chk(fn).iteritems():
                         if key in allowed_keys:
                             kwargs.update({key: value})
                 elif fn.endswith('.h5'):
+                    import h5py as h5
                     with h5.File(fn, 'r') as f:
                         return cls.from_hdf5(f)
                 else:
@@ -464,7 +688,7 @@ class System(object):
         return cls(**kwargs)
 
     @classmethod
-    def from_hdf5(cls, f):
+    def from_hdf5(cls, f, lazy=False):
         '''Create a system from an HDF5 file/group containing a system group
 
            **Arguments:**
@@ -472,15 +696,28 @@ class System(object):
            f
                 An open h5.File object with a system group. The system group
                 must at least contain a numbers and pos dataset.
+
+           **Optional arguments:**
+
+           lazy
+                When True, the (potentially large) pos, bonds and charges
+                arrays are only read from the file when they are used for the
+                first time. The file must remain open until then.
         '''
         sgrp = f['system']
-        kwargs = {
-            'numbers': sgrp['numbers'][:],
-            'pos': sgrp['pos'][:],
-        }
-        for key in 'scopes', 'scope_ids', 'ffatypes', 'ffatype_ids', 'bonds', 'rvecs', 'charges', 'masses':
+        kwargs = {}
+        for key in 'numbers', 'pos', 'scopes', 'scope_ids', 'ffatypes', 'ffatype_ids', 'bonds', 'rvecs', 'charges', 'masses':
             if key in sgrp:
-                kwargs[key] = sgrp[key][:]
+                dataset = sgrp[key]
+                if lazy and key in ('pos', 'bonds', 'charges'):
+                    kwargs[key] = dataset
+                elif dataset.dtype.kind in 'biuf':
+                    # Numerical arrays are read directly into a numpy buffer.
+                    kwargs[key] = np.empty(dataset.shape, dataset.dtype)
+                    if dataset.size > 0:
+                        dataset.read_direct(kwargs[key])
+                else:
+                    kwargs[key] = dataset[:]
         if log.do_high:
             log('Read system parameters from %s.' % f.filename)
         return cls(**kwargs)
@@ -524,6 +761,7 @@ class System(object):
                 'masses': self.masses,
             })
         elif fn.endswith('.h5'):
+            import h5py as h5
             with h5.File(fn, 'w') as f:
                 self.to_hdf5(f)
         elif fn.endswith('.xyz'):
@@ -582,10 +820,13 @@ class System(object):
            given type. On the other hand ``rule`` can be an ATSELECT string that
            defines the atoms of interest.
 
-           A list of atom indexes is returned.
+           A list of atom indexes is returned. Compiled ATSELECT rules are
+           evaluated for all atoms at once.
         """
         if isinstance(rule, basestring):
             rule = atsel_compile(rule)
+        if hasattr(rule, 'get_mask'):
+            return rule.get_mask(self).nonzero()[0]
         return np.array([i for i in xrange(self.natom) if rule(self, i)])
 
     def iter_bonds(self):
@@ -694,24 +935,34 @@ class System(object):
                 if isinstance(rule, basestring):
                     rule = atsel_compile(rule)
                 my_rules.append((ffatype, rule))
-            # Use the rules to detect the atom types
+            # Evaluate all rules for all atoms. The cache makes sure that
+            # subexpressions shared by several rules are evaluated only once.
+            cache = {}
+            masks = np.zeros((len(my_rules), self.natom), bool)
+            for irule, (ffatype, rule) in enumerate(my_rules):
+                if hasattr(rule, 'get_mask'):
+                    masks[irule] = rule.get_mask(self, cache)
+                else:
+                    masks[irule] = [rule(self, i) for i in xrange(self.natom)]
+            # The first matching rule determines the atom type.
+            matched = masks.any(axis=0)
+            if not matched.all():
+                i = (~matched).nonzero()[0][0]
+                raise ValueError('Could not detect FF atom type of atom %i.' % i)
+            irules = masks.argmax(axis=0)
+            # Assign ffatype_ids in order of first appearance.
             lookup = {}
             self.ffatypes = []
             self.ffatype_ids = np.zeros(self.natom, int)
-            for i in xrange(self.natom):
-                my_ffatype = None
-                for ffatype, rule in my_rules:
-                    if rule(self, i):
-                        my_ffatype = ffatype
-                        break
-                if my_ffatype is None:
-                    raise ValueError('Could not detect FF atom type of atom %i.' % i)
+            unique, first = np.unique(irules, return_index=True)
+            for irule in unique[first.argsort()]:
+                my_ffatype = my_rules[irule][0]
                 ffatype_id = lookup.get(my_ffatype)
                 if ffatype_id is None:
                     ffatype_id = len(lookup)
                     self.ffatypes.append(my_ffatype)
                     lookup[my_ffatype] = ffatype_id
-                self.ffatype_ids[i] = ffatype_id
+                self.ffatype_ids[irules == irule] = ffatype_id
             # Make sure all is done well ...
             self._init_derived_ffatypes()
 
@@ -853,55 +1104,30 @@ class System(object):
         # C) Cell vectors
         new_args['rvecs'] = self.cell.rvecs*np.array(reps)[:,None]
 
-        # D) Atom positions
-        new_pos = np.zeros((self.natom*rep_all, 3), float)
-        start = 0
-        for iimage in np.ndindex(reps):
-            stop = start+self.natom
-            new_pos[start:stop] = self.pos + np.dot(iimage, self.cell.rvecs)
-            start = stop
-        new_args['pos'] = new_pos
+        # D) Atom positions. The images are ordered as in np.ndindex(reps).
+        images = np.indices(reps).reshape(len(reps), -1).T
+        new_pos = self.pos + np.dot(images, self.cell.rvecs)[:,None,:]
+        new_args['pos'] = new_pos.reshape(-1, 3)
 
         if self.bonds is not None:
             # E) Bonds
-            # E.1) A function that translates a set of image indexes and an old atom
-            # index into a new atom index
-            offsets = {}
-            start = 0
-            for iimage in np.ndindex(reps):
-                offsets[iimage] = start
-                start += self.natom
-            def to_new_atom_index(iimage, i):
-                return offsets[iimage] + i
-
-            # E.2) Construct extended bond information: for each bond, also keep
+            # E.1) Construct extended bond information: for each bond, also keep
             # track of periodic image it connects to. Note that this information
             # is implicit in yaff, and derived using the minimum image convention.
-            rel_iimage = {}
-            for ibond in xrange(len(self.bonds)):
-                i0, i1 = self.bonds[ibond]
-                delta = self.pos[i0] - self.pos[i1]
-                frac = np.dot(self.cell.gvecs, delta)
-                rel_iimage[ibond] = np.ceil(frac-0.5)
-
-            # E.3) Create the new bonds
-            new_bonds = np.zeros((len(self.bonds)*rep_all,2), int)
-            counter = 0
-            for iimage0 in np.ndindex(reps):
-                for ibond in xrange(len(self.bonds)):
-                    i0, i1 = self.bonds[ibond]
-                    # Translate i0 to the new index.
-                    j0 = to_new_atom_index(iimage0, i0)
-                    # Also translate i1 to the new index. This is a bit more tricky.
-                    # The difficult case occurs when the bond between i0 and i1
-                    # connects different periodic images. In that case, the change
-                    # in periodic image must be taken into account.
-                    iimage1 = tuple((iimage0[c] + rel_iimage[ibond][c]) % reps[c] for c in xrange(len(reps)))
-                    j1 = to_new_atom_index(iimage1, i1)
-                    new_bonds[counter,0] = j0
-                    new_bonds[counter,1] = j1
-                    counter += 1
-            new_args['bonds'] = new_bonds
+            bonds = np.asarray(self.bonds, int).reshape(-1, 2)
+            deltas = self.pos[bonds[:,0]] - self.pos[bonds[:,1]]
+            rel_images = np.ceil(np.dot(deltas, self.cell.gvecs.T) - 0.5).astype(int)
+
+            # E.2) Create the new bonds. The first atom of each bond is translated
+            # to the new index in each image. For the second atom, the change in
+            # periodic image must be taken into account when the bond connects
+            # different periodic images.
+            new_bonds = np.zeros((rep_all, len(bonds), 2), int)
+            new_bonds[:,:,0] = np.arange(rep_all)[:,None]*self.natom + bonds[:,0]
+            images1 = (images[:,None,:] + rel_images) % reps
+            iimages1 = np.ravel_multi_index(tuple(images1.T), reps).T
+            new_bonds[:,:,1] = iimages1*self.natom + bonds[:,1]
+            new_args['bonds'] = new_bonds.reshape(-1, 2)
 
         # Done
         return System(**new_args)
@@ -1083,7 +1309,7 @@ class System(object):
                 new_bonds.append([i0, i1])
         self.bonds = np.array(new_bonds)
 
-    def iter_matches(self, other, overlapping=True):
+    def iter_matches(self, other, overlapping=True, nproc=None):
         """Yield all renumberings of atoms that map the given system on the current.
 
         Parameters
@@ -1095,40 +1321,17 @@ class System(object):
             When set to False, the returned matches are guaranteed to be mutually
             exclusive. The result may not be unique when partially overlapping matches
             would exist. Use with care.
-
-        The graph distance is used to perform the mapping, so bonds must be defined in
-        the current and the given system.
+        nproc : int or None
+            When larger than one, the search is distributed over a pool with the
+            given number of processes.
+
+        The bond graphs are used to perform the mapping, so bonds must be defined in
+        the current and the given system. Only the absence or presence of a direct bond
+        is compared, because a shorter path may exist between two atoms in the big
+        system (self) that is not present in a fragment (other).
         """
-        def make_graph_distance_matrix(system):
-            """Return a bond graph distance matrix.
-
-            Parameters
-            ----------
-            system : System
-                Molecule (with bonds) for which the graph distances must be computed.
-
-            The graph distance is used for comparison because it allows the pattern
-            matching to make optimal choices of which pairs of atoms to compare next, i.e.
-            both bonded or nearby the last matched pair.
-            """
-            from molmod.graphs import Graph
-            return Graph(system.bonds, system.natom).distances
-
-        def error_sq_fn(x, y):
-            """Compare bonded versus not bonded, rather than the full graph distance.
-
-            Parameters
-            ----------
-            x, y: int
-                Graph distances from self and other, respectively.
-
-            Graph distances are not completely transferable between self and other, i.e. a
-            shorter path may exist between two atoms in the big system (self) that is not
-            present in a fragment (other). Hence, only the absence or presence of a direct
-            bond must be compared.
-            """
-            return (min(x - 1, 1) - min(y - 1, 1))**2
-
+        if self.bonds is None or other.bonds is None:
+            raise ValueError('The system does not have bond data.')
         with log.section('SYS'):
             log('Generating allowed indexes for renumbering.')
             # The allowed permutations is just based on the chemical elements, not the atom
@@ -1147,13 +1350,9 @@ class System(object):
                 ffatype_ids1 = order[other.ffatype_ids]
                 for ffatype_id1 in ffatype_ids1:
                     allowed.append((ffatype_ids0 == ffatype_id1).nonzero()[0])
-            log('Building distance matrix for self.')
-            dm0 = make_graph_distance_matrix(self)
-            log('Building distance matrix for other.')
-            dm1 = make_graph_distance_matrix(other)
             # Yield the solutions
             log('Generating renumberings.')
-            for match in iter_matches(dm0, dm1, allowed, 1e-3, error_sq_fn, overlapping):
+            for match in iter_bond_matches(self.neighs1, other.neighs1, allowed, overlapping, nproc):
                 yield match
 
     def to_file(self, fn):
@@ -1199,6 +1398,7 @@ class System(object):
                 'masses': self.masses,
             })
         elif fn.endswith('.h5'):
+            import h5py as h5
             with h5.File(fn, 'w') as f:
                 self.to_hdf5(f)
         elif fn.endswith('.xyz'):
@@ -162,6 +162,37 @@ def test_atselect_scope():
     assert (system.get_indexes('8')==np.array([0, 7])).all()
 
 
+def check_mask(system, s):
+    fn = atsel_compile(s)
+    expected = np.array([fn(system, i) for i in xrange(system.natom)])
+    assert (fn.get_mask(system) == expected).all()
+
+
+def test_mask_caffeine():
+    system = get_system_caffeine()
+    for s in ['C&=3%H', 'C&=2%N', 'O&=1%(C&=2%N)', 'O&=1%(C&=1%C)', 'C&>1%C',
+              'C&<2%C', 'N&!=2', 'N|8', '!0', '=3%(C|N)&!<3%H', '*']:
+        check_mask(system, s)
+
+
+def test_mask_scope():
+    system = System(
+        numbers=np.array([8, 1, 1, 6, 1, 1, 1, 8, 1]),
+        pos=np.zeros((9, 3), float),
+        scopes=['WAT', 'WAT', 'WAT', 'METH', 'METH', 'METH', 'METH', 'METH', 'METH'],
+        ffatypes=['O', 'H', 'H', 'C', 'H_C', 'H_C', 'H_C', 'O', 'H_O'],
+        bonds=np.array([[0, 1], [0, 2], [3, 4], [3, 5], [3, 6], [3, 7], [7, 8], [8, 7]]),
+    )
+    for s in ['WAT:*', 'WAT:H|METH:8', 'METH:*&=1%O', '=1%METH:O', 'O&=2']:
+        check_mask(system, s)
+
+
+def test_compile_memoized():
+    rule = atsel_compile('C&=3%H')
+    assert atsel_compile('C & =3%H') is rule
+    assert atsel_compile('O&=1%(C&=3%H)').fns[1].fn is rule
+
+
 def test_iter_matches_water_water():
     # Water molecule with oxygen in center
     dm0 = np.array([
@@ -199,3 +230,53 @@ def test_iter_matches_water_hydroxyl():
     # Get all solutions
     solutions = np.array(sorted(iter_matches(dm0, dm1, allowed)))
     np.testing.assert_equal(solutions, [[1, 0], [1, 2]])
+
+
+def test_iter_bond_matches_water_hydroxyl():
+    # Water molecule with oxygen in center
+    neighs0 = [set([1]), set([0, 2]), set([1])]
+    # Hydroxyl group
+    neighs1 = [set([1]), set([0])]
+    allowed = [[1], [0, 2]]
+    solutions = np.array(sorted(iter_bond_matches(neighs0, neighs1, allowed)))
+    np.testing.assert_equal(solutions, [[1, 0], [1, 2]])
+    # Without restrictions, the hydroxyl group can be matched in both directions.
+    allowed = [[0, 1, 2], [0, 1, 2]]
+    solutions = np.array(sorted(iter_bond_matches(neighs0, neighs1, allowed)))
+    np.testing.assert_equal(solutions, [[0, 1], [1, 0], [1, 2], [2, 1]])
+
+
+def test_iter_bond_matches_induced():
+    # Triangle versus a chain of three vertices: the bond between the end
+    # points of the chain is not present in the reference.
+    neighs0 = [set([1]), set([0, 2]), set([1])]
+    neighs1 = [set([1, 2]), set([0, 2]), set([0, 1])]
+    allowed = [[0, 1, 2]]*3
+    assert len(list(iter_bond_matches(neighs0, neighs1, allowed))) == 0
+    assert len(list(iter_bond_matches(neighs1, neighs0, allowed))) == 0
+    assert len(list(iter_bond_matches(neighs1, neighs1, allowed))) == 6
+
+
+def test_iter_bond_matches_consistent():
+    system = get_system_caffeine()
+    allowed = [(system.numbers == number).nonzero()[0] for number in system.numbers]
+    from molmod.graphs import Graph
+    dm = Graph(system.bonds, system.natom).distances
+    result0 = sorted(iter_matches(dm, dm, allowed, error_sq_fn=lambda x, y: (min(x - 1, 1) - min(y - 1, 1))**2))
+    result1 = sorted(iter_bond_matches(system.neighs1, system.neighs1, allowed))
+    assert len(result0) == 6**3
+    assert result0 == result1
+
+
+def test_iter_bond_matches_pool():
+    # A chain of three vertices in a ring of twelve vertices. The first
+    # matches of most roots overlap with the match of a previous root.
+    neighs0 = [set([(i-1)%12, (i+1)%12]) for i in xrange(12)]
+    neighs1 = [set([1]), set([0, 2]), set([1])]
+    allowed = [range(12)]*3
+    for overlapping in True, False:
+        result0 = list(iter_bond_matches(neighs0, neighs1, allowed, overlapping))
+        result1 = list(iter_bond_matches(neighs0, neighs1, allowed, overlapping, nproc=2))
+        assert result0 == result1
+    assert len(result0) == 4
+    assert sorted(sum(result0, ())) == range(12)
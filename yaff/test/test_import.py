@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# YAFF is yet another force-field code
+# Copyright (C) 2011 - 2013 Toon Verstraelen <Toon.Verstraelen@UGent.be>,
+# Louis Vanduyfhuys <Louis.Vanduyfhuys@UGent.be>, Center for Molecular Modeling
+# (CMM), Ghent University, Ghent, Belgium; all rights reserved unless otherwise
+# stated.
+#
+# This file is part of YAFF.
+#
+# YAFF is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# YAFF is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+
+
+import os, sys, subprocess
+
+import yaff
+
+
+def run_fresh(code):
+    '''Run code in a fresh interpreter and return the standard output'''
+    env = dict(os.environ)
+    rootdir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(yaff.__file__))))
+    env['PYTHONPATH'] = rootdir + ':' + env.get('PYTHONPATH', '')
+    proc = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE, env=env)
+    outdata = proc.communicate()[0]
+    assert proc.returncode == 0
+    return outdata.split()
+
+
+def test_import_lazy():
+    loaded = run_fresh('''
+import sys, yaff
+yaff.System, yaff.ForceField
+for name in 'h5py', 'matplotlib', 'yaff.analysis', 'yaff.conversion', 'yaff.sampling', 'yaff.tune':
+    print name in sys.modules
+''')
+    assert loaded == ['False']*6
+
+
+def test_import_star():
+    names = run_fresh('''
+from yaff import *
+print VerletIntegrator.__module__, RDF.__module__, xyz_to_hdf5.__module__
+print utils.__name__, log.__class__.__name__, context.__class__.__name__
+''')
+    assert names == [
+        'yaff.sampling.verlet', 'yaff.analysis.rdf', 'yaff.conversion.xyz',
+        'yaff.sampling.utils', 'ScreenLog', 'Context',
+    ]
+
+
+def test_import_attributes():
+    assert yaff.System is yaff.system.System
+    assert yaff.Spectrum is yaff.analysis.spectrum.Spectrum
+    assert yaff.pes.ForceField is yaff.ForceField
+    assert 'HDF5Writer' in yaff.__all__
+    assert 'angstrom' in yaff.__all__
+    try:
+        yaff.does_not_exist
+        assert False
+    except AttributeError:
+        pass
+
+
+def test_import_unknown():
+    loaded = run_fresh('''
+import sys, yaff
+print hasattr(yaff, 'does_not_exist')
+for name in 'yaff.pes', 'yaff.analysis', 'yaff.conversion', 'yaff.sampling', 'yaff.tune':
+    print name in sys.modules
+''')
+    assert loaded == ['False']*6
+
+
+def test_import_names():
+    # The static table of lazy names must match the public names of the
+    # subpackages, i.e. the names ``from yaff.<module> import *`` imports. This
+    # runs in a fresh interpreter, because the imports of the tests add
+    # attributes to the subpackages.
+    mismatches = run_fresh('''
+import yaff
+from importlib import import_module
+seen = set(name for name in yaff._original.__dict__ if not name.startswith('_'))
+seen.difference_update(yaff._lazy_modules)
+for modname, names in yaff._lazy_names:
+    module = import_module('yaff.%s' % modname)
+    public = getattr(module, '__all__', None)
+    if public is None:
+        public = [name for name in module.__dict__ if not name.startswith('_')]
+    expected = set(public) - seen
+    for name in expected.symmetric_difference(names):
+        print modname, name
+    seen.update(expected)
+''')
+    assert mismatches == []
@@ -29,7 +29,7 @@ from yaff import System, Cell, angstrom, context
 
 from common import get_system_water32, get_system_glycine, get_system_quartz, \
     get_system_cyclopropene, get_system_peroxide, get_system_graphene8, \
-    get_system_polyethylene4
+    get_system_polyethylene4, get_system_caffeine
 
 
 def compare_water32(system0, system1, eps=0, xyz=False):
@@ -83,6 +83,80 @@ def test_hdf5():
         shutil.rmtree(dirname)
 
 
+def test_load_xyz_molmod():
+    from molmod import Molecule
+    from yaff.system import _load_xyz
+    for fn in 'test/guaianolide.xyz', 'test/water_trajectory.xyz', 'test/rhodium_complex_nobornane.xyz':
+        mol = Molecule.from_file(context.get_fn(fn))
+        numbers, pos = _load_xyz(context.get_fn(fn), block_size=7)
+        np.testing.assert_equal(numbers, mol.numbers)
+        np.testing.assert_equal(pos, mol.coordinates)
+
+
+
+def test_load_xyz_irregular():
+    from yaff.system import _load_xyz
+    dirname = tempfile.mkdtemp('yaff', 'test_load_xyz_irregular')
+    try:
+        fn = '%s/tmp.xyz' % dirname
+        # The total number of words is a multiple of the number of lines, but
+        # the lines have different numbers of columns.
+        with open(fn, 'w') as f:
+            f.write('2\ntitle\nH 0.0 1.0 2.0 0.5 0.5\nO 3.0 4.0 5.0\n')
+        numbers, pos = _load_xyz(fn)
+        np.testing.assert_equal(numbers, [1, 8])
+        np.testing.assert_allclose(pos/angstrom, [[0.0, 1.0, 2.0], [3.0, 4.0, 5.0]])
+        with open(fn, 'w') as f:
+            f.write('2\ntitle\nH 0.0 1.0 2.0 0.5 0.5 0.5\nO 3.0 4.0\n')
+        try:
+            _load_xyz(fn)
+            assert False
+        except IOError:
+            pass
+    finally:
+        shutil.rmtree(dirname)
+
+def test_load_chk_molmod():
+    from molmod.io import load_chk
+    from yaff.system import _load_chk
+    system = get_system_caffeine()
+    system.set_standard_masses()
+    dirname = tempfile.mkdtemp('yaff', 'test_load_chk_molmod')
+    try:
+        system.to_file('%s/tmp.chk' % dirname)
+        for fn in '%s/tmp.chk' % dirname, context.get_fn('test/water_hessian.chk'):
+            data0 = load_chk(fn)
+            data1 = _load_chk(fn)
+            assert sorted(data0) == sorted(data1)
+            for key, value0 in data0.iteritems():
+                value1 = data1[key]
+                if isinstance(value0, np.ndarray):
+                    assert value0.dtype == value1.dtype
+                    np.testing.assert_equal(value0, value1)
+                else:
+                    assert value0 == value1
+    finally:
+        shutil.rmtree(dirname)
+
+
+def test_hdf5_lazy():
+    system0 = get_system_water32()
+    with h5.File('yaff.test.test_system.test_hdf5_lazy.h5', driver='core', backing_store=False) as f:
+        system0.to_hdf5(f)
+        system1 = System.from_hdf5(f, lazy=True)
+        assert system1.natom == system0.natom
+        assert system1.nbond == system0.nbond
+        # Nothing is read yet
+        assert isinstance(system1._pos, h5.Dataset)
+        assert isinstance(system1._bonds, h5.Dataset)
+        assert isinstance(system1._charges, h5.Dataset)
+        assert 'neighs1' not in system1.__dict__
+        compare_water32(system0, system1)
+        assert isinstance(system1.pos, np.ndarray)
+        assert system1.neighs1 == system0.neighs1
+        assert system1.neighs4 == system0.neighs4
+
+
 def test_ffatypes():
     system = get_system_water32()
     assert (system.ffatypes == ['O', 'H']).all()
@@ -219,6 +293,40 @@ def test_detect_ffatypes():
     check_detect_ffatypes(system, rules)
 
 
+def test_detect_ffatypes_order():
+    system = get_system_caffeine()
+    system.detect_ffatypes([
+        ('C_H3', 'C&=3%H'),
+        ('C_O', 'C&=1%O'),
+        ('C', '6'),
+        ('N', '7'),
+        ('H_C', '1&=1%C'),
+        ('O', '8'),
+    ])
+    # The ffatypes must be ordered by first appearance in the system.
+    first = [(system.ffatype_ids == i).nonzero()[0][0] for i in xrange(len(system.ffatypes))]
+    assert first == sorted(first)
+    for i in xrange(system.natom):
+        ffatype = system.get_ffatype(i)
+        if ffatype == 'C_H3':
+            assert i in system.get_indexes('6&=3%1')
+        elif ffatype == 'C_O':
+            assert i in system.get_indexes('6&=1%8&!=3%1')
+        elif ffatype == 'C':
+            assert i in system.get_indexes('6&!=1%8&!=3%1')
+        else:
+            assert system.numbers[i] == {'N': 7, 'H_C': 1, 'O': 8}[ffatype]
+
+
+def test_detect_ffatypes_failure():
+    system = get_system_caffeine()
+    try:
+        system.detect_ffatypes([('C', '6'), ('N', '7'), ('O', '8')])
+        assert False
+    except ValueError:
+        pass
+
+
 def test_align_cell_quartz():
     system = get_system_quartz()
     system.cell = Cell(system.cell.rvecs[::-1].copy())
@@ -260,6 +368,33 @@ def test_supercell_quartz_222():
     assert issubclass(system222.bonds.dtype.type, int)
 
 
+def test_supercell_quartz_312():
+    system111 = get_system_quartz()
+    system312 = system111.supercell(3, 1, 2)
+    assert system312.natom == system111.natom*6
+    assert len(system312.bonds) == len(system111.bonds)*6
+    # The first atom of each bond is in the same image as in the original bond.
+    np.testing.assert_equal(system312.bonds[:,0] % system111.natom, np.tile(system111.bonds[:,0], 6))
+    np.testing.assert_equal(system312.bonds[:,1] % system111.natom, np.tile(system111.bonds[:,1], 6))
+    check_detect_bonds(system312)
+
+
+def check_neighs(system):
+    # Compare with a straightforward computation of graph distances.
+    from molmod.graphs import Graph
+    dm = Graph(system.bonds, system.natom).distances
+    for n in 1, 2, 3, 4:
+        neighs = getattr(system, 'neighs%i' % n)
+        for i in xrange(system.natom):
+            assert neighs[i] == set((dm[i] == n).nonzero()[0])
+
+
+def test_neighs():
+    check_neighs(get_system_caffeine())
+    check_neighs(get_system_glycine())
+    check_neighs(get_system_quartz().supercell(2, 2, 1))
+
+
 def test_supercell_graphene_22():
     system11 = get_system_graphene8()
     system22 = system11.supercell(2, 2)
@@ -491,3 +626,31 @@ def test_iter_matches_single_atom():
     selected = set(system.iter_matches(system_ref).next())
     reference = set([28])
     np.testing.assert_equal(selected, reference)
+
+
+def test_iter_matches_quartz_pool():
+    system = get_system_quartz()
+    result0 = list(system.iter_matches(system))
+    result1 = list(system.iter_matches(system, nproc=2))
+    assert result0 == result1
+    result0 = list(system.iter_matches(system, overlapping=False))
+    result1 = list(system.iter_matches(system, overlapping=False, nproc=2))
+    assert result0 == result1
+    assert len(result0) == 1
+
+
+def test_iter_matches_fragment_supercell():
+    system = get_system_quartz().supercell(2, 2, 2)
+    # A silicon atom with its four oxygen neighbors
+    fragment = system.subsystem([0] + sorted(system.neighs1[0]))
+    matches = list(system.iter_matches(fragment))
+    # Each SiO4 unit occurs 4! times due to the permutations of the oxygens.
+    assert len(matches) == 24*(system.numbers == 14).sum()
+    for match in matches:
+        match = list(match)
+        np.testing.assert_equal(system.numbers[match], fragment.numbers)
+        for i0, i1 in fragment.bonds:
+            assert match[i1] in system.neighs1[match[i0]]
+    matches = list(system.iter_matches(fragment, overlapping=False))
+    assert len(matches) > 0
+    assert len(set(sum(matches, ()))) == len(matches)*fragment.natom